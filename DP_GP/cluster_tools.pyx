@@ -1,9 +1,16 @@
 import cython
+import os
+import tempfile
 import numpy as np
 cimport numpy as np
 np.import_array()
 from DP_GP import utils
-from scipy.cluster.hierarchy import fclusterdata
+from DP_GP import executors
+from DP_GP.similarity import as_similarity, label_runs, co_clustered_before_and_after, share_similarity, load_similarity
+from scipy.cluster.hierarchy import linkage, fcluster
+
+# maximum number of entries of the posterior similarity matrix materialized at once
+_ROW_CHUNK = 2**22
 
 #############################################################################################
 
@@ -17,37 +24,79 @@ def log_factorial(n):
 
 #############################################################################################
 
-cdef compute_mpear(short[:] cluster_labels, double[:,:] sim_mat):
+def row_chunks(n_genes, chunk=None):
+    '''
+    Split genes into consecutive chunks of rows of the posterior similarity matrix, by 
+    default of at most _ROW_CHUNK entries each.
+    
+    :rtype: generator of (start, genes)
+    '''
+    if chunk is None:
+        chunk = max(1, _ROW_CHUNK // max(n_genes, 1))
+    for start in range(0, n_genes, chunk):
+        yield start, np.arange(start, min(start + chunk, n_genes))
+
+def mpear_terms(sim_mat):
+    '''
+    Compute the terms of MPEAR (see compute_mpear) that depend only on the posterior
+    similarity matrix, once for all clusterings, from chunks of its rows: the sum of its 
+    upper triangle, for each gene j the sum of sim_mat[i,j] over i < j - 1, and the sum 
+    of its diagonal.
+    
+    :param sim_mat: sim_mat[i,j] = (# samples gene i in cluster with gene j)/(# total samples)
+    :type sim_mat: numpy array of (0-1) floats or posterior similarity matrix backend
+    
+    :returns: (upper_sum, column_sums, diagonal_sum)
+    :rtype: tuple
+    '''
+    sim = as_similarity(sim_mat)
+    N = sim.n_genes
+    column_sums = np.zeros(N)
+    superdiagonal_sum, diagonal_sum = 0., 0.
+    for start, genes in row_chunks(N):
+        rows = sim.rows(genes)
+        column_sums += np.triu(rows, start + 2).sum(axis=0)
+        diagonal_sum += rows[np.arange(len(genes)), genes].sum()
+        above = genes[genes + 1 < N]
+        superdiagonal_sum += rows[above - start, above + 1].sum()
+    return column_sums.sum() + superdiagonal_sum, column_sums, diagonal_sum
+
+def compute_mpear(cluster_labels, sim_mat, terms=None):
     '''
     Compute MPEAR (Fritsch and Ickstadt 2009, DOI:10.1214/09-BA414).
     This function and accessory routines were taken with little 
     modification from Pyclone (Roth et al. 2014 DOI:10.1038/nmeth.2883).
+    The sum of sim_mat over co-clustered pairs is taken from the within-cluster
+    blocks of the posterior similarity matrix backend (see block_sum in DP_GP.similarity),
+    the other sums from the terms precomputed by mpear_terms.
     
     :param cluster_labels: cluster labels
     :type cluster_labels: numpy array of ints
     :param sim_mat: sim_mat[i,j] = (# samples gene i in cluster with gene j)/(# total samples)
-    :type sim_mat: numpy array of (0-1) floats
+    :type sim_mat: numpy array of (0-1) floats or posterior similarity matrix backend
+    :param terms: output of mpear_terms(sim_mat), computed if not given
+    :type terms: tuple
     
     :rtype: float
     
     '''
-    cdef int N = sim_mat.shape[0]
+    sim = as_similarity(sim_mat)
+    if terms is None:
+        terms = mpear_terms(sim)
+    upper_sum, column_sums, diagonal_sum = terms
+    
+    cdef int N = sim.n_genes
     cdef double c = np.exp(log_binomial_coefficient(N, 2))
-    cdef double num_term_1 = 0
-    cdef double num_term_2 = 0
-    cdef double den_term_1 = 0
-    
-    cdef size_t i, j
-    for j in range(N):
-        for i in range(j):
-            den_term_1 += sim_mat[i][j]
-            if cluster_labels[i] == cluster_labels[j]:
-                num_term_1 += sim_mat[i][j]
-                num_term_2 += sum(sim_mat[:j - 1, j])
-                den_term_1 += 1
+    order, starts, ends = label_runs(cluster_labels)
+    sizes = ends - starts
+    # S is symmetric, so the co-clustered pairs i < j hold half of the off-diagonal block sum
+    num_term_1 = (sim.block_sum(order, starts, ends) - diagonal_sum) / 2
+    before, after = co_clustered_before_and_after(order, starts, ends)
+    num_term_2 = np.dot(before, column_sums)
+    n_pairs = np.sum(sizes * (sizes - 1)) / 2.
     
     num_term_2 /= c
-    den_term_1 /= 2
+    den_term_1 = (upper_sum + n_pairs) / 2
     
     num = num_term_1 - num_term_2
     den = den_term_1 - num_term_2
@@ -79,43 +128,199 @@ def relabel_clustering(cluster_labels):
     
     return new_labels
 
+def canonical_clustering(cluster_labels):
+    '''
+    Relabel a clustering as in relabel_clustering, i.e. clusters numbered from 1 in order of
+    their first gene, so that two clusterings that are the same partition of genes have the
+    same labels (and byte representation, which serves as hash key of the partition).
+    
+    :param cluster_labels: cluster labels
+    :type cluster_labels: numpy array of ints
+    
+    :returns: canonical cluster labels
+    :rtype: numpy array of ints
+    '''
+    labels, first, inverse = np.unique(np.asarray(cluster_labels), return_index=True, return_inverse=True)
+    rank = np.empty(len(labels), dtype=np.int64)
+    rank[np.argsort(first, kind='mergesort')] = np.arange(1, len(labels) + 1)
+    return rank[inverse]
+
+def unique_clusterings(clusterings):
+    '''
+    Deduplicate sampled clusterings that are the same partition of genes under different
+    cluster labels, by hashing their canonical labels (see canonical_clustering).
+    
+    :param clusterings: clusterings[i,j] is the cluster to which gene j belongs at sample i
+    :type clusterings: numpy array of ints or clustering_trace
+    
+    :returns: (partitions, counts)
+        partitions: canonical labels of each distinct partition, in order of first sample
+        :type partitions: numpy array of ints of dimension P by N
+        counts: number of samples of each partition
+        :type counts: numpy array of ints
+    '''
+    chunks = clusterings.iter_chunks() if hasattr(clusterings, 'iter_chunks') else [np.asarray(clusterings)]
+    index, partitions, counts = {}, [], []
+    for rows in chunks:
+        for labels in rows:
+            partition = canonical_clustering(labels)
+            key = partition.tobytes()
+            if key not in index:
+                index[key] = len(partitions)
+                partitions.append(partition)
+                counts.append(0)
+            counts[index[key]] += 1
+    if len(partitions) == 0:
+        return np.zeros((0, 0), dtype=np.int64), np.zeros(0, dtype=np.int64)
+    return np.vstack(partitions), np.array(counts)
+
 #############################################################################################
 
 def compute_sq_dist(S, S_new):   
     '''
-    Compute the squared distance between two numpy matrices.
+    Compute the squared (Frobenius) distance between two numpy matrices.
     '''
     diff = S - S_new
-    sq_dist = np.sum(np.dot(diff, diff))
+    sq_dist = np.sum(diff * diff)
     return(sq_dist)
 
 
+def sum_of_squares(sim_mat):
+    '''
+    Compute the sum of squared entries of the posterior similarity matrix, from chunks of its rows.
+    
+    :param sim_mat: sim_mat[i,j] = (# samples gene i in cluster with gene j)/(# total samples)
+    :type sim_mat: numpy array of (0-1) floats or posterior similarity matrix backend
+    
+    :rtype: float
+    '''
+    sim = as_similarity(sim_mat)
+    return sum([np.sum(np.square(sim.rows(genes))) for start, genes in row_chunks(sim.n_genes)])
+
+def compute_least_squares_distance(cluster_labels, sim_mat, sim_sq_sum=None):
+    '''
+    Compute the squared (Frobenius) distance between the co-clustering matrix of a clustering,
+    1[c_i = c_j], and the posterior similarity matrix (Dahl 2006), as
+    sum(sim_mat^2) - 2 sum of sim_mat over co-clustered pairs + number of co-clustered pairs, 
+    from the within-cluster blocks of the posterior similarity matrix backend (see block_sum 
+    in DP_GP.similarity), without materializing the co-clustering matrix or sim_mat.
+    
+    :param cluster_labels: cluster labels
+    :type cluster_labels: numpy array of ints
+    :param sim_mat: sim_mat[i,j] = (# samples gene i in cluster with gene j)/(# total samples)
+    :type sim_mat: numpy array of (0-1) floats or posterior similarity matrix backend
+    :param sim_sq_sum: output of sum_of_squares(sim_mat), computed if not given
+    :type sim_sq_sum: float
+    
+    :rtype: float
+    '''
+    sim = as_similarity(sim_mat)
+    if sim_sq_sum is None:
+        sim_sq_sum = sum_of_squares(sim)
+    order, starts, ends = label_runs(cluster_labels)
+    sizes = ends - starts
+    return sim_sq_sum - 2 * sim.block_sum(order, starts, ends) + np.sum(sizes * sizes)
+
+#############################################################################################
+#
+#    Scoring of sampled clusterings, in parallel
+#
 #############################################################################################
 
-def best_clustering_by_mpear(clusterings, sim_mat):
+# number of clusterings scored per task
+_SCORING_CHUNK = 16
+
+def score_chunk(task):
+    '''
+    Score a chunk of clusterings by one criterion. Module-level so that it can be dispatched 
+    to a process pool, in which case the posterior similarity matrix backend is given by the 
+    handle of share_similarity and memory-mapped, so that all processes share one copy.
+    
+    :param task: (criterion, clusterings, sim, terms), where criterion is 'MPEAR' (see 
+                 compute_mpear) or 'least_squares' (see compute_least_squares_distance), 
+                 sim is a posterior similarity matrix backend or the handle of one, and terms
+                 are the precomputed terms of the criterion
+    :type task: tuple
+    
+    :rtype: list of floats
+    '''
+    criterion, clusterings, sim, terms = task
+    if isinstance(sim, tuple):
+        sim = load_similarity(sim)
+    score = compute_mpear if criterion == 'MPEAR' else compute_least_squares_distance
+    return [score(clustering, sim, terms) for clustering in clusterings]
+
+def score_clusterings(clusterings, sim_mat, criterion, terms, executor=None):
+    '''
+    Score clusterings by one criterion in chunks, in parallel by an executor (see DP_GP.executors).
+    Threads share the posterior similarity matrix backend (and score with the GIL released), 
+    processes memory-map one copy of its data (e.g. integer co-clustering counts) written to 
+    a temporary file. Besides the backend, tasks only carry the clusterings and the terms
+    of the criterion, of size O(N).
+    
+    :param clusterings: clusterings[i,j] is the cluster to which gene j belongs at sample i
+    :type clusterings: numpy array of ints
+    :param sim_mat: sim_mat[i,j] = (# samples gene i in cluster with gene j)/(# total samples)
+    :type sim_mat: numpy array of (0-1) floats or posterior similarity matrix backend
+    :param criterion: 'MPEAR' or 'least_squares'
+    :type criterion: str
+    :param terms: precomputed terms of the criterion (see mpear_terms and sum_of_squares)
+    :param executor: executor of the chunks [default=serial]
+    :type executor: serial_executor, thread_executor or process_executor
+    
+    :rtype: numpy array of floats
+    '''
+    if executor is None:
+        executor = executors.serial_executor()
+    clusterings = np.asarray(clusterings)
+    sim = as_similarity(sim_mat)
+    path = None
+    if not executor.shares_memory:
+        handle, path = tempfile.mkstemp(suffix='.npy')
+        os.close(handle)
+        sim = share_similarity(sim, path)
+    try:
+        tasks = [(criterion, clusterings[start:start + _SCORING_CHUNK], sim, terms) 
+                 for start in range(0, len(clusterings), _SCORING_CHUNK)]
+        scores = [score for chunk_scores in executor.map(score_chunk, tasks) for score in chunk_scores]
+    finally:
+        if path is not None:
+            os.remove(path)
+    return np.array(scores)
+
+#############################################################################################
+
+def best_clustering_by_mpear(clusterings, sim_mat, executor=None, partitions=None):
     """
     Find the optimal clustering according to the MPEAR criterion.
+    Each distinct partition among the sampled clusterings is scored once (see unique_clusterings).
     
     :param clusterings: clusterings[i,j] is the cluster to which gene j belongs at sample i
-    :type clusterings: numpy array of ints
+    :type clusterings: numpy array of ints or clustering_trace
     :param sim_mat: sim_mat[i,j] = (# samples gene i in cluster with gene j)/(# total samples)
-    :type sim_mat: numpy array of (0-1) floats
+    :type sim_mat: numpy array of (0-1) floats or posterior similarity matrix backend
+    :param executor: executor of the scoring of clusterings (see score_clusterings)
+    :type executor: serial_executor, thread_executor or process_executor
+    :param partitions: output of unique_clusterings(clusterings), computed if not given
+    :type partitions: tuple
     
     :returns: best_cluster_labels
         best_cluster_labels: best clustering
         :type best_cluster_labels: list    
     """
+    if partitions is None:
+        partitions = unique_clusterings(clusterings)
+    partitions, _ = partitions
+    sim = as_similarity(sim_mat)
+    pears = score_clusterings(partitions, sim, 'MPEAR', mpear_terms(sim), executor)
     max_pear = 0
     
-    clusterings = clusterings.astype(np.int16)
-    for i in range(len(clusterings)):
-        
-        pear = compute_mpear(clusterings[i,], sim_mat)
+    for i, pear in enumerate(pears):
         
         if pear > max_pear:
             
             max_pear = pear
-            best_cluster_labels = clusterings[i]
+            best_cluster_labels = partitions[i]
     
     best_cluster_labels = relabel_clustering(best_cluster_labels)
     return best_cluster_labels
@@ -150,60 +355,130 @@ def best_clustering_by_log_likelihood(clusterings, log_post_list):
 
 #############################################################################################
 
-def best_clustering_by_sq_dist(clusterings, sim_mat):
+def best_clustering_by_sq_dist(clusterings, sim_mat, executor=None, partitions=None):
     """
     Find the optimal clustering according to the Dahl 2006 least-squares criterion
     ("Model-based clustering for expression data via a Dirichlet process mixture model").
+    Each distinct partition among the sampled clusterings is scored once (see unique_clusterings).
     
     :param clusterings: clusterings[i,j] is the cluster to which gene j belongs at sample i
-    :type clusterings: numpy array of ints
+    :type clusterings: numpy array of ints or clustering_trace
     :param sim_mat: sim_mat[i,j] = (# samples gene i in cluster with gene j)/(# total samples)
-    :type sim_mat: numpy array of (0-1) floats
+    :type sim_mat: numpy array of (0-1) floats or posterior similarity matrix backend
+    :param executor: executor of the scoring of clusterings (see score_clusterings)
+    :type executor: serial_executor, thread_executor or process_executor
+    :param partitions: output of unique_clusterings(clusterings), computed if not given
+    :type partitions: tuple
     
     :returns: best_cluster_labels
         best_cluster_labels: best clustering
         :type best_cluster_labels: list    
     """
+    if partitions is None:
+        partitions = unique_clusterings(clusterings)
+    partitions, _ = partitions
+    sim = as_similarity(sim_mat)
+    dists = score_clusterings(partitions, sim, 'least_squares', sum_of_squares(sim), executor)
     
     min_dist = np.inf
     
-    for i in range(len(clusterings)):
-        clustering = clusterings[i,:]
-        S = np.zeros((len(clustering), len(clustering)))
-        for j in range(len(clustering)):
-            for k in range(len(clustering)):
-                if clustering[j] == clustering[k]:
-                    S[j,k] = 1
-                else:
-                    S[j,k] = 0
-        
-        dist = compute_sq_dist(S, sim_mat)
+    for i, dist in enumerate(dists):
         
         if dist < min_dist:
             
             min_dist = dist
-            best_cluster_labels = clusterings[i]
+            best_cluster_labels = partitions[i]
     
     best_cluster_labels = relabel_clustering(best_cluster_labels)
     return best_cluster_labels
 
-def best_clustering_by_h_clust(clusterings, method):
+def condensed_distance(sim, genes, chunk=1000):
+    '''
+    Compute the condensed distance matrix 1 - S (in the order of scipy.spatial.distance.pdist) 
+    among the given genes, filling it from chunks of rows of S so that no other N x N 
+    matrix is created.
+    
+    :param sim: posterior similarity matrix
+    :type sim: posterior similarity matrix backend (see DP_GP.similarity)
+    :param genes: gene indices
+    :type genes: numpy array of ints
+    :param chunk: number of rows of S materialized at once
+    :type chunk: int
+    
+    :rtype: numpy array of floats of length n (n - 1) / 2, n = number of genes
+    '''
+    n = len(genes)
+    distance = np.empty(n * (n - 1) // 2)
+    position = 0
+    for start in range(0, n, chunk):
+        rows = sim.rows(genes[start:start + chunk])[:,genes]
+        for k in range(rows.shape[0]):
+            i = start + k
+            distance[position:position + n - i - 1] = 1. - rows[k, i + 1:]
+            position += n - i - 1
+    return distance
+
+def best_clustering_by_h_clust(sim_mat, method, threshold=0.5, memory_budget=4e9, random_state=np.random):
     """
-    Find the optimal clustering by hierarchical clustering. For more details, see
-    description of scipy.cluster.hierarchy.fclusterdata.
+    Find the optimal clustering by hierarchical clustering of genes by the distance 1 - S
+    (S = posterior similarity matrix), with average or complete linkage, cut at distance
+    threshold. E.g. with average linkage and threshold 0.5, the genes of two clusters are
+    on average co-clustered in less than half of the samples. For more details, see 
+    description of scipy.cluster.hierarchy.linkage, which computes average and complete 
+    linkage by the nearest-neighbor chain algorithm from the condensed distance matrix.
+    
+    If the condensed distance matrix does not fit into memory_budget, the clustering is 
+    approximated: a random subset of genes (landmarks), as large as fits, is clustered, and
+    every other gene is assigned to the cluster of landmarks it is closest to by the same 
+    linkage, i.e. by average or minimum similarity.
     
-    :param clusterings: clusterings[i,j] is the cluster to which gene j belongs at sample i
-    :type clusterings: numpy array of ints
     :param sim_mat: sim_mat[i,j] = (# samples gene i in cluster with gene j)/(# total samples)
-    :type sim_mat: numpy array of (0-1) floats
+    :type sim_mat: numpy array of (0-1) floats or posterior similarity matrix backend
+    :param method: 'average' or 'complete'
+    :type method: str
+    :param threshold: distance at which the hierarchy is cut
+    :type threshold: float
+    :param memory_budget: memory (in bytes) available to the condensed distance matrix
+    :type memory_budget: float
+    :param random_state: source of random numbers for choosing landmarks
+    :type random_state: numpy.random.RandomState
     
     :returns: best_cluster_labels
         best_cluster_labels: best clustering
         :type best_cluster_labels: list    
     """
-    best_cluster_labels = fclusterdata(clusterings, 0.99, method=method, metric='hamming')
-    best_cluster_labels = relabel_clustering(best_cluster_labels)
-    return best_cluster_labels
+    sim = as_similarity(sim_mat)
+    N = sim.n_genes
+    if N == 1:
+        return [1]
+    
+    # as many landmarks as the condensed distances among them fit into memory
+    n_landmarks = min(N, max(2, int(np.sqrt(2 * memory_budget / 8.))))
+    while n_landmarks > 2 and 8. * n_landmarks * (n_landmarks - 1) / 2. > memory_budget:
+        n_landmarks -= 1
+    if n_landmarks < N:
+        print "WARNING: the distance matrix of %s genes does not fit into memory, approximating %s by %s landmark genes"%(N, method, n_landmarks)
+        landmarks = np.sort(random_state.choice(N, n_landmarks, replace=False))
+    else:
+        landmarks = np.arange(N)
+    
+    Z = linkage(condensed_distance(sim, landmarks), method=method)
+    landmark_labels = fcluster(Z, threshold, criterion='distance')
+    if n_landmarks == N:
+        return relabel_clustering(landmark_labels)
+    
+    # assign all genes (including landmarks, which stay put) to the closest cluster of landmarks
+    order, starts, ends = label_runs(landmark_labels)
+    reduce_linkage = np.add if method == 'average' else np.minimum
+    best_cluster_labels = np.empty(N, dtype=int)
+    for start in range(0, N, 1000):
+        rows = sim.rows(np.arange(start, min(start + 1000, N)))[:,landmarks[order]]
+        similarity = reduce_linkage.reduceat(rows, starts, axis=1)
+        if method == 'average':
+            similarity /= ends - starts
+        best_cluster_labels[start:start + rows.shape[0]] = landmark_labels[order[starts]][np.argmax(similarity, axis=1)]
+    best_cluster_labels[landmarks] = landmark_labels
+    return relabel_clustering(best_cluster_labels)
 
 #############################################################################################
 
@@ -237,3 +512,29 @@ def save_cluster_membership_information(optimal_cluster_labels, output, gene_to_
             else:
                 handle.write('%s\t%s\t%0.4f\n'%(cluster, gene, gene_to_prob[gene]))
     handle.close()
+
+#############################################################################################
+
+def save_partition_frequencies(partitions, gene_names, output):
+    """
+    Save the posterior frequencies of the distinct sampled partitions, from most to least 
+    frequent, in the form:
+    frequency<tab>count<tab>n_clusters<tab>gene1<tab>gene2 ...
+    where the gene columns hold the canonical cluster labels of the partition.
+    
+    :param partitions: output of unique_clusterings
+    :type partitions: tuple
+    :param gene_names: gene names, in order of the columns of the clusterings
+    :type gene_names: list
+    :param output: absolute path to output
+    :type output: str
+    
+    """
+    partitions, counts = partitions
+    order = np.argsort(-counts, kind='mergesort')
+    handle = open(output, "w")
+    handle.write('\t'.join(['frequency', 'count', 'n_clusters'] + [str(gene) for gene in gene_names]) + '\n')
+    for i in order:
+        handle.write('%0.4f\t%s\t%s\t'%(counts[i] / float(counts.sum()), counts[i], partitions[i].max()))
+        handle.write('\t'.join([str(label) for label in partitions[i]]) + '\n')
+    handle.close()
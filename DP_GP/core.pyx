@@ -5,16 +5,28 @@ Created on 2016-03-06
 '''
 import cython
 from cpython cimport bool 
+from libc.math cimport exp, log
 from sys import float_info
 import numpy as np
 cimport numpy as np
 np.import_array()
 import pandas as pd
-import collections
 import GPy
 import scipy
+from scipy.special import gammaln
 import copy
+import heapq
+import time
+import os
+import signal
+import cPickle as pickle
 from DP_GP import utils
+from DP_GP import gp
+from DP_GP import executors
+from DP_GP import similarity
+from DP_GP.diagnostics import streaming_diagnostics
+from DP_GP.trace import clustering_trace
+from DP_GP.similarity import label_runs, co_clustered_before_and_after
 from sklearn.preprocessing import scale,StandardScaler
 import sys
 
@@ -24,9 +36,242 @@ def squared_dist_two_matrices(S, S_new):
     sq_dist = np.sum(np.dot(diff, diff))
     return(sq_dist)
 
+class SamplingTerminated(Exception):
+    '''
+    Raised by gibbs_sampler.sampler() when it terminates on SIGTERM, after writing a final 
+    checkpoint. Unlike exiting, it propagates from a process pool worker to the parent process.
+    '''
+
 # pre-compute useful value
 _LOG_2PI = np.log(2 * np.pi)
 
+# number of slots by which the cluster table grows
+_SLOT_CHUNK = 256
+
+# maximum number of elements of the gene x cluster x T projections computed at once
+_LL_CHUNK = 2**22
+
+# eigenvalues (or squared Cholesky pivots) below this fraction of the largest are treated as zero
+_RANK_RTOL = 1E6 * np.finfo('float64').eps
+
+#############################################################################################
+# 
+#    Routines for Cholesky factors of cluster covariance matrices
+#
+#############################################################################################
+
+def jittered_cholesky(A, int max_tries=5, rtol=None):
+    '''
+    Compute the lower Cholesky factor of a symmetric positive (semi-)definite matrix. If the
+    factorization fails, retry with a jitter added to the diagonal, starting at 1e-10 times 
+    the mean of the diagonal and increasing tenfold for up to max_tries attempts.
+    
+    If rtol is given, only a factor of a full-rank matrix is accepted: the jitter may not
+    exceed rtol times the mean of the diagonal, and the smallest squared pivot diag(L)^2
+    must exceed rtol times the largest.
+    
+    :param A: symmetric matrix
+    :type A: numpy array of dimension T by T
+    :param max_tries: maximum number of jittered attempts
+    :type max_tries: int
+    :param rtol: relative tolerance below which A is treated as rank-deficient [default=None]
+    :type rtol: float
+    
+    :returns: lower triangular L such that L L^T = A (+ jitter I), or None if A is
+              not positive definite up to the largest jitter (or rank-deficient, if rtol is given)
+    :rtype: numpy array of dimension T by T
+    '''
+    mean_diag = np.mean(np.diag(A))
+    max_jitter = np.inf if rtol is None else rtol * mean_diag
+    jitter = 0
+    for i in range(max_tries + 1):
+        try:
+            L = scipy.linalg.cholesky(A + jitter * np.eye(A.shape[0]), lower=True, check_finite=False)
+            break
+        except np.linalg.LinAlgError:
+            if not mean_diag > 0:
+                return None
+            jitter = 1e-10 * mean_diag if jitter == 0 else 10 * jitter
+            if jitter > max_jitter:
+                return None
+    else:
+        return None
+    
+    if rtol is not None:
+        pivots = np.diag(L)**2
+        if not np.min(pivots) > rtol * np.max(pivots):
+            return None
+    return L
+
+def factorize_covariance(covK, factorization='cholesky'):
+    ''' 
+    Factorize a predictive covariance matrix such that the multivariate normal
+    log-likelihood of x is -0.5 * (rank * log(2 pi) + log_pdet + q(x - mean)), where
+    the quadratic form q is computed from the factor (see factor_sq_norms).
+    
+    By default, the covariance matrix is factorized by a (jittered) Cholesky 
+    decomposition L L^T. The factor is L itself (triangular = True), so that
+    q(d) = |L^-1 d|^2 is computed by triangular solves against the data, and 
+    log_pdet = 2 sum(log(diag(L))).
+    
+    Only if the covariance matrix is rank-deficient, i.e. if its Cholesky factor
+    does not exist or has a squared pivot below _RANK_RTOL times the largest one
+    (or factorization = 'eigh'), 
+    because covariance matrix is symmetric positive semi-definite,
+    the eigendecomposition can be quickly computed and, from that,
+    the pseudo-determinant. The factor is then U, with q(d) = |d U|^2 (triangular = False).
+    This will rapidly speed up multivariate
+    normal likelihood calculations compared to e.g. scipy.stats.multivariate_normal.
+    
+    Code taken with little modification from:
+    https://github.com/cs109/content/blob/master/labs/lab6/_multivariate.py
+    
+    :param covK: covariance matrix
+    :type covK: numpy array of dimension T by T
+    :param factorization: 'cholesky' or 'eigh'
+    :type factorization: str
+    
+    :returns: (rank, factor, log_pdet, triangular)
+    :rtype: tuple
+    '''
+    if factorization == 'cholesky':
+        L = jittered_cholesky(covK, rtol=_RANK_RTOL)
+        if L is not None:
+            return L.shape[0], L, 2 * np.sum(np.log(np.diag(L))), True
+    
+    s, u = scipy.linalg.eigh(covK, check_finite=False)
+    eps = _RANK_RTOL * np.max(abs(s))
+    d = s[s > eps]
+    s_pinv = np.zeros_like(s)
+    nonzero = abs(s) > eps
+    s_pinv[nonzero] = 1. / s[nonzero]
+    return len(d), np.multiply(u, np.sqrt(s_pinv)), np.sum(np.log(d)), False
+
+def factor_sq_norms(diff, factor, triangular):
+    '''
+    For each row k of diff, compute the quadratic form of the likelihood (see factorize_covariance) 
+    under one factor: |L^-1 diff[k]|^2 by one triangular solve against all rows if the factor is 
+    a lower Cholesky factor L (half the multiply-adds of a product with a dense T x T matrix), 
+    and |diff[k] U|^2 otherwise.
+    
+    :param diff: differences between expression vectors and a cluster mean
+    :type diff: numpy array of dimension K by T
+    :param factor: factor of the covariance matrix of the cluster
+    :type factor: numpy array of dimension T by T
+    :param triangular: whether factor is a lower Cholesky factor
+    :type triangular: bool
+    
+    :rtype: numpy array of floats of length K
+    '''
+    if triangular:
+        z = scipy.linalg.solve_triangular(factor, diff.T, lower=True, check_finite=False)
+        return np.einsum('tk,tk->k', z, z)
+    proj = np.dot(diff, factor)
+    return np.einsum('kt,kt->k', proj, proj)
+
+def log_likelihood_matrix(expression, means, factors, triangular, rank, log_pdet):
+    '''
+    Multivariate normal log-likelihoods of N expression vectors under each of K clusters.
+    Clusters with Cholesky factors are scored one by one, each by a triangular solve against
+    all expression vectors (see factor_sq_norms). For the other (eigh) factors, because 
+    |(x - mean) U|^2 = |x U - mean U|^2, the projections of all expression vectors onto all
+    of them are one matrix product with the factors stacked side by side. Expression vectors
+    are processed in chunks of at most _LL_CHUNK projections, to bound memory.
+    
+    :param expression: expression vectors without missing data
+    :type expression: numpy array of dimension N by T
+    :param means: stacked cluster means
+    :type means: numpy array of dimension K by T
+    :param factors: stacked factors (see factorize_covariance)
+    :type factors: numpy array of dimension K by T by T
+    :param triangular: whether each factor is a lower Cholesky factor
+    :type triangular: numpy array of bools of length K
+    :param rank: ranks of the covariance matrices
+    :type rank: numpy array of length K
+    :param log_pdet: log pseudo-determinants of the covariance matrices
+    :type log_pdet: numpy array of length K
+    
+    :rtype: numpy array of dimension N by K
+    '''
+    K, T = means.shape
+    cholesky, dense = np.flatnonzero(triangular), np.flatnonzero(~triangular)
+    if len(dense) > 0:
+        U_stacked = np.ascontiguousarray(np.transpose(factors[dense], (1, 0, 2))).reshape(T, len(dense) * T)
+        mean_proj = np.einsum('kt,kts->ks', means[dense], factors[dense])
+    sq_norms = np.empty((expression.shape[0], K))
+    chunk = max(1, _LL_CHUNK // max(1, K * T))
+    for start in range(0, expression.shape[0], chunk):
+        rows = expression[start:start+chunk]
+        for k in cholesky:
+            sq_norms[start:start+chunk, k] = factor_sq_norms(rows - means[k], factors[k], True)
+        if len(dense) > 0:
+            proj = np.dot(rows, U_stacked).reshape(-1, len(dense), T) - mean_proj
+            sq_norms[start:start+chunk, dense] = np.einsum('nks,nks->nk', proj, proj)
+    return -0.5 * (rank * _LOG_2PI + log_pdet + sq_norms)
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def sample_assignment(double[::1] LL, np.intp_t[::1] sizes, np.intp_t[::1] clusterIDs, np.intp_t own_cluster, double alpha, int m, double u):
+    '''
+    Draw the cluster of a gene from its posterior over clusters, i.e. proportional to the 
+    product of the prior of Neal's algorithm 8 (DOI:10.1080/10618600.2000.10474879, see 
+    _log_prior) and the multivariate normal likelihood of the gene under each cluster, 
+    from cached log-likelihoods and a uniform random number. Unnormalized log-posteriors are
+    exponentiated relative to the largest one, and the first cluster at which their cumulative 
+    sum exceeds u times their sum is chosen.
+    
+    :param LL: log-likelihoods of the gene under each slot of the cluster table
+    :type LL: numpy array of floats
+    :param sizes: number of genes in each slot of the cluster table
+    :type sizes: numpy array of ints
+    :param clusterIDs: active clusters in ascending order
+    :type clusterIDs: numpy array of ints
+    :param own_cluster: cluster to which the gene currently belongs
+    :type own_cluster: int
+    :param alpha: concentration parameter of the Dirichlet process
+    :type alpha: float
+    :param m: number of empty clusters
+    :type m: int
+    :param u: uniform random number in [0, 1)
+    :type u: float
+    
+    :returns: index of the chosen cluster in clusterIDs
+    :rtype: int
+    '''
+    cdef Py_ssize_t k, K = clusterIDs.shape[0]
+    cdef double log_empty_prior, log_post, log_post_max = -np.inf, total = 0, cumulative = 0
+    cdef bint singleton = sizes[own_cluster] == 1
+    
+    # Neal's algorithm 8: if the gene is a singleton, its cluster counts as one more empty cluster
+    log_empty_prior = log(alpha / (m + 1)) if singleton else log(alpha / m)
+    for k in range(K):
+        log_post = _log_prior(sizes, clusterIDs[k], own_cluster, singleton, log_empty_prior) + LL[clusterIDs[k]]
+        if log_post > log_post_max:
+            log_post_max = log_post
+    for k in range(K):
+        total += exp(_log_prior(sizes, clusterIDs[k], own_cluster, singleton, log_empty_prior) + LL[clusterIDs[k]] - log_post_max)
+    u *= total
+    for k in range(K):
+        cumulative += exp(_log_prior(sizes, clusterIDs[k], own_cluster, singleton, log_empty_prior) + LL[clusterIDs[k]] - log_post_max)
+        if u < cumulative:
+            return k
+    return K - 1
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef inline double _log_prior(np.intp_t[::1] sizes, np.intp_t clusterID, np.intp_t own_cluster, bint singleton, double log_empty_prior):
+    '''
+    Log Chinese Restaurant Process prior of a cluster, unnormalized: the number of other genes
+    in the cluster, or alpha / m for an empty cluster. If the gene is a singleton, its own cluster 
+    counts as one more empty cluster, i.e. each has alpha / (m + 1).
+    '''
+    if clusterID == own_cluster:
+        return log_empty_prior if singleton else log(sizes[clusterID] - 1)
+    if sizes[clusterID] == 0:
+        return log_empty_prior
+    return log(sizes[clusterID])
+
 #############################################################################################
 # 
 #    Routine for reading gene expression matrix/matrices
@@ -112,24 +357,30 @@ def save_clusterings(sampled_clusterings, output_path_prefix):
     """
     Save all sampled clusterings to output_path_prefix + "_clusterings.txt".
     
-    :param sampled_clusterings: a pandas dataframe where each column is a gene,
+    :param sampled_clusterings: a trace (or pandas dataframe) where each column is a gene,
                              each row is a sample, and each record is the cluster
                              assignment for that gene for that sample.
-    :type sampled_clusterings: pandas dataframe of dimension S by N,
+    :type sampled_clusterings: clustering_trace or pandas dataframe of dimension S by N,
                          where S=number of samples, N = number of genes
     :param output_path_prefix: absolute path to output
     :type output_path_prefix: str
     
     :returns: NULL
     """
-    sampled_clusterings.to_csv(output_path_prefix + "_clusterings.txt", sep='\t', index=False)
+    if isinstance(sampled_clusterings, pd.DataFrame):
+        sampled_clusterings.to_csv(output_path_prefix + "_clusterings.txt", sep='\t', index=False)
+    else:
+        sampled_clusterings.save(output_path_prefix + "_clusterings.txt")
     
 def save_posterior_similarity_matrix(sim_mat, gene_names, output_path_prefix):
     """
     Save posterior similarity matrix to output_path_prefix + "_posterior_similarity_matrix.txt".
     
+    Rows are written in chunks, so that a posterior similarity matrix backend is never
+    materialized as a whole.
+    
     :param sim_mat: sim_mat[i,j] = (# samples gene i in cluster with gene j)/(# total samples)
-    :type sim_mat: numpy array of (0-1) floats
+    :type sim_mat: numpy array of (0-1) floats or posterior similarity matrix backend
     :param gene_names: list of gene names
     :type gene_names: list
     :param output_path_prefix: absolute path to output
@@ -137,7 +388,7 @@ def save_posterior_similarity_matrix(sim_mat, gene_names, output_path_prefix):
     
     :returns: NULL
     """
-    pd.DataFrame(sim_mat, columns=gene_names, index=gene_names).to_csv(output_path_prefix+"_posterior_similarity_matrix.txt", sep='\t')
+    similarity.save_similarity_matrix(sim_mat, gene_names, output_path_prefix+"_posterior_similarity_matrix.txt")
 
 def save_log_likelihoods(log_likelihoods, output_path_prefix):
     """
@@ -177,9 +428,10 @@ def save_posterior_similarity_matrix_key(gene_names, output_path_prefix):
 
 class dp_cluster():
     '''
-    dp_cluster object is composed of 0 or more genes and is parameterized by a Gaussian process.
+    dp_cluster object is composed of 1 or more genes and is parameterized by a Gaussian process.
+    Empty (auxiliary) clusters are drawn from the GP prior instead (see auxiliary_cluster).
     
-    :param members: 0 or more gene indices that belong to cluster
+    :param members: 1 or more gene indices that belong to cluster
     :type members: list
     :param sigma_n: initial noise variance
     :type sigma_n: float
@@ -187,17 +439,28 @@ class dp_cluster():
     :type X: numpy array of dimension 1 x P, where P = number of time points
     :param iter_num_at_birth: iteration when cluster created
     :type iter_num_at_birth: int
+    :param factorization: factorization of the predictive covariance, 'cholesky' (jittered
+                          Cholesky, eigendecomposition only if rank-deficient) or 'eigh'
+    :type factorization: str
+    :param gp_backend: Gaussian process regression backend, 'native', 'native_stats' or 'gpy' (see DP_GP.gp)
+    :type gp_backend: str
     
     :rtype: dp_cluster object
     
     '''
-    def __init__(self, members, X, Y=None, sigma_n=0.2, iter_num_at_birth=0, fast=False):
+    def __init__(self, members, X, Y=None, sigma_n=0.2, iter_num_at_birth=0, fast=False, factorization='cholesky', gp_backend='native'):
         
         self.dob = iter_num_at_birth # dob = date of birth, i.e. GS iteration number of creation
         self.members = members # members is a list of gene indices that belong to this cluster.
         self.size = len(self.members) # how many members?
         self.model_optimized = False # a newly created cluster is not optimized
+        self.fitted_members = None # members at the last hyperparameter fit
+        self.fit_seconds = None # duration of the hyperparameter fit at the last update (None if skipped)
+        self.priors = None # prior parameters set on the model
         self.fast = fast
+        self.factorization = factorization
+        # in fast mode, members are separate outputs of the GP, which native_stats does not summarize
+        self.gp_backend = 'native' if (fast and gp_backend == 'native_stats') else gp_backend
         
         # it may be beneficial to keep track of neg. log likelihood and hyperparameters over iterations
         self.sigma_f_at_iters, self.sigma_n_at_iters, self.l_at_iters, self.NLL_at_iters, self.update_iters = [],[],[],[],[]
@@ -207,77 +470,132 @@ class dp_cluster():
         # noise variance is initially set to a constant (and possibly estimated) value
         self.sigma_n = sigma_n
         if Y is not None:
-            if not self.fast:
-                # remove missing data
-                self.X = np.vstack([x for j in range(Y.shape[1]) for x in self.t[~np.isnan(Y[:,j])].flatten()])
-            else:
-                self.X = X
+            self.X, self.Y = self.training_data(Y)
         else:
             self.X = self.t
         
         # Define a convariance kernel with a radial basis function and freely allow for a overall slope and bias
-        self.kernel = GPy.kern.RBF(input_dim=1, variance = 1., lengthscale = 1.) + \
-                      GPy.kern.Linear(input_dim=1, variances=0.001) + \
-                      GPy.kern.Bias(input_dim=1, variance=0.001)
+        self.kernel = self.default_kernel()
         self.K = self.kernel.K(self.X)
-        if (self.size == 0):
-            # for empty clusters, draw a mean vector from the GP prior
-            self.Y = np.vstack(np.random.multivariate_normal(np.zeros(self.X.shape[0]), self.K, 1).flatten())
-        else: 
-            if not self.fast:
-                # remove missing data
-                self.Y = np.vstack([y for j in range(Y.shape[1]) for y in Y[:,j][~np.isnan(Y[:,j])].flatten()])
-            else:
-                self.Y = Y
-        
-        self.model = GPy.models.GPRegression(self.X, self.Y, self.kernel)
-        self.model.Gaussian_noise = self.sigma_n**2
+        
+        self.model = gp.regression(self.X, self.Y, self.kernel, self.gp_backend)
+        gp.set_noise_variance(self.model, self.sigma_n**2)
         self.mean, covK = self.model._raw_predict(self.t, full_cov=True)
         self.covK = self.kernel.K(self.t) + (self.sigma_n**2) * np.eye(self.t.shape[0])
         self.mean = self.mean.flatten()
         self.update_rank_U_and_log_pdet()
         
+    def default_kernel(self):
+        '''Radial basis function kernel plus linear and bias kernels, at initial hyperparameters.'''
+        return gp.default_kernel(self.gp_backend)
+    
+    def training_data(self, Y):
+        '''
+        Inputs and outputs of the GP regression of the members' expression Y.
+        Except in fast mode, the members are observations of one function: stacked
+        with missing data removed, or, for the native_stats backend, passed as they 
+        are to be summarized per time point.
+        
+        :param Y: expression of the members, one column per member
+        :type Y: numpy array of dimension |timepoints| x |members|
+        
+        :rtype: tuple of numpy arrays (X, Y)
+        '''
+        if self.fast or self.gp_backend == 'native_stats':
+            return self.t, Y
+        # remove missing data
+        X = np.vstack([x for j in range(Y.shape[1]) for x in self.t[~np.isnan(Y[:,j])].flatten()])
+        Y = np.vstack([y for j in range(Y.shape[1]) for y in Y[:,j][~np.isnan(Y[:,j])].flatten()])
+        return X, Y
+    
+    def __getstate__(self):
+        '''
+        Pickle the GP model as its type and parameter values, because GPy models
+        (whose kernel is shared with this cluster) cannot be restored by unpickling.
+        Native models are pickled as they are.
+        '''
+        state = self.__dict__.copy()
+        # factors for missing data are recomputed on demand
+        state.pop('pattern_factors', None)
+        if self.gp_backend != 'gpy':
+            return state
+        del state['kernel'], state['model']
+        state['sparse_model'] = gp.is_sparse(self.model)
+        state['param_array'] = self.model.param_array.copy()
+        return state
+    
+    def __setstate__(self, state):
+        '''Rebuild the GP model from its type and parameter values.'''
+        self.pattern_factors = {}
+        if state['gp_backend'] != 'gpy':
+            self.__dict__.update(state)
+            return
+        state = state.copy()
+        sparse_model = state.pop('sparse_model')
+        param_array = state.pop('param_array')
+        self.__dict__.update(state)
+        self.kernel = self.default_kernel()
+        if sparse_model:
+            self.model = GPy.models.SparseGPRegression(X=self.X, Y=self.Y, kernel=self.kernel, Z=np.vstack(self.t))
+        else:
+            self.model = GPy.models.GPRegression(X=self.X, Y=self.Y, kernel=self.kernel)
+        if self.priors is not None:
+            gp.set_priors(self.model, *self.priors)
+        self.model[:] = param_array
+        
     def update_rank_U_and_log_pdet(self):
         ''' 
-        Because covariance matrix is symmetric positive semi-definite,
-        the eigendecomposition can be quickly computed and, from that,
-        the pseudo-determinant. This will rapidly speed up multivariate
-        normal likelihood calculations compared to e.g. scipy.stats.multivariate_normal.
-        
-        Code taken with little modification from:
-        https://github.com/cs109/content/blob/master/labs/lab6/_multivariate.py
-        '''
-        s, u = scipy.linalg.eigh(self.covK, check_finite=False)
-        eps = 1E6 * np.finfo('float64').eps * np.max(abs(s))
-        d = s[s > eps]
-        s_pinv  = np.array([0 if abs(l) <= eps else 1/l for l in s], dtype=float)
-        self.rank = len(d)
-        self.U = np.multiply(u, np.sqrt(s_pinv))
-        self.log_pdet = np.sum(np.log(d))
-        
-    def add_member(self, new_member, iter_num):
-        ''' 
-        Add a member to this cluster and increment size.
+        Factorize the predictive covariance matrix (see factorize_covariance) such that 
+        the multivariate normal log-likelihood of x is 
+        -0.5 * (rank * log(2 pi) + log_pdet + q(x - mean)), and clear the 
+        factors of its sub-matrices for missing data (see marginal_factors).
         '''
-        self.members += [new_member]
-        self.size += 1
-        self.model_optimized = False
+        self.rank, self.factor, self.log_pdet, self.triangular = factorize_covariance(self.covK, self.factorization)
+        self.pattern_factors = {}
+    
+    def marginal_factors(self, observed):
+        '''
+        Factors (see update_rank_U_and_log_pdet) of the marginal distribution of the
+        observed time points, i.e. of the sub-matrix of the predictive covariance matrix,
+        to compute the log-likelihood of expression vectors with missing data. Factors are
+        cached by pattern of observed time points until the covariance matrix changes.
+        
+        :param observed: whether each time point is observed
+        :type observed: numpy array of bools
         
-    def remove_member(self, old_member, iter_num):
+        :returns: (rank, factor, log_pdet, triangular)
+        :rtype: tuple
         '''
-        Remove a member from this cluster and decrement size.
+        key = observed.tostring()
+        if key not in self.pattern_factors:
+            self.pattern_factors[key] = factorize_covariance(self.covK[np.ix_(observed, observed)], self.factorization)
+        return self.pattern_factors[key]
+    
+    def changed_fraction(self):
         '''
-        self.members = [member for member in self.members if member !=  old_member ]
-        self.size -= 1
-        self.model_optimized = False
+        Fraction of members that joined or left the cluster since the last 
+        hyperparameter fit (1 if the hyperparameters were never fitted).
+        '''
+        if self.fitted_members is None:
+            return 1.
+        changed = len(self.fitted_members.symmetric_difference(self.members))
+        return changed / float(max(len(self.fitted_members), self.size, 1))
         
-    def update_cluster_attributes(self, gene_expression_matrix, sigma_n2_shape=12, sigma_n2_rate=2, length_scale_mu=0., length_scale_sigma=1., sigma_f_mu=0., sigma_f_sigma=1., iter_num=0, max_iters=1000, optimizer='lbfgsb', sparse_regression=False, fast=False):
+    def update_cluster_attributes(self, gene_expression_matrix, sigma_n2_shape=12, sigma_n2_rate=2, length_scale_mu=0., length_scale_sigma=1., sigma_f_mu=0., sigma_f_sigma=1., iter_num=0, max_iters=1000, optimizer='lbfgsb', sparse_regression=False, fast=False, refit_threshold=0.):
         '''
         For all the clusters greater than size 1, update their Gaussian process hyperparameters,
         then return clusters.
         
+        After the first fit, the GP model is kept and only its data are replaced, so that
+        hyperparameters (including noise variance) are re-optimized starting from their
+        last fitted values. If fewer than refit_threshold of the members changed since
+        the last fit, the hyperparameters are kept as they are and only the predictive
+        mean and covariance are updated.
+        
         :param iter_num: current Gibbs sampling iteration
         :type iter_num: int
+        :param refit_threshold: minimum fraction of changed members to re-optimize hyperparameters
+        :type refit_threshold: float
         :param clusters: dictionary of dp_cluster objects
         :type clusters: dict
         
@@ -289,49 +607,14 @@ class dp_cluster():
         if (self.size > 0):
             
             if not self.model_optimized:
-                
-                # update model and associated hyperparameters
-                gene_expression_matrix = np.array(gene_expression_matrix)
-                if not self.fast:
-                    Y = np.array(np.mat(gene_expression_matrix[self.members,:])).T
-                    self.X = np.vstack([x for j in range(Y.shape[1]) for x in self.t[~np.isnan(Y[:,j])].flatten()])
-                    self.Y = np.vstack([y for j in range(Y.shape[1]) for y in Y[:,j][~np.isnan(Y[:,j])].flatten()])
-                else:
-                    self.Y = np.array(np.mat(gene_expression_matrix[self.members,:])).T
-                
-#                 print self.X
-#                 print "shape(self.X)", self.X.shape
-#                 print self.Y
-#                 print "shape(self.Y)", self.Y.shape
-                
-#                 self.K = self.kernel.K(self.X)
-                if not sparse_regression or self.size <= 20:
-                    self.model = GPy.models.GPRegression(X=self.X, Y=self.Y, kernel=self.kernel)
-                else:
-                    self.model = GPy.models.SparseGPRegression(X=self.X, Y=self.Y, kernel=self.kernel, Z=np.vstack(self.t))
-                
-                # for some reason, must re-set prior on Gaussian noise at every update:
-                self.model.Gaussian_noise.set_prior(GPy.priors.InverseGamma(sigma_n2_shape, sigma_n2_rate), warning=False)                
-                self.model.sum.rbf.lengthscale.set_prior(GPy.priors.LogGaussian(length_scale_mu, length_scale_sigma), warning=False)
-                self.model.sum.rbf.variance.set_prior(GPy.priors.LogGaussian(sigma_f_mu, sigma_f_sigma), warning=False)
-                self.model_optimized = True
-                self.model.optimize(optimizer, max_iters=max_iters)
-                
-                self.sigma_n = np.sqrt(self.model['Gaussian_noise'][0])
-                if not self.fast:
-                    mean, self.covK = self.model.predict(self.t, full_cov=True) #kern=self.model.kern)  
-                    self.mean = mean.flatten()
-                    self.K = self.kernel.K(self.t)
-                else:
-                    mean, self.covK = self.model.predict(self.X, full_cov=True, kern=self.model.kern)  
-                    self.mean = np.hstack(mean.mean(axis=1))
-                
-                self.update_rank_U_and_log_pdet()
+                self.fit(np.asarray(gene_expression_matrix)[self.members,:], sigma_n2_shape, sigma_n2_rate, length_scale_mu, length_scale_sigma, 
+                         sigma_f_mu, sigma_f_sigma, max_iters, optimizer, sparse_regression, refit_threshold)
                 
             # keep track of neg. log-likelihood and hyperparameters
             self.sigma_n_at_iters.append(self.sigma_n)
-            self.sigma_f_at_iters.append(np.sqrt(self.model.sum.rbf.variance))
-            self.l_at_iters.append(np.sqrt(self.model.sum.rbf.lengthscale))
+            sigma_f2, length_scale, sigma_n2 = gp.hyperparameters(self.model)
+            self.sigma_f_at_iters.append(np.sqrt(sigma_f2))
+            self.l_at_iters.append(np.sqrt(length_scale))
             self.NLL_at_iters.append( - float(self.model.log_likelihood()) )
             self.update_iters.append(iter_num)
             
@@ -341,6 +624,255 @@ class dp_cluster():
             pass
             
         return self
+    
+    def fit(self, member_expression, sigma_n2_shape=12, sigma_n2_rate=2, length_scale_mu=0., length_scale_sigma=1., sigma_f_mu=0., sigma_f_sigma=1., max_iters=1000, optimizer='lbfgsb', sparse_regression=False, refit_threshold=0.):
+        '''
+        Update the GP model with the expression of the current members, (re-)optimize
+        its hyperparameters (see update_cluster_attributes) and update the predictive 
+        mean and covariance and their factorization.
+        
+        :param member_expression: expression of the members over the time course
+        :type member_expression: numpy array of dimension |members| x |timepoints|
+        '''
+        # update model and associated hyperparameters
+        self.X, self.Y = self.training_data(np.array(np.mat(member_expression)).T)
+        
+#                 print self.X
+#                 print "shape(self.X)", self.X.shape
+#                 print self.Y
+#                 print "shape(self.Y)", self.Y.shape
+        
+#                 self.K = self.kernel.K(self.X)
+        sparse = sparse_regression and self.size > 20
+        if self.fitted_members is None or gp.is_sparse(self.model) != sparse:
+            # the new model starts from the hyperparameters of the (shared) kernel
+            # fitted at the last update, and from the default noise variance
+            self.model = gp.regression(self.X, self.Y, self.kernel, self.gp_backend, sparse=sparse, Z=np.vstack(self.t))
+            
+            # a new model has no priors, a warm-started model keeps those set here
+            self.priors = (sigma_n2_shape, sigma_n2_rate, length_scale_mu, length_scale_sigma, sigma_f_mu, sigma_f_sigma)
+            gp.set_priors(self.model, *self.priors)
+        else:
+            # warm start from all hyperparameters of the last fit
+            self.model.set_XY(self.X, self.Y)
+        self.model_optimized = True
+        
+        if self.changed_fraction() >= refit_threshold:
+            start = time.time()
+            self.model.optimize(optimizer, max_iters=max_iters)
+            self.fit_seconds = time.time() - start
+            self.fitted_members = set(self.members)
+        else:
+            self.fit_seconds = None
+        
+        self.update_predictive()
+    
+    def update_predictive(self):
+        '''
+        Update the predictive mean and covariance, and their factorization, from
+        the current data and hyperparameters of the GP model.
+        '''
+        self.sigma_n = np.sqrt(gp.hyperparameters(self.model)[2])
+        if not self.fast:
+            mean, self.covK = self.model.predict(self.t, full_cov=True) #kern=self.model.kern)  
+            self.mean = mean.flatten()
+            self.K = self.kernel.K(self.t)
+        else:
+            mean, self.covK = self.model.predict(self.X, full_cov=True, kern=self.model.kern)  
+            self.mean = np.hstack(mean.mean(axis=1))
+        
+        self.update_rank_U_and_log_pdet()
+    
+    def condition(self, member_expression, parameters):
+        '''
+        Update the predictive mean and covariance for the expression of the current members
+        at the given hyperparameters, without optimizing them. The hyperparameters are 
+        optimized at the next update (see update_cluster_attributes).
+        
+        :param member_expression: expression of the members over the time course
+        :type member_expression: numpy array of dimension |members| x |timepoints|
+        :param parameters: RBF variance, RBF lengthscale, linear variance, bias variance 
+                           and noise variance (see gp.kernel_parameters)
+        :type parameters: numpy array of floats
+        '''
+        self.X, self.Y = self.training_data(np.array(np.mat(member_expression)).T)
+        self.model.set_XY(self.X, self.Y)
+        self.model[-5:] = parameters
+        self.model_optimized = False
+        self.update_predictive()
+    
+    def fit_result(self):
+        '''
+        Collect the attributes set by fit(), with the GP model reduced to its type and
+        parameter values, e.g. to return a fit from another process.
+        
+        :rtype: dict
+        '''
+        result = {attribute:getattr(self, attribute) for attribute in ['X', 'Y', 'priors', 'fitted_members', 'fit_seconds', 'model_optimized', 
+                                                                       'sigma_n', 'mean', 'covK', 'K', 'rank', 'factor', 'log_pdet', 'triangular']}
+        result['sparse_model'] = gp.is_sparse(self.model)
+        result['param_array'] = np.array(self.model.param_array)
+        return result
+    
+    def apply_fit_result(self, result):
+        '''
+        Take over a fit of this cluster (with the same members) collected by fit_result().
+        
+        :param result: output of fit_result()
+        :type result: dict
+        '''
+        result = result.copy()
+        sparse_model = result.pop('sparse_model')
+        param_array = result.pop('param_array')
+        if result['priors'] != self.priors or gp.is_sparse(self.model) != sparse_model:
+            self.model = gp.regression(result['X'], result['Y'], self.kernel, self.gp_backend, sparse=sparse_model, Z=np.vstack(self.t))
+            gp.set_priors(self.model, *result['priors'])
+        else:
+            self.model.set_XY(result['X'], result['Y'])
+        self.model[:] = param_array
+        self.__dict__.update(result)
+        self.pattern_factors = {}
+
+#############################################################################################
+# 
+#    Define prior of auxiliary (empty) clusters
+#
+#############################################################################################
+
+class cluster_prior():
+    '''
+    Distribution of the mean trajectories of empty (auxiliary) clusters under the GP prior
+    at initial hyperparameters, factorized once for all auxiliary clusters.
+    
+    The mean of an empty cluster is the posterior mean of the GP given one draw y from 
+    the prior, K (K + sigma_n^2 I)^-1 y, so means are drawn as L z, where L = K (K + sigma_n^2 I)^-1 C
+    for a square root C of K and z is standard normal. All auxiliary clusters share the 
+    predictive covariance K + sigma_n^2 I and its factorization.
+    
+    :param X: vertically stacked array of time points
+    :type X: numpy array of dimension P by 1, where P = number of time points
+    :param sigma_n: initial noise standard deviation
+    :type sigma_n: float
+    :param factorization: factorization of the predictive covariance, 'cholesky' or 'eigh'
+    :type factorization: str
+    :param gp_backend: Gaussian process regression backend of the kernel (see DP_GP.gp)
+    :type gp_backend: str
+    '''
+    def __init__(self, X, sigma_n=0.2, factorization='cholesky', gp_backend='native'):
+        K = gp.default_kernel(gp_backend).K(X)
+        T = K.shape[0]
+        C = jittered_cholesky(K)
+        if C is None:
+            s, u = scipy.linalg.eigh(K, check_finite=False)
+            C = u * np.sqrt(np.clip(s, 0, np.inf))
+        # jitter as added to the noise variance by GP regression
+        self.L = np.dot(K, scipy.linalg.solve(K + (sigma_n**2 + 1e-8) * np.eye(T), C, assume_a='pos'))
+        self.covK = K + (sigma_n**2) * np.eye(T)
+        self.factorization = factorization
+        self.rank, self.factor, self.log_pdet, self.triangular = factorize_covariance(self.covK, factorization)
+        self.pattern_factors = {}
+    
+    def draw_means(self, int n, random_state=np.random):
+        '''
+        Draw mean trajectories of n auxiliary clusters in one matrix product.
+        
+        :param random_state: source of random numbers
+        :type random_state: numpy.random.RandomState
+        
+        :rtype: numpy array of dimension n by P
+        '''
+        return np.dot(random_state.standard_normal((n, self.L.shape[0])), self.L.T)
+    
+    def marginal_factors(self, observed):
+        '''Factors of the covariance sub-matrix of the observed time points, see dp_cluster.marginal_factors.'''
+        key = observed.tostring()
+        if key not in self.pattern_factors:
+            self.pattern_factors[key] = factorize_covariance(self.covK[np.ix_(observed, observed)], self.factorization)
+        return self.pattern_factors[key]
+
+class auxiliary_cluster():
+    '''
+    Empty (auxiliary) cluster with a mean trajectory drawn from the prior (see cluster_prior),
+    holding only what the Gibbs sampler needs to score genes under it. The covariance 
+    and its factors are those of the shared prior.
+    
+    :param prior: prior shared by all auxiliary clusters
+    :type prior: cluster_prior
+    :param mean: mean trajectory
+    :type mean: numpy array of length P
+    :param iter_num_at_birth: iteration when cluster created
+    :type iter_num_at_birth: int
+    '''
+    def __init__(self, prior, mean, iter_num_at_birth=0):
+        self.prior = prior
+        self.mean = mean
+        self.dob = iter_num_at_birth
+        self.members = []
+        self.size = 0
+        self.covK, self.rank, self.factor, self.log_pdet, self.triangular = prior.covK, prior.rank, prior.factor, prior.log_pdet, prior.triangular
+    
+    def marginal_factors(self, observed):
+        '''Factors of the covariance sub-matrix of the observed time points, shared through the prior.'''
+        return self.prior.marginal_factors(observed)
+
+#############################################################################################
+# 
+#    Routines for updating the hyperparameters of many clusters
+#
+#############################################################################################
+
+def fit_cluster(task):
+    '''
+    Fit one cluster, see dp_cluster.fit. Module-level so that it can be dispatched
+    to a process pool.
+    
+    :param task: (cluster, member_expression, fit_args) where fit_args are passed to dp_cluster.fit
+    :type task: tuple
+    
+    :returns: output of dp_cluster.fit_result()
+    :rtype: dict
+    '''
+    cluster, member_expression, fit_args = task
+    cluster.fit(member_expression, *fit_args)
+    return cluster.fit_result()
+
+def update_clusters(clusters, gene_expression_matrix, fit_args, int iter_num=0, executor=None):
+    '''
+    Update the attributes of several clusters, as dp_cluster.update_cluster_attributes.
+    The hyperparameters of clusters that are not optimized are fitted through the 
+    executor, largest cluster first. Clusters fitted in another process take over the
+    fitted hyperparameters and factors.
+    
+    :param clusters: dp_cluster objects
+    :type clusters: list
+    :param gene_expression_matrix: expression over timecourse of dimension |genes|x|timepoints|
+    :type gene_expression_matrix: numpy array of floats
+    :param fit_args: (sigma_n2_shape, sigma_n2_rate, length_scale_mu, length_scale_sigma, sigma_f_mu,
+                      sigma_f_sigma, max_iters, optimizer, sparse_regression, refit_threshold), see dp_cluster.fit
+    :type fit_args: tuple
+    :param iter_num: current Gibbs sampling iteration
+    :type iter_num: int
+    :param executor: executor (see DP_GP.executors), or None to fit serially
+    :type executor: serial_executor, thread_executor or process_executor
+    
+    :returns: clusters that were fitted
+    :rtype: list
+    '''
+    gene_expression_matrix = np.asarray(gene_expression_matrix)
+    to_fit = sorted([cluster for cluster in clusters if cluster.size > 0 and not cluster.model_optimized], key=lambda cluster: -cluster.size)
+    tasks = [(cluster, gene_expression_matrix[cluster.members,:], fit_args) for cluster in to_fit]
+    if executor is None:
+        map(fit_cluster, tasks)
+    elif executor.shares_memory:
+        executor.map(fit_cluster, tasks)
+    else:
+        for cluster, result in zip(to_fit, executor.map(fit_cluster, tasks)):
+            cluster.apply_fit_result(result)
+    
+    # keep track of neg. log-likelihood and hyperparameters
+    for cluster in clusters:
+        cluster.update_cluster_attributes(gene_expression_matrix, iter_num=iter_num)
+    return to_fit
 
 #############################################################################################
 # 
@@ -387,14 +919,53 @@ cdef class gibbs_sampler(object):
     :type sq_dist_eps: float
     :param post_eps: epsilon for posterior log likelihood convergence
     :type post_eps: float
+    :param sim_mat_backend: storage of the posterior similarity matrix, 'dense' (N x N counts),
+                            'partition' (sampled clusterings, rows materialized on demand)
+                            or 'auto' (dense if it fits into sim_mat_memory_budget)
+    :type sim_mat_backend: str
+    :param sim_mat_memory_budget: memory (in bytes) available to the posterior similarity matrix
+    :type sim_mat_memory_budget: float
+    :param checkpoint_path: file to which the sampler state is checkpointed, or None
+    :type checkpoint_path: str
+    :param checkpoint_every: checkpoint every checkpoint_every iterations (0 = only on SIGTERM)
+    :type checkpoint_every: int
+    :param spill_path_prefix: if given, clusterings are spilled to spill_path_prefix + 
+                              "_all_clusterings.bin" and "_sampled_clusterings.bin"
+    :type spill_path_prefix: str
+    :param factorization: factorization of cluster covariance matrices, 'cholesky' or 'eigh' (see dp_cluster)
+    :type factorization: str
+    :param gp_backend: Gaussian process regression backend, 'native', 'native_stats' or 'gpy' (see DP_GP.gp)
+    :type gp_backend: str
+    :param refit_threshold: minimum fraction of changed members for which the hyperparameters 
+                            of a cluster are re-optimized (see dp_cluster.update_cluster_attributes)
+    :type refit_threshold: float
+    :param fit_executor: executor of hyperparameter fits of clusters, 'serial', 'thread' or 'process'
+                         (see DP_GP.executors)
+    :type fit_executor: str
+    :param fit_processes: number of threads/processes of the executor [default=number of CPUs]
+    :type fit_processes: int
+    :param split_merge: number of split-merge moves (see split_merge_move) after each sweep
+                        over genes, not in fast mode
+    :type split_merge: int
+    :param seed: seed of the random numbers of the sampler, which are drawn from its own
+                 stream, independent of the global state of numpy.random (None = from the system)
+    :type seed: int
+    :param target_ess: if check_convergence and target_ess > 0, sampling converges once the effective 
+                       sample sizes of the log posterior likelihood, the number of clusters and the
+                       co-clustering of random gene pairs reach target_ess, leaving out those that
+                       stay constant (see DP_GP.diagnostics.streaming_diagnostics), instead of by 
+                       plateaus of the log likelihood and squared distance
+    :type target_ess: float
     
-    :returns: (S, sampled_clusterings, log_likelihoods, iter_num):
+    :returns: (S, all_clusterings, sampled_clusterings, log_likelihoods, iter_num):
         S: posterior similarity matrix
-        :type S: numpy array of dimension N by N where N=number of genes
-        sampled_clusterings: a pandas dataframe where each column is a gene,
+        :type S: posterior similarity matrix backend (see DP_GP.similarity) of N genes
+        all_clusterings: like sampled_clusterings, for every iteration after burn-in phase I
+        :type all_clusterings: clustering_trace
+        sampled_clusterings: a trace where each column is a gene,
                              each row is a sample, and each record is the cluster
                              assignment for that gene for that sample.
-        :type sampled_clusterings: pandas dataframe of dimension S by N,
+        :type sampled_clusterings: clustering_trace of dimension S by N,
                              where S=number of samples, N = number of genes
         log_likelihoods: list of log likelihoods of sampled clusterings
         :type log_likelihoods: list
@@ -406,9 +977,17 @@ cdef class gibbs_sampler(object):
     cdef int iter_num, num_samples_taken, min_sq_dist_counter, post_counter, m, s, burnIn_phaseI, burnIn_phaseII ,max_num_iterations, max_iters, n_genes
     cdef double min_sq_dist, prev_sq_dist, current_sq_dist, max_post, current_post, prev_post, alpha,  sigma_n_init, sigma_n2_shape, sigma_n2_rate, length_scale_mu, length_scale_sigma, sigma_f_mu, sigma_f_sigma, sq_dist_eps, post_eps
     cdef bool converged, converged_by_sq_dist, converged_by_likelihood, check_convergence, check_burnin_convergence, sparse_regression, fast
-    cpdef gene_expression_matrix
+    cdef bool resumed, terminate
+    cdef int checkpoint_every, checkpoint_iter
+    cdef int n_refits, n_refits_skipped
+    cdef int split_merge, n_splits_proposed, n_splits_accepted, n_merges_proposed, n_merges_accepted
+    cdef double refit_threshold, refit_seconds, target_ess
+    cpdef checkpoint_path, factorization, gp_backend, fit_executor, fit_processes
+    cpdef gene_expression_matrix, observed, observed_expression, complete_genes, missing_patterns
     cdef double[:] t
-    cpdef optimizer, X, last_MVN_by_cluster_by_gene, last_cluster, clusters, S, log_likelihoods, cluster_size_changes, last_proportions, sampled_clusterings, all_clusterings
+    cdef readonly LL_cache
+    cpdef optimizer, X, random_state, streaming_diagnostics, aux_prior, LL_column_version, cluster_version, log_marginal_cache, log_marginal_version, last_cluster, clusters, S, log_likelihoods, cluster_size_changes, last_proportions, sampled_clusterings, all_clusterings
+    cpdef cluster_means, cluster_factors, cluster_triangular, cluster_rank, cluster_log_pdet, cluster_sizes, occupied, free_slots, active, S_before, S_after
     
     def __init__(self,
                  gene_expression_matrix,
@@ -433,7 +1012,20 @@ cdef class gibbs_sampler(object):
                  double sigma_f_mu=0., 
                  double sigma_f_sigma=1., 
                  double sq_dist_eps=0.01, 
-                 double post_eps=1e-5):
+                 double post_eps=1e-5,
+                 sim_mat_backend='auto',
+                 double sim_mat_memory_budget=4e9,
+                 checkpoint_path=None,
+                 int checkpoint_every=0,
+                 spill_path_prefix=None,
+                 factorization='cholesky',
+                 gp_backend='native',
+                 double refit_threshold=0.,
+                 fit_executor='serial',
+                 fit_processes=None,
+                 int split_merge=0,
+                 seed=None,
+                 double target_ess=0):
         
         # hard-coded vars:        
         self.iter_num = 0
@@ -470,6 +1062,7 @@ cdef class gibbs_sampler(object):
         self.sq_dist_eps = sq_dist_eps
         self.post_eps = post_eps
         self.check_convergence = check_convergence
+        self.target_ess = target_ess
         self.check_burnin_convergence = check_burnin_convergence
         
         # option to run sparse regression for large datasets
@@ -479,6 +1072,30 @@ cdef class gibbs_sampler(object):
         # (only runs with no missing data)
         self.fast = fast
         
+        # factorization of cluster covariance matrices
+        self.factorization = factorization
+        
+        # Gaussian process regression backend
+        self.gp_backend = gp_backend
+        
+        # refit policy of hyperparameters, and number and total duration of refits
+        self.refit_threshold = refit_threshold
+        self.n_refits = 0
+        self.n_refits_skipped = 0
+        self.refit_seconds = 0.
+        
+        # parallelization of hyperparameter fits
+        self.fit_executor = fit_executor
+        self.fit_processes = fit_processes
+        
+        # split-merge moves and their acceptance
+        self.split_merge = split_merge
+        self.n_splits_proposed, self.n_splits_accepted = 0, 0
+        self.n_merges_proposed, self.n_merges_accepted = 0, 0
+        
+        # random numbers of this sampler
+        self.random_state = np.random.RandomState(seed)
+        
         # intialize kernel variables
         self.sigma_n_init = sigma_n_init
         self.sigma_n2_shape = sigma_n2_shape
@@ -490,156 +1107,472 @@ cdef class gibbs_sampler(object):
         self.t = t
         self.X = np.vstack(t)
         
+        # prior of the mean trajectories of empty clusters, factorized once
+        self.aux_prior = cluster_prior(self.X, self.sigma_n_init, factorization, gp_backend)
+        
         # initialize expression
         self.gene_expression_matrix = gene_expression_matrix
         self.n_genes = gene_expression_matrix.shape[0]
         
-        # initialize dictionary to keep track of logpdf of MVN by cluster by gene
-        self.last_MVN_by_cluster_by_gene = collections.defaultdict(dict)
-        
-        # initialize a posterior similarity matrix
+        # observed expression (missing data as 0) and its indicator, for sums over genes
+        self.observed = (~np.isnan(gene_expression_matrix)).astype(float)
+        self.observed_expression = np.where(self.observed > 0, gene_expression_matrix, 0.)
+        
+        # genes without missing data, and the other genes grouped by pattern of observed
+        # time points, so that each group is scored at once (see cache_log_likelihoods)
+        observed = self.observed > 0
+        complete = observed.all(axis=1)
+        self.complete_genes = np.flatnonzero(complete)
+        incomplete = np.flatnonzero(~complete)
+        self.missing_patterns = []
+        if len(incomplete) > 0:
+            patterns, inverse = np.unique(observed[incomplete], axis=0, return_inverse=True)
+            order, starts, ends = label_runs(inverse)
+            self.missing_patterns = [(patterns[inverse[order[start]]], incomplete[order[start:end]]) for start, end in zip(starts, ends)]
+        
+        # initialize a gene x slot matrix to keep track of logpdf of MVN by cluster by gene.
+        # Every slot carries a parameter version; a cached column is valid only if it was
+        # computed under the current version of its slot, so that changing the parameters
+        # of a cluster invalidates its whole column by incrementing the version.
+        self.LL_cache = np.zeros((self.n_genes, 0))
+        self.LL_column_version = np.zeros(0, dtype=np.int32)
+        self.cluster_version = np.zeros(0, dtype=np.int32)
+        
+        # likewise, cache the marginal log-likelihood of each cluster's GP model by slot
+        self.log_marginal_cache = np.zeros(0)
+        self.log_marginal_version = np.zeros(0, dtype=np.int32)
+        
+        # initialize the cluster table. Every cluster occupies a slot, and cluster IDs are slot
+        # indices. Slots 0 to m-1 are reserved for the empty (auxiliary) clusters, freed slots are
+        # re-used lowest first so that IDs stay dense. Per slot, the table keeps the dp_cluster
+        # object, the cluster size and, stacked for batched likelihood calculations, the
+        # mean, factor, rank and log pseudo-determinant.
+        T = gene_expression_matrix.shape[1]
+        self.clusters = []
+        self.cluster_sizes = np.zeros(0, dtype=np.intp)
+        self.occupied = np.zeros(0, dtype=bool)
+        self.cluster_means = np.zeros((0, T))
+        self.cluster_factors = np.zeros((0, T, T))
+        self.cluster_rank = np.zeros(0)
+        self.cluster_log_pdet = np.zeros(0)
+        self.cluster_triangular = np.zeros(0, dtype=bool)
+        self.free_slots = []
+        self.active = None
+        # slots of the auxiliary clusters, more are added in chunks as clusters are born
+        self.grow_cluster_table(self.m)
+        
+        # initialize a posterior similarity matrix (a backend that records sampled
+        # clusterings, see DP_GP.similarity), and the total counts of
+        # co-clustering with lower- and higher-indexed genes
         N = gene_expression_matrix.shape[0]
-        self.S = np.zeros((N, N))
+        self.S = similarity.similarity_backend(N, max_num_iterations // s + 1, sim_mat_backend, sim_mat_memory_budget)
+        self.S_before = np.zeros(N)
+        self.S_after = np.zeros(N)
         
-        # initialize a dict liking gene (key) to last cluster assignment (value)
-        self.last_cluster = {}
-        
-        # initialize cluster dict in which to keep all DP clusters
-        self.clusters = {}
+        # initialize an array linking gene (index) to last cluster assignment (value)
+        self.last_cluster = np.zeros(self.n_genes, dtype=np.intp)
         
         # initialize a list to keep track of log likelihoods
         self.log_likelihoods = []
         
+        # initialize cheap per-sample convergence statistics
+        self.streaming_diagnostics = streaming_diagnostics(self.n_genes, random_state=self.random_state)
+        
         # initialize a list to keep track of the
         # degree to which cluster sizes change over
         # iterations (for burn-in convergence)
         self.cluster_size_changes = []
         self.last_proportions = False
         
-        # initialize arrays to keep track of clusterings
-        self.sampled_clusterings = np.arange(self.n_genes)
-        self.all_clusterings = np.arange(self.n_genes)
+        # initialize traces to keep track of clusterings
+        if spill_path_prefix is None:
+            self.sampled_clusterings = clustering_trace(self.n_genes, len(self.clusters))
+            self.all_clusterings = clustering_trace(self.n_genes, len(self.clusters))
+        else:
+            self.sampled_clusterings = clustering_trace(self.n_genes, len(self.clusters), spill_path=spill_path_prefix + "_sampled_clusterings.bin")
+            self.all_clusterings = clustering_trace(self.n_genes, len(self.clusters), spill_path=spill_path_prefix + "_all_clusterings.bin")
+        
+        # initialize checkpointing
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint_every = checkpoint_every
+        self.checkpoint_iter = 0
+        self.resumed = False
+        self.terminate = False
         
     #############################################################################################
         
     def get_log_posterior(self):
-        '''Get log posterior distribution of the current clustering.'''
+        '''
+        Get log posterior distribution of the current clustering. The marginal log-likelihoods
+        of the clusters' GP models are cached by slot, and only re-evaluated for clusters
+        that were (re)placed or updated since they were last evaluated.
+        '''
+        
+        clusterIDs = np.flatnonzero(self.cluster_sizes > 0)
+        stale = clusterIDs[self.log_marginal_version[clusterIDs] != self.cluster_version[clusterIDs]]
+        for clusterID in stale:
+            self.log_marginal_cache[clusterID] = self.clusters[clusterID].model.log_likelihood()
+        self.log_marginal_version[stale] = self.cluster_version[stale]
         
-        prior = np.array([self.clusters[clusterID].size for clusterID in sorted(self.clusters) if self.clusters[clusterID].size > 0])
+        prior = self.cluster_sizes[clusterIDs]
         log_prior = np.log( prior / float(prior.sum()) )        
-        log_likelihood = np.array([self.clusters[clusterID].model.log_likelihood() for clusterID in sorted(self.clusters) if self.clusters[clusterID].size > 0 ])
-        return ( np.sum(log_prior + log_likelihood) )
+        return ( np.sum(log_prior + self.log_marginal_cache[clusterIDs]) )
     
     #############################################################################################
     
-    @cython.wraparound(False)
-    @cython.cdivision(True)
-    @cython.nonecheck(False)
-    def calculate_prior(self, int gene):
+    def grow_cluster_table(self, int capacity):
         '''
-        Implementation of Neal's algorithm 8 (DOI:10.1080/10618600.2000.10474879), 
-        according to the number of genes in each cluster, returns an array of prior 
-        probabilities sorted by cluster name.
+        Grow the cluster table to (at least) the given number of slots, in chunks, 
+        and add the new slots to the free-slot heap.
         
-        :param clusters: dictionary of dp_cluster objects
-        :type clusters: dict
-        :param last_cluster: dictionary linking gene with the most recent cluster to which gene belonged
-        :type last_cluster: dict
-        :param gene: gene index
-        :type gene: int
-        
-        :returns: normalized prior probabilities
-        :rtype: numpy array of floats
-        '''
-        
-        cdef double[:] prior = np.zeros(len(self.clusters))
-        cdef int index
-        cdef int clusterID
-        
-        # Check if the last cluster to which the gene belonged was a singleton.
-        singleton = True if self.clusters[self.last_cluster[gene]].size == 1 else False
-        
-        # If it was a singleton, adjust the number of Chinese Restaurant Process
-        # "empty tables" accordingly (e.g. +1).
-        if singleton:
-            for index, clusterID in enumerate(sorted(self.clusters)):
-                if (self.last_cluster[gene] == clusterID): # if gene last belonged to the cluster under consideration
-                    prior[index] =  self.alpha / ( self.m + 1 )
-                else:
-                    if (self.clusters[clusterID].size == 0):
-                        prior[index] =  self.alpha / ( self.m + 1 ) 
-                    else:
-                        prior[index] = float( self.clusters[clusterID].size )
-        else:
-            for index, clusterID in enumerate(sorted(self.clusters)):
-                if (self.last_cluster[gene] == clusterID): # if gene last belonged to the cluster under consideration
-                    prior[index] = float( self.clusters[clusterID].size - 1 )
-                else:
-                    if (self.clusters[clusterID].size == 0):
-                        prior[index] =  self.alpha / self.m 
-                    else:
-                        prior[index] = float( self.clusters[clusterID].size )
-        
-        prior_normed = prior / np.sum(prior)
-        return prior_normed
-        
-    @cython.wraparound(False)
-    @cython.cdivision(True)
-    @cython.nonecheck(False)
-    def calculate_likelihood_MVN_by_dict(self, int gene):
+        :param capacity: minimum number of slots
+        :type capacity: int
         '''
-        Compute likelihood of gene belonging to each cluster (sorted by cluster name) according
-        to the multivariate normal distribution.
-        
-        :param clusters: dictionary of dp_cluster objects
-        :type clusters: dict
-        :param last_cluster: dictionary linking gene index with the most recent cluster to which gene belonged
-        :type last_cluster: dict
-        :param gene: gene index
-        :type gene: int
-        
-        :returns: normalized likelihood probabilities
-        :rtype: numpy array of floats
+        cdef int old_capacity = len(self.clusters)
+        cdef int T = self.cluster_means.shape[1]
+        if capacity <= old_capacity:
+            return
+        capacity = max(capacity, old_capacity + _SLOT_CHUNK)
+        added = capacity - old_capacity
+        
+        self.clusters.extend([None] * added)
+        self.cluster_sizes = np.concatenate((self.cluster_sizes, np.zeros(added, dtype=np.intp)))
+        self.occupied = np.concatenate((self.occupied, np.zeros(added, dtype=bool)))
+        self.cluster_means = np.vstack((self.cluster_means, np.zeros((added, T))))
+        self.cluster_factors = np.concatenate((self.cluster_factors, np.zeros((added, T, T))))
+        self.cluster_rank = np.concatenate((self.cluster_rank, np.zeros(added)))
+        self.cluster_log_pdet = np.concatenate((self.cluster_log_pdet, np.zeros(added)))
+        self.cluster_triangular = np.concatenate((self.cluster_triangular, np.zeros(added, dtype=bool)))
+        self.cluster_version = np.concatenate((self.cluster_version, np.ones(added, dtype=np.int32)))
+        self.LL_cache = np.hstack((self.LL_cache, np.zeros((self.n_genes, added))))
+        self.LL_column_version = np.concatenate((self.LL_column_version, np.zeros(added, dtype=np.int32)))
+        self.log_marginal_cache = np.concatenate((self.log_marginal_cache, np.zeros(added)))
+        self.log_marginal_version = np.concatenate((self.log_marginal_version, np.zeros(added, dtype=np.int32)))
+        for slot in range(old_capacity, capacity):
+            if slot >= self.m:
+                heapq.heappush(self.free_slots, slot)
+    
+    def shrink_cluster_table(self):
         '''
+        Compact the cluster table and release its free slots in whole chunks, keeping one
+        chunk of free slots, e.g. once the one-gene clusters of the first sweep have merged.
+        Clusters in slots beyond the number of occupied slots are moved, together with their
+        cached log-likelihoods, to the lowest free slots, and genes are relabelled accordingly.
+        '''
+        occupied = np.flatnonzero(self.occupied)
+        cdef int n_occupied = max(self.m, len(occupied))
+        cdef int capacity = n_occupied + _SLOT_CHUNK
+        if len(self.clusters) - capacity < _SLOT_CHUNK:
+            return
+        
+        moved = occupied[occupied >= n_occupied]
+        slots = np.flatnonzero(~self.occupied[:n_occupied])
+        for clusterID, slot in zip(moved, slots):
+            self.clusters[slot] = self.clusters[clusterID]
+        for values in [self.cluster_sizes, self.occupied, self.cluster_means, self.cluster_factors, self.cluster_rank, self.cluster_log_pdet, 
+                       self.cluster_triangular, self.cluster_version, self.LL_column_version, self.log_marginal_cache, self.log_marginal_version]:
+            values[slots] = values[moved]
+        self.LL_cache[:,slots] = self.LL_cache[:,moved]
+        
+        relabel = np.arange(len(self.clusters))
+        relabel[moved] = slots
+        self.last_cluster = relabel[self.last_cluster]
+        self.streaming_diagnostics.relabel(relabel)
+        if self.last_proportions is not False:
+            self.last_proportions = {int(relabel[n]):proportion for n, proportion in self.last_proportions.iteritems()}
+        
+        del self.clusters[capacity:]
+        self.cluster_sizes = self.cluster_sizes[:capacity].copy()
+        self.occupied = self.occupied[:capacity].copy()
+        self.occupied[n_occupied:] = False
+        self.cluster_means = self.cluster_means[:capacity].copy()
+        self.cluster_factors = self.cluster_factors[:capacity].copy()
+        self.cluster_rank = self.cluster_rank[:capacity].copy()
+        self.cluster_log_pdet = self.cluster_log_pdet[:capacity].copy()
+        self.cluster_triangular = self.cluster_triangular[:capacity].copy()
+        self.cluster_version = self.cluster_version[:capacity].copy()
+        self.LL_cache = self.LL_cache[:,:capacity].copy()
+        self.LL_column_version = self.LL_column_version[:capacity].copy()
+        self.log_marginal_cache = self.log_marginal_cache[:capacity].copy()
+        self.log_marginal_version = self.log_marginal_version[:capacity].copy()
+        for clusterID in range(n_occupied, capacity):
+            self.clusters[clusterID] = None
+            self.cluster_sizes[clusterID] = 0
+        self.free_slots = range(n_occupied, capacity)
+        self.active = None
+    
+    def new_slot(self):
+        '''Take the lowest free slot of the cluster table, growing the table if none is left.'''
+        if not self.free_slots:
+            self.grow_cluster_table(len(self.clusters) + 1)
+        return heapq.heappop(self.free_slots)
+    
+    def set_cluster(self, int clusterID, cluster, int size):
+        '''
+        Place a dp_cluster object in a slot of the cluster table and stack its mean, 
+        factor, rank and log pseudo-determinant for batched likelihood calculations.
+        
+        :param clusterID: slot of cluster table
+        :type clusterID: int
+        :param cluster: cluster to be placed in slot
+        :type cluster: dp_cluster
+        :param size: number of genes in cluster
+        :type size: int
+        '''
+        if not self.occupied[clusterID]:
+            self.occupied[clusterID] = True
+            self.active = None
+        self.clusters[clusterID] = cluster
+        self.cluster_sizes[clusterID] = size
+        self.stack_cluster(clusterID)
+    
+    def stack_cluster(self, int clusterID):
+        '''
+        Copy the mean, factor, rank and log pseudo-determinant of a cluster into
+        the stacked (cluster x T and cluster x T x T) arrays of the cluster table, and
+        invalidate the cached log-likelihoods of the slot by incrementing its version.
         
-        cdef double[:] lik = np.zeros(len(self.clusters))
-        cdef int index
-        cdef int clusterID
-        
-        # Check if the last cluster to which the gene belonged was a singleton.
-        singleton = True if self.clusters[self.last_cluster[gene]].size == 1 else False
+        :param clusterID: cluster to be stacked
+        :type clusterID: int
+        '''
+        cluster = self.clusters[clusterID]
+        self.cluster_means[clusterID] = cluster.mean
+        self.cluster_factors[clusterID] = cluster.factor
+        self.cluster_rank[clusterID] = cluster.rank
+        self.cluster_log_pdet[clusterID] = cluster.log_pdet
+        self.cluster_triangular[clusterID] = cluster.triangular
+        self.cluster_version[clusterID] += 1
+    
+    def free_slot(self, int clusterID):
+        '''Remove an emptied cluster from the cluster table and return its slot to the free-slot heap.'''
+        self.clusters[clusterID] = None
+        self.occupied[clusterID] = False
+        self.active = None
+        heapq.heappush(self.free_slots, clusterID)
+    
+    def active_clusters(self):
+        '''
+        Return the IDs (slots) of all clusters, including empty clusters, in ascending order.
+        The array is cached until a cluster is created or removed.
+        '''
+        if self.active is None:
+            self.active = np.flatnonzero(self.occupied)
+        return self.active
+    
+    def members_by_cluster(self):
+        '''
+        Split gene indices by cluster assignment in one pass over the assignment array.
         
-        # expression of gene tested
-        expression_vector = self.gene_expression_matrix[gene,:]
+        :returns: dictionary linking cluster ID (key) to sorted array of member gene indices (value)
+        :rtype: dict
+        '''
+        order, starts, ends = label_runs(self.last_cluster)
+        return {self.last_cluster[order[start]]:order[start:end] for start, end in zip(starts, ends)}
+    
+    #############################################################################################
+    
+    def cache_log_likelihoods(self, clusterIDs):
+        '''
+        Compute the log-likelihoods of all genes under the given clusters at once and 
+        store them to the gene x slot cache (see log_likelihood_matrix). Genes with missing
+        data are scored per pattern of observed time points, all genes of a pattern at once,
+        under the mean and covariance sub-matrix of the observed time points, i.e. 
+        marginalizing over the missing time points. The factors of the sub-matrices are
+        cached by each cluster per pattern (see dp_cluster.marginal_factors).
+        
+        :param clusterIDs: clusters whose columns of the cache are (re)computed
+        :type clusterIDs: numpy array of ints
+        '''
+        genes = self.complete_genes
+        if len(genes) > 0:
+            self.LL_cache[np.ix_(genes, clusterIDs)] = log_likelihood_matrix(self.gene_expression_matrix[genes], self.cluster_means[clusterIDs], self.cluster_factors[clusterIDs],
+                                                                             self.cluster_triangular[clusterIDs], self.cluster_rank[clusterIDs], self.cluster_log_pdet[clusterIDs])
+        for observed, genes in self.missing_patterns:
+            if not observed.any():
+                self.LL_cache[np.ix_(genes, clusterIDs)] = 0
+                continue
+            rank, factors, log_pdet, triangular = [np.array(values) for values in zip(*[self.clusters[clusterID].marginal_factors(observed) for clusterID in clusterIDs])]
+            self.LL_cache[np.ix_(genes, clusterIDs)] = log_likelihood_matrix(self.gene_expression_matrix[np.ix_(genes, observed)], self.cluster_means[np.ix_(clusterIDs, observed)],
+                                                                             factors, triangular, rank, log_pdet)
+        self.LL_column_version[clusterIDs] = self.cluster_version[clusterIDs]
+    
+    def cache_stale_log_likelihoods(self):
+        '''
+        Recompute the columns of the gene x slot cache of the active clusters that 
+        were (re)placed or updated since they were last computed.
+        '''
+        clusterIDs = self.active_clusters()
+        stale = clusterIDs[self.LL_column_version[clusterIDs] != self.cluster_version[clusterIDs]]
+        if len(stale) > 0:
+            self.cache_log_likelihoods(stale)
+    
+    #############################################################################################
+    
+    def cluster_stats(self, genes):
+        '''
+        Number, sum and sum of squares of the observed expression of genes at each time point,
+        the sufficient statistics of the GP marginal likelihood of a cluster (see gp.stats_log_likelihood).
         
-        for index, clusterID in enumerate(sorted(self.clusters)):
-            
-            if clusterID in self.last_MVN_by_cluster_by_gene and gene in self.last_MVN_by_cluster_by_gene[clusterID]:
-                lik[index] = self.last_MVN_by_cluster_by_gene[clusterID][gene]
-            else:
-#                 print expression_vector.shape,
-                non_nan = ~np.isnan(expression_vector)
-#                 print non_nan,
-                non_nan_idx = np.arange(len(expression_vector))[non_nan]
-#                 print non_nan_idx,
-#                 lik[index] = -0.5 * (self.clusters[clusterID].rank * _LOG_2PI + self.clusters[clusterID].log_pdet + \
-#                                      np.sum(np.square(np.dot(expression_vector[non_nan] - \
-#                                                              self.clusters[clusterID].mean[non_nan], 
-#                                                              self.clusters[clusterID].U[non_nan_idx].T[non_nan_idx]))))
-#                 print "self.clusters[clusterID].rank", self.clusters[clusterID].rank
-#                 print "self.clusters[clusterID].U.shape", self.clusters[clusterID].U.shape
-#                 print "expression_vector", expression_vector
-#                 print "self.clusters[clusterID].mean", self.clusters[clusterID].mean
-                lik[index] = -0.5 * (self.clusters[clusterID].rank * _LOG_2PI + self.clusters[clusterID].log_pdet + \
-                                     np.sum(np.square(np.dot(expression_vector - self.clusters[clusterID].mean, self.clusters[clusterID].U))))
-       
-        # scale the log-likelihoods down by subtracting (one less than) the largest log-likelihood
-        # (which is equivalent to dividing by the largest likelihood), to avoid
-        # underflow issues when normalizing to [0-1] interval.
-        lik_scaled_down = np.exp(lik - (np.nanmax(lik)-1))
-        lik_normed = lik_scaled_down/np.sum(lik_scaled_down)
-        return lik_normed, lik
+        :param genes: gene indices
+        :type genes: numpy array of ints
         
+        :rtype: tuple of numpy arrays of length T
+        '''
+        expression = self.observed_expression[genes]
+        return self.observed[genes].sum(axis=0), expression.sum(axis=0), np.square(expression).sum(axis=0)
+    
+    def sequential_allocation(self, int i, int j, genes, K, double noise_variance, sides=None):
+        '''
+        Allocate genes one by one, in random order, to the side of gene i or of gene j,
+        with probability proportional to the number of genes of that side times the GP predictive
+        likelihood of the gene given them (sequentially-allocated split proposal of Dahl, 2003). 
+        If sides are given, the given allocation is followed and only its probability computed.
+        
+        :param i, j: anchor genes of the two sides
+        :type i, j: int
+        :param genes: genes to allocate, excluding i and j
+        :type genes: numpy array of ints
+        :param K: covariance matrix of the GP at the time points
+        :type K: numpy array of dimension T by T
+        :param noise_variance: Gaussian noise variance of the GP
+        :type noise_variance: float
+        :param sides: 0 (side of i) or 1 (side of j) of each gene, or None to sample the allocation
+        :type sides: numpy array of ints
+        
+        :returns: (sides, log_q, LL): allocation, its log-probability and the GP marginal 
+                  log-likelihoods of the two sides
+        :rtype: tuple
+        '''
+        # statistics of the two sides, stacked
+        counts, sums, sum_squares = [np.vstack(side_stats) for side_stats in zip(self.cluster_stats([i]), self.cluster_stats([j]))]
+        LL = gp.stats_log_likelihood(K, noise_variance, counts, sums, sum_squares)
+        sizes = np.ones(2)
+        allocation = np.zeros(len(genes), dtype=int) if sides is None else sides
+        cdef double log_q = 0.
+        for k in self.random_state.permutation(len(genes)):
+            observed, expression = self.observed[genes[k]], self.observed_expression[genes[k]]
+            new_counts, new_sums, new_sum_squares = counts + observed, sums + expression, sum_squares + np.square(expression)
+            new_LL = gp.stats_log_likelihood(K, noise_variance, new_counts, new_sums, new_sum_squares)
+            log_p = np.log(sizes) + new_LL - LL
+            log_p -= np.logaddexp(log_p[0], log_p[1])
+            if sides is None:
+                allocation[k] = np.log(self.random_state.uniform()) < log_p[1]
+            side = allocation[k]
+            log_q += log_p[side]
+            counts[side], sums[side], sum_squares[side], LL[side] = new_counts[side], new_sums[side], new_sum_squares[side], new_LL[side]
+            sizes[side] += 1
+        return allocation, log_q, LL
+    
+    def split_merge_move(self):
+        '''
+        Metropolis-Hastings split-merge move (Jain & Neal, DOI:10.1198/1061860043001), with 
+        sequentially-allocated split proposals (Dahl, 2003). Two genes are chosen at random. If they
+        belong to the same cluster, a split of that cluster separating them is proposed, otherwise
+        the merge of their clusters. Clusterings are compared by their Chinese Restaurant Process 
+        prior and the GP marginal likelihoods of the affected clusters, at the hyperparameters of 
+        the cluster to be split, or of the larger of the clusters to be merged (of the lower slot 
+        if of equal size), whichever gene was chosen first. The clusters resulting from an accepted
+        move are conditioned on their members at these hyperparameters, so that the reverse move 
+        is evaluated at the same hyperparameters.
+        
+        The move is a heuristic to escape the local modes of one-gene-at-a-time sampling: only at 
+        fixed hyperparameters shared by all clusters does it leave the posterior of clusterings 
+        invariant. Gibbs sweeps score genes by the predictive distribution of each cluster 
+        instead of by the marginal likelihood of its members (see cache_log_likelihoods), and 
+        hyperparameters are re-optimized at the next sample.
+        
+        :returns: whether the move was accepted
+        :rtype: bool
+        '''
+        i, j = self.random_state.choice(self.n_genes, 2, replace=False)
+        cluster_i, cluster_j = self.last_cluster[i], self.last_cluster[j]
+        if (self.cluster_sizes[cluster_j], -cluster_j) > (self.cluster_sizes[cluster_i], -cluster_i):
+            parameters = gp.kernel_parameters(self.clusters[cluster_j].model)
+        else:
+            parameters = gp.kernel_parameters(self.clusters[cluster_i].model)
+        K = gp.rbf_linear_bias(*parameters[:4]).K(self.X)
+        noise_variance = parameters[4]
+        
+        if cluster_i == cluster_j:
+            members = np.flatnonzero(self.last_cluster == cluster_i)
+            genes = members[(members != i) & (members != j)]
+            sides, log_q, LL = self.sequential_allocation(i, j, genes, K, noise_variance)
+            moved = np.r_[j, genes[sides == 1]]
+        else:
+            members_i = np.flatnonzero(self.last_cluster == cluster_i)
+            members_j = np.flatnonzero(self.last_cluster == cluster_j)
+            members = np.r_[members_i, members_j]
+            genes = np.r_[members_i[members_i != i], members_j[members_j != j]]
+            sides = np.r_[np.zeros(len(members_i) - 1, dtype=int), np.ones(len(members_j) - 1, dtype=int)]
+            sides, log_q, LL = self.sequential_allocation(i, j, genes, K, noise_variance, sides)
+            moved = members_j
+        
+        # log of (split clustering / merged clustering) posterior, and of the split proposal
+        n_j = len(moved)
+        n_i = len(members) - n_j
+        LL_merged = gp.stats_log_likelihood(K, noise_variance, *self.cluster_stats(members))
+        log_ratio = np.log(self.alpha) + gammaln(n_i) + gammaln(n_j) - gammaln(n_i + n_j) + LL[0] + LL[1] - LL_merged
+        
+        if cluster_i == cluster_j:
+            self.n_splits_proposed += 1
+            if np.log(self.random_state.uniform()) < log_ratio - log_q:
+                self.n_splits_accepted += 1
+                self.split_cluster(cluster_i, moved, parameters)
+                return True
+        else:
+            self.n_merges_proposed += 1
+            if np.log(self.random_state.uniform()) < log_q - log_ratio:
+                self.n_merges_accepted += 1
+                self.merge_clusters(cluster_i, cluster_j, parameters)
+                return True
+        return False
+    
+    def split_cluster(self, int clusterID, moved, parameters):
+        '''
+        Move genes of a cluster to a new cluster in the lowest free slot, and condition
+        both clusters on their members at the given hyperparameters (see dp_cluster.condition).
+        
+        :param clusterID: cluster to be split
+        :type clusterID: int
+        :param moved: genes to be moved to the new cluster
+        :type moved: numpy array of ints
+        :param parameters: hyperparameters (see gp.kernel_parameters)
+        :type parameters: numpy array of floats
+        '''
+        new_cluster = dp_cluster(members=list(moved), 
+                                 sigma_n=self.sigma_n_init, 
+                                 X=self.X, 
+                                 Y=self.gene_expression_matrix[moved,:].T, 
+                                 iter_num_at_birth=self.iter_num,
+                                 fast=self.fast, 
+                                 factorization=self.factorization,
+                                 gp_backend=self.gp_backend)
+        new_cluster.condition(self.gene_expression_matrix[moved,:], parameters)
+        new_clusterID = self.new_slot()
+        self.set_cluster(new_clusterID, new_cluster, len(moved))
+        self.last_cluster[moved] = new_clusterID
+        self.cluster_sizes[clusterID] -= len(moved)
+        self.condition_cluster(clusterID, parameters)
+    
+    def merge_clusters(self, int clusterID, int other_clusterID, parameters):
+        '''
+        Move all genes of other_clusterID to clusterID, remove other_clusterID and condition
+        clusterID on its members at the given hyperparameters (see dp_cluster.condition).
+        '''
+        self.last_cluster[self.last_cluster == other_clusterID] = clusterID
+        self.cluster_sizes[clusterID] += self.cluster_sizes[other_clusterID]
+        self.cluster_sizes[other_clusterID] = 0
+        self.free_slot(other_clusterID)
+        self.condition_cluster(clusterID, parameters)
+    
+    def condition_cluster(self, int clusterID, parameters):
+        '''Condition a cluster on its current members at the given hyperparameters and re-stack it.'''
+        cluster = self.clusters[clusterID]
+        cluster.members = list(np.flatnonzero(self.last_cluster == clusterID))
+        cluster.size = len(cluster.members)
+        cluster.condition(self.gene_expression_matrix[cluster.members,:], parameters)
+        self.stack_cluster(clusterID)
+    
     #############################################################################################
     
     def sample(self):
@@ -659,42 +1592,36 @@ cdef class gibbs_sampler(object):
     
     def update_S_matrix(self):
         '''
-        The S matrix, or the posterior similarity matrix, keeps a running average of gene-by-gene
-        co-occurence such that S[i,j] = (# samples gene i in same cluster as gene g)/(# samples total).
-        Because of the symmetric nature of this matrix, only the lower triangle is updated and maintained.
+        The S matrix, or the posterior similarity matrix, keeps gene-by-gene co-occurence counts
+        such that S[i,j]/(# samples total) = (# samples gene i in same cluster as gene g)/(# samples total).
+        The current cluster labels are recorded by the posterior similarity matrix backend.
         
         This matrix may be used as a check for convergence. To this end, return the squared distance
-        between the current clustering and the posterior similarity matrix.
+        between the current clustering and the posterior similarity matrix, i.e. the sum of the 
+        matrix product of the difference of their lower triangles with itself. Because this
+        only depends on row and column sums of the difference, it is computed from
+        per-gene totals of co-clustering with lower- and higher-indexed genes.
         
-        :param S: posterior similarity matrix
-        :type S: numpy array of dimension N by N where N=number of genes
-        :param last_cluster: dictionary linking gene with the most recent cluster to which gene belonged
-        :type last_cluster: dict
-        :param num_samples_taken: number of samples
-        :type num_samples_taken: int
-        
-        :returns: (S, sq_dist)
-            S: posterior similarity matrix
-            :type S: numpy array of dimension N by N where N=number of genes
-            sq_dist: squared distance between posterior similarity matrix and current clustering
-            :type sq_dist: float
+        :returns: sq_dist: squared distance between posterior similarity matrix and current clustering
+        :rtype: float
         
         '''
-        genes1, genes2 = np.tril_indices(len(self.S), k = -1)
-        S_new = np.zeros_like(self.S)
-        
-        for gene1, gene2 in zip(genes1, genes2):
-            
-            if self.last_cluster[gene1] == self.last_cluster[gene2]:
-                S_new[gene1, gene2] += 1.0
-            else:
-                pass
+        order, starts, ends = label_runs(self.last_cluster)
+        before, after = co_clustered_before_and_after(order, starts, ends)
         
-        sq_dist = squared_dist_two_matrices(self.S, S_new)
+        if self.num_samples_taken > 1:
+            previous_samples = float(self.num_samples_taken - 1)
+            row_sums = self.S_before / previous_samples - before
+            col_sums = self.S_after / previous_samples - after
+        else:
+            row_sums, col_sums = -before, -after
+        sq_dist = np.dot(row_sums, col_sums)
         
-        S = ((self.S * (self.num_samples_taken - 1.0)) + S_new) / float(self.num_samples_taken)
+        self.S.add(self.last_cluster, runs=(order, starts, ends))
+        self.S_before += before
+        self.S_after += after
         
-        return(S, sq_dist)
+        return(sq_dist)
     
     #############################################################################################
     
@@ -742,22 +1669,194 @@ cdef class gibbs_sampler(object):
     
     #############################################################################################
     
+    def get_state(self):
+        '''
+        Collect the complete state of the sampler between two iterations: cluster assignments,
+        the cluster table (including each cluster's GP model and hyperparameters), the posterior
+        similarity matrix, sampled/all clusterings, log likelihoods, burn-in phase boundaries,
+        convergence variables and the state of the random number generator. The log-likelihood
+        caches are not included, they are rebuilt on demand.
+        
+        :returns: state
+        :rtype: dict
+        '''
+        return {'n_genes':self.n_genes,
+                'iter_num':self.iter_num,
+                'num_samples_taken':self.num_samples_taken,
+                'burnIn_phaseI':self.burnIn_phaseI,
+                'burnIn_phaseII':self.burnIn_phaseII,
+                'min_sq_dist_counter':self.min_sq_dist_counter,
+                'post_counter':self.post_counter,
+                'min_sq_dist':self.min_sq_dist,
+                'prev_sq_dist':self.prev_sq_dist,
+                'current_sq_dist':self.current_sq_dist,
+                'max_post':self.max_post,
+                'current_post':self.current_post,
+                'prev_post':self.prev_post,
+                'converged':self.converged,
+                'converged_by_sq_dist':self.converged_by_sq_dist,
+                'converged_by_likelihood':self.converged_by_likelihood,
+                'last_cluster':self.last_cluster,
+                'clusters':self.clusters,
+                'cluster_sizes':self.cluster_sizes,
+                'occupied':self.occupied,
+                'cluster_means':self.cluster_means,
+                'cluster_factors':self.cluster_factors,
+                'cluster_rank':self.cluster_rank,
+                'cluster_log_pdet':self.cluster_log_pdet,
+                'cluster_triangular':self.cluster_triangular,
+                'cluster_version':self.cluster_version,
+                'free_slots':self.free_slots,
+                'S':self.S,
+                'S_before':self.S_before,
+                'S_after':self.S_after,
+                'log_likelihoods':self.log_likelihoods,
+                'streaming_diagnostics':self.streaming_diagnostics,
+                'cluster_size_changes':self.cluster_size_changes,
+                'last_proportions':self.last_proportions,
+                'sampled_clusterings':self.sampled_clusterings,
+                'all_clusterings':self.all_clusterings,
+                'refits':(self.n_refits, self.n_refits_skipped, self.refit_seconds),
+                'split_merge':(self.n_splits_proposed, self.n_splits_accepted, self.n_merges_proposed, self.n_merges_accepted),
+                'random_state':self.random_state.get_state()}
+    
+    def set_state(self, state):
+        '''
+        Restore a state collected by get_state, so that sampler() continues the same chain.
+        
+        :param state: state of a sampler of the same genes
+        :type state: dict
+        '''
+        if state['n_genes'] != self.n_genes:
+            raise ValueError("checkpoint is of %s genes, not %s"%(state['n_genes'], self.n_genes))
+        
+        self.iter_num = state['iter_num']
+        self.num_samples_taken = state['num_samples_taken']
+        self.burnIn_phaseI = state['burnIn_phaseI']
+        self.burnIn_phaseII = state['burnIn_phaseII']
+        self.min_sq_dist_counter = state['min_sq_dist_counter']
+        self.post_counter = state['post_counter']
+        self.min_sq_dist = state['min_sq_dist']
+        self.prev_sq_dist = state['prev_sq_dist']
+        self.current_sq_dist = state['current_sq_dist']
+        self.max_post = state['max_post']
+        self.current_post = state['current_post']
+        self.prev_post = state['prev_post']
+        self.converged = state['converged']
+        self.converged_by_sq_dist = state['converged_by_sq_dist']
+        self.converged_by_likelihood = state['converged_by_likelihood']
+        self.last_cluster = state['last_cluster']
+        
+        self.clusters = state['clusters']
+        self.cluster_sizes = state['cluster_sizes']
+        self.occupied = state['occupied']
+        self.cluster_means = state['cluster_means']
+        self.cluster_factors = state['cluster_factors']
+        self.cluster_rank = state['cluster_rank']
+        self.cluster_log_pdet = state['cluster_log_pdet']
+        self.cluster_triangular = state['cluster_triangular']
+        self.cluster_version = state['cluster_version']
+        self.free_slots = state['free_slots']
+        self.active = None
+        # versions start at one, so that an empty cache is invalid for all slots
+        self.LL_cache = np.zeros((self.n_genes, len(self.clusters)))
+        self.LL_column_version = np.zeros(len(self.clusters), dtype=np.int32)
+        self.log_marginal_cache = np.zeros(len(self.clusters))
+        self.log_marginal_version = np.zeros(len(self.clusters), dtype=np.int32)
+        
+        self.S = state['S']
+        self.S_before = state['S_before']
+        self.S_after = state['S_after']
+        self.log_likelihoods = state['log_likelihoods']
+        if 'streaming_diagnostics' in state:
+            self.streaming_diagnostics = state['streaming_diagnostics']
+        self.cluster_size_changes = state['cluster_size_changes']
+        self.last_proportions = state['last_proportions']
+        self.sampled_clusterings = state['sampled_clusterings']
+        self.all_clusterings = state['all_clusterings']
+        self.n_refits, self.n_refits_skipped, self.refit_seconds = state['refits']
+        self.n_splits_proposed, self.n_splits_accepted, self.n_merges_proposed, self.n_merges_accepted = state.get('split_merge', (0, 0, 0, 0))
+        self.random_state.set_state(state['random_state'])
+        
+        self.checkpoint_iter = self.iter_num
+        self.resumed = True
+    
+    def save_checkpoint(self):
+        '''
+        Write the sampler state to checkpoint_path. The state is written to a temporary
+        file first and then renamed, so that a checkpoint is never left half-written.
+        '''
+        tmp_path = self.checkpoint_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            with utils.suppress_stdout_stderr():
+                pickle.dump(self.get_state(), f, pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, self.checkpoint_path)
+        self.checkpoint_iter = self.iter_num
+        print 'Checkpoint written at iteration %s: %s'%(self.iter_num, self.checkpoint_path)
+    
+    def load_checkpoint(self, checkpoint_path=None):
+        '''
+        Restore the sampler state from a checkpoint, by default from checkpoint_path.
+        
+        :param checkpoint_path: checkpoint file
+        :type checkpoint_path: str
+        '''
+        if checkpoint_path is None:
+            checkpoint_path = self.checkpoint_path
+        with open(checkpoint_path, 'rb') as f:
+            with utils.suppress_stdout_stderr():
+                state = pickle.load(f)
+        self.set_state(state)
+        print 'Resuming Gibbs sampling at iteration %s from %s'%(self.iter_num, checkpoint_path)
+    
+    def request_termination(self, signum, frame):
+        '''Signal handler: write a final checkpoint and raise SamplingTerminated after the current iteration.'''
+        self.terminate = True
+    
+    #############################################################################################
+    
     def sampler(self):
         
 #         import warnings
 #         warnings.simplefilter("error")
         
-        print 'Initializing one-gene clusters...'
         cdef int i, gene
-        for i in range(self.n_genes):
-            self.clusters[self.m + i] = dp_cluster(members=[i], sigma_n=self.sigma_n_init, \
-                                                   X=self.X, Y=np.array(np.mat(self.gene_expression_matrix[i,:])).T, \
-                                                   iter_num_at_birth=self.iter_num, 
-                                                   fast=self.fast) # cluster members, D.O.B.
-            self.last_cluster[i] = self.m + i
-            
+        if not self.resumed:
+            print 'Initializing one-gene clusters...'
+            # one slot per gene, added at once rather than chunk by chunk
+            self.grow_cluster_table(self.m + self.n_genes)
+            for i in range(self.n_genes):
+                clusterID = self.new_slot()
+                self.set_cluster(clusterID, dp_cluster(members=[i], sigma_n=self.sigma_n_init, \
+                                                       X=self.X, Y=np.array(np.mat(self.gene_expression_matrix[i,:])).T, \
+                                                       iter_num_at_birth=self.iter_num, 
+                                                       fast=self.fast, factorization=self.factorization, gp_backend=self.gp_backend), 1) # cluster members, D.O.B.
+                self.last_cluster[i] = clusterID
+        
+        # on SIGTERM, checkpoint at the end of the current iteration
+        previous_handler = None
+        if self.checkpoint_path is not None:
+            try:
+                previous_handler = signal.signal(signal.SIGTERM, self.request_termination)
+            except ValueError: # not in main thread
+                pass
+        
+        executor = executors.executor(self.fit_executor, self.fit_processes)
+        
         while (not self.converged) and (self.iter_num < self.max_num_iterations):
-                        
+            
+            if self.checkpoint_path is not None and self.iter_num != self.checkpoint_iter and \
+               (self.terminate or (self.checkpoint_every > 0 and self.iter_num % self.checkpoint_every == 0)):
+                self.save_checkpoint()
+            if self.terminate:
+                print 'Received SIGTERM, terminating Gibbs sampling at iteration %s.'%(self.iter_num)
+                executor.close()
+                if previous_handler is not None:
+                    signal.signal(signal.SIGTERM, previous_handler)
+                raise SamplingTerminated('terminated on SIGTERM at iteration %s, checkpoint written to %s'%(self.iter_num, self.checkpoint_path))
+            
             self.iter_num += 1
             
             # keep user updated on clustering progress:
@@ -769,64 +1868,70 @@ cdef class gibbs_sampler(object):
                 print 'Past burn-in phase II, start taking samples...'
             
             # at every iteration create empty clusters to ensure new mean trajectories
-            for i in range(0, self.m):
-                self.clusters[i] = dp_cluster(members=[], sigma_n=self.sigma_n_init, X=self.X, iter_num_at_birth=self.iter_num)
-                if i in self.last_MVN_by_cluster_by_gene:
-                    del self.last_MVN_by_cluster_by_gene[i]
+            for i, mean in enumerate(self.aux_prior.draw_means(self.m, self.random_state)):
+                self.set_cluster(i, auxiliary_cluster(self.aux_prior, mean, iter_num_at_birth=self.iter_num), 0)
+            
+            print 'Sizes of clusters =', list(self.cluster_sizes[self.active_clusters()])
+            
+            # cluster parameters only change between sweeps, so score all genes against
+            # all clusters up front, leaving only clusters born during the sweep to score
+            self.cache_stale_log_likelihoods()
+            uniforms = self.random_state.random_sample(self.n_genes)
             
-            print 'Sizes of clusters =', [c.size for c in self.clusters.values()]
             for i in range(self.n_genes):
                 gene = i
                 
-                prior = self.calculate_prior(gene)
-                lik, LL = self.calculate_likelihood_MVN_by_dict(gene)
-                
-                # lik is array of normalized likelihoods
-                # LL is array of log-likelihoods
-                for clusterID, likelihood in zip(sorted(self.clusters), LL):
-                    self.last_MVN_by_cluster_by_gene[clusterID][gene] = likelihood
-                
-                post = prior * lik
-                post = post/sum(post)
-                
-                cluster_chosen_index = np.where(np.random.multinomial(1, post, size=1).flatten() == 1)[0][0]
-                cluster_chosen = sorted(self.clusters)[cluster_chosen_index]            
+                cluster_chosen_index = sample_assignment(self.LL_cache[gene], self.cluster_sizes, self.active_clusters(), 
+                                                         self.last_cluster[gene], self.alpha, self.m, uniforms[i])
+                cluster_chosen = self.active_clusters()[cluster_chosen_index]
                 prev_cluster = self.last_cluster[gene]
                 
                 if (prev_cluster != cluster_chosen): # if a new cluster chosen:
                     
-                    if (self.clusters[cluster_chosen].size == 0):
+                    if (self.cluster_sizes[cluster_chosen] == 0):
                         
-                        # create a new cluster
-                        cluster_chosen = max(self.clusters.keys()) + 1
-                        self.clusters[cluster_chosen] = dp_cluster(members=[gene], 
-                                                                   sigma_n=self.sigma_n_init, 
-                                                                   X=self.X, 
-                                                                   Y=np.array(np.mat(self.gene_expression_matrix[gene,:])).T, 
-                                                                   iter_num_at_birth=self.iter_num,
-                                                                   fast=self.fast)
+                        # create a new cluster in the lowest free slot
+                        cluster_chosen = self.new_slot()
+                        self.set_cluster(cluster_chosen, dp_cluster(members=[gene], 
+                                                                    sigma_n=self.sigma_n_init, 
+                                                                    X=self.X, 
+                                                                    Y=np.array(np.mat(self.gene_expression_matrix[gene,:])).T, 
+                                                                    iter_num_at_birth=self.iter_num,
+                                                                    fast=self.fast, 
+                                                                    factorization=self.factorization,
+                                                                    gp_backend=self.gp_backend), 1)
+                        self.cache_log_likelihoods(np.array([cluster_chosen]))
                         
                     else:
                         
-                        self.clusters[cluster_chosen].add_member(gene, self.iter_num)
+                        # membership is kept in the assignment array, only size changes here
+                        self.cluster_sizes[cluster_chosen] += 1
+                        self.clusters[cluster_chosen].model_optimized = False
                     
                     # remove gene from previous cluster
-                    self.clusters[prev_cluster].remove_member(gene, self.iter_num)
+                    self.cluster_sizes[prev_cluster] -= 1
+                    self.clusters[prev_cluster].model_optimized = False
                     
                     # if cluster becomes empty, remove
-                    if (self.clusters[prev_cluster].size == 0):
+                    if (self.cluster_sizes[prev_cluster] == 0):
                         
-                        del self.clusters[prev_cluster]
-                        del self.last_MVN_by_cluster_by_gene[prev_cluster]
+                        self.free_slot(prev_cluster)
                     
                 else: # if the same cluster is chosen, then pass
                     pass
                 
                 self.last_cluster[gene] = cluster_chosen
+            
+            # split-merge moves between sweeps over genes
+            if not self.fast and self.n_genes > 1:
+                for i in range(self.split_merge):
+                    self.split_merge_move()
+            
+            self.shrink_cluster_table()
                 
             if self.check_burnin_convergence and self.iter_num < self.burnIn_phaseII:
                 
-                sizes = {n:c.size for n,c in self.clusters.iteritems() if c.size > 0}
+                sizes = {n:self.cluster_sizes[n] for n in np.flatnonzero(self.cluster_sizes > 0)}
                 proportions = {n:s/float(sum(sizes.values())) for n,s in sizes.iteritems()}
                 
                 if self.last_proportions is not False:
@@ -860,22 +1965,35 @@ cdef class gibbs_sampler(object):
                     
             if self.iter_num >= self.burnIn_phaseI:
                 
-                self.all_clusterings = np.vstack((self.all_clusterings, np.array([self.last_cluster[i] for i in range(self.n_genes)])))            
+                self.all_clusterings.append(self.last_cluster)
                 
                 if self.sample():
                     
-                    for clusterID, cluster in self.clusters.iteritems():
+                    members_by_cluster = self.members_by_cluster()
+                    for clusterID, members in members_by_cluster.iteritems():
                         
-                        if not cluster.model_optimized and cluster.size > 1:
-                            del self.last_MVN_by_cluster_by_gene[clusterID]
-                        
-                        self.clusters[clusterID] = cluster.update_cluster_attributes(self.gene_expression_matrix, self.sigma_n2_shape, self.sigma_n2_rate, self.length_scale_mu, self.length_scale_sigma, self.sigma_f_mu, self.sigma_f_sigma, self.iter_num, self.max_iters, self.optimizer, self.sparse_regression, self.fast)
-#                         import time; time.sleep(5)
+                        cluster = self.clusters[clusterID]
+                        cluster.members = list(members)
+                        cluster.size = len(members)
+                    
+                    refit = [clusterID for clusterID in members_by_cluster if not self.clusters[clusterID].model_optimized]
+                    update_clusters([self.clusters[clusterID] for clusterID in members_by_cluster], self.gene_expression_matrix, 
+                                    (self.sigma_n2_shape, self.sigma_n2_rate, self.length_scale_mu, self.length_scale_sigma, self.sigma_f_mu, self.sigma_f_sigma, 
+                                     self.max_iters, self.optimizer, self.sparse_regression, self.refit_threshold), self.iter_num, executor)
+                    
+                    # updated clusters invalidate their cached log-likelihoods
+                    for clusterID in refit:
+                        self.stack_cluster(clusterID)
+                        if self.clusters[clusterID].fit_seconds is None:
+                            self.n_refits_skipped += 1
+                        else:
+                            self.n_refits += 1
+                            self.refit_seconds += self.clusters[clusterID].fit_seconds
                         
             # take a sample from the posterior distribution
             if self.sample() and (self.iter_num >= self.burnIn_phaseII):
                 
-                self.sampled_clusterings = np.vstack((self.sampled_clusterings, np.array([self.last_cluster[i] for i in range(self.n_genes)])))   
+                self.sampled_clusterings.append(self.last_cluster)
                 
                 self.num_samples_taken += 1
                 print 'Sample number: %s'%(self.num_samples_taken)
@@ -884,9 +2002,17 @@ cdef class gibbs_sampler(object):
                 self.prev_post = self.current_post
                 self.current_post = self.get_log_posterior()
                 self.log_likelihoods.append(self.current_post)
-                self.S, self.current_sq_dist = self.update_S_matrix()
+                self.current_sq_dist = self.update_S_matrix()
+                self.streaming_diagnostics.add(self.current_post, self.last_cluster)
                 
-                if (self.check_convergence):
+                if self.check_convergence and self.target_ess > 0:
+                    
+                    # converge once every monitored quantity that varies has target_ess effective 
+                    # samples, not while none does (NaN)
+                    min_ess = self.streaming_diagnostics.min_effective_sample_size()
+                    self.converged = True if (not np.isnan(min_ess) and min_ess >= self.target_ess) else False
+                    
+                elif (self.check_convergence):
                     
                     self.prev_sq_dist = self.current_sq_dist
                     
@@ -932,6 +2058,8 @@ cdef class gibbs_sampler(object):
                         self.converged = False
                                 
         if self.converged:
+            if self.target_ess > 0:
+                print 'Gibbs sampling converged by effective sample size'
             if self.post_counter >= 10:
                 print 'Gibbs sampling converged by log-likelihood'
             if self.min_sq_dist_counter >= 10:
@@ -939,10 +2067,24 @@ cdef class gibbs_sampler(object):
         elif (self.iter_num == self.max_num_iterations):
             print "Maximum number of Gibbs sampling iterations: %s; terminating Gibbs sampling now."%(self.iter_num)
         
-        self.sampled_clusterings = pd.DataFrame(self.sampled_clusterings[1:,:], columns=self.sampled_clusterings[0,:])
-        self.all_clusterings = pd.DataFrame(self.all_clusterings[1:,:], columns=self.all_clusterings[0,:])
+        executor.close()
+        
+        if self.num_samples_taken > 0:
+            ess = self.streaming_diagnostics.effective_sample_sizes(current=True)
+            print 'Effective sample sizes: %.1f (log likelihood), %.1f (number of clusters), %.1f (co-clustering of %s gene pairs); mean switch rate %.3f'%(
+                ess['log_likelihood'], ess['n_clusters'], ess['co_clustering'], len(self.streaming_diagnostics.pairs[0]), self.streaming_diagnostics.mean_switch_rate())
+        
+        if self.split_merge > 0:
+            print 'Split-merge moves: %s of %s splits (%.1f%%) and %s of %s merges (%.1f%%) accepted'%(self.n_splits_accepted, self.n_splits_proposed, 
+                                                                                                       100. * self.n_splits_accepted / max(self.n_splits_proposed, 1), 
+                                                                                                       self.n_merges_accepted, self.n_merges_proposed, 
+                                                                                                       100. * self.n_merges_accepted / max(self.n_merges_proposed, 1))
+        
+        # skipped refits are assumed to take as long as an average refit
+        print 'Hyperparameter refits: %s in %.1f s, %s skipped (about %.1f s saved)'%(self.n_refits, self.refit_seconds, self.n_refits_skipped, 
+                                                                                       self.n_refits_skipped * self.refit_seconds / max(self.n_refits, 1))
         
-        # S is lower triangular, make into full symmetric similarity matrix
-        self.S = np.array(self.S + self.S.T + np.eye(len(self.S)))
+        if previous_handler is not None:
+            signal.signal(signal.SIGTERM, previous_handler)
         
         return(self.S, self.all_clusterings, self.sampled_clusterings, self.log_likelihoods, self.iter_num)
@@ -0,0 +1,231 @@
+'''
+Convergence diagnostics for Gibbs sampling chains.
+'''
+import numpy as np
+import pandas as pd
+
+#############################################################################################
+#
+#    Convergence diagnostics
+#
+#############################################################################################
+
+def potential_scale_reduction(traces):
+    '''
+    Compute the potential scale reduction factor R-hat of a scalar quantity
+    (Gelman and Rubin 1992, DOI:10.1214/ss/1177011136). Chains are truncated
+    to the length of the shortest chain.
+
+    :param traces: one sequence of sampled values per chain
+    :type traces: list of lists/numpy arrays of floats
+
+    :returns: R-hat, or NaN if fewer than two chains of at least two samples are
+              given. Without variation within chains, R-hat is 1 if the chains agree 
+              and infinite if they are stuck at different values.
+    :rtype: float
+    '''
+    n = min([len(trace) for trace in traces]) if len(traces) > 0 else 0
+    if len(traces) < 2 or n < 2:
+        return np.nan
+
+    traces = np.array([np.asarray(trace, dtype=float)[:n] for trace in traces])
+    W = np.mean(np.var(traces, axis=1, ddof=1))
+    B = n * np.var(np.mean(traces, axis=1), ddof=1)
+    if W == 0:
+        return 1. if B == 0 else np.inf
+
+    var_hat = (n - 1.) / n * W + B / n
+    return np.sqrt(var_hat / W)
+
+#############################################################################################
+
+def effective_sample_size(trace):
+    '''
+    Estimate the effective sample size of a scalar quantity from its trace in one chain,
+    n / (1 + 2 sum of autocorrelations), with autocorrelations (computed by FFT) summed 
+    by Geyer's initial monotone sequence (DOI:10.1214/ss/1177011137).
+
+    :param trace: sampled values
+    :type trace: list/numpy array of floats
+
+    :returns: effective sample size, or NaN if fewer than four samples are given or if
+              there is no variation in the trace, which then tells nothing about mixing
+    :rtype: float
+    '''
+    x = np.asarray(trace, dtype=float)
+    n = len(x)
+    if n < 4:
+        return np.nan
+    # on the raw values, since subtracting the mean of a constant trace may leave rounding errors
+    if np.all(x == x[0]):
+        return np.nan
+    x = x - np.mean(x)
+
+    f = np.fft.rfft(x, 2 * n)
+    autocov = np.fft.irfft(f * np.conj(f))[:n]
+    rho = autocov / autocov[0]
+
+    # sums of autocorrelations at lags 2k and 2k + 1, up to the first non-positive one, made monotone
+    pairs = rho[:n - n % 2].reshape(-1, 2).sum(axis=1)
+    non_positive = np.flatnonzero(pairs <= 0)
+    pairs = np.minimum.accumulate(pairs[:non_positive[0] if len(non_positive) > 0 else len(pairs)])
+    tau = max(-1. + 2. * np.sum(pairs), 1. / np.log10(n))
+    return n / tau
+
+#############################################################################################
+
+class streaming_diagnostics():
+    '''
+    Convergence diagnostics of one Gibbs sampling chain from cheap per-sample statistics:
+    the log posterior likelihood, the number of clusters, the fraction of genes that switched
+    cluster since the previous sample, and the fraction of a random subset of gene pairs that
+    are co-clustered. Each sample costs O(N + number of pairs). Effective sample sizes are
+    recomputed only once the number of samples has grown by check_growth since they were
+    last computed, so that checking them at every sample costs O(log n) amortized instead
+    of an O(n log n) FFT per sample.
+
+    :param n_genes: number of genes
+    :type n_genes: int
+    :param n_pairs: number of randomly chosen gene pairs
+    :type n_pairs: int
+    :param random_state: source of random numbers for choosing gene pairs
+    :type random_state: numpy.random.RandomState
+    :param check_growth: relative growth of the number of samples between computations of
+                         effective sample sizes
+    :type check_growth: float
+    '''
+    def __init__(self, n_genes, n_pairs=1000, random_state=np.random, check_growth=0.1):
+        if n_genes > 1:
+            first = random_state.randint(n_genes, size=n_pairs)
+            self.pairs = (first, (first + random_state.randint(1, n_genes, size=n_pairs)) % n_genes)
+        else:
+            self.pairs = (np.zeros(0, dtype=int), np.zeros(0, dtype=int))
+        self.log_posteriors, self.n_clusters, self.switch_rates, self.co_clustered_pairs = [], [], [], []
+        self.last_clustering = None
+        self.check_growth = check_growth
+        self.ess, self.ess_samples = None, 0
+
+    def add(self, log_posterior, clustering):
+        '''
+        Record the statistics of a sampled clustering.
+
+        :param log_posterior: log posterior likelihood of the clustering
+        :type log_posterior: float
+        :param clustering: cluster of each gene
+        :type clustering: numpy array of ints
+        '''
+        clustering = np.asarray(clustering)
+        self.log_posteriors.append(log_posterior)
+        self.n_clusters.append(len(np.unique(clustering)))
+        if self.last_clustering is not None:
+            self.switch_rates.append(np.mean(clustering != self.last_clustering))
+        self.co_clustered_pairs.append(np.mean(clustering[self.pairs[0]] == clustering[self.pairs[1]]) if len(self.pairs[0]) > 0 else 1.)
+        self.last_clustering = clustering.copy()
+
+    def relabel(self, labels):
+        '''
+        Follow a relabelling of clusters, e.g. when the cluster table of the sampler is compacted,
+        so that relabelled genes do not count as switched.
+
+        :param labels: new label of each old label
+        :type labels: numpy array of ints
+        '''
+        if self.last_clustering is not None:
+            self.last_clustering = labels[self.last_clustering]
+
+    def effective_sample_sizes(self, current=False):
+        '''
+        Effective sample sizes of the log posterior likelihood ("log_likelihood"), the number 
+        of clusters ("n_clusters") and the fraction of co-clustered gene pairs ("co_clustering"),
+        as last computed (see check_growth).
+
+        :param current: recompute them for all samples so far
+        :type current: bool
+
+        :rtype: dict
+        '''
+        n = len(self.log_posteriors)
+        if current or self.ess is None or n >= max(self.ess_samples + 1, self.ess_samples * (1. + self.check_growth)):
+            self.ess = {'log_likelihood':effective_sample_size(self.log_posteriors),
+                        'n_clusters':effective_sample_size(self.n_clusters),
+                        'co_clustering':effective_sample_size(self.co_clustered_pairs)}
+            self.ess_samples = n
+        return self.ess
+
+    def min_effective_sample_size(self):
+        '''
+        Smallest effective sample size of the monitored quantities that varied. Constant 
+        quantities, e.g. a number of clusters that has settled, are left out.
+        
+        :returns: effective sample size, or NaN while too few samples are taken or if all 
+                  monitored quantities are constant
+        :rtype: float
+        '''
+        ess = [value for value in self.effective_sample_sizes().values() if not np.isnan(value)]
+        return min(ess) if len(ess) > 0 else np.nan
+
+    def mean_switch_rate(self):
+        '''Mean fraction of genes that switched cluster between consecutive samples.'''
+        return np.mean(self.switch_rates) if len(self.switch_rates) > 0 else np.nan
+
+#############################################################################################
+
+def number_of_clusters(clusterings):
+    '''
+    Count clusters per sample.
+
+    :param clusterings: clusterings[i,j] is the cluster to which gene j belongs at sample i
+    :type clusterings: numpy array of ints
+
+    :rtype: numpy array of ints
+    '''
+    return np.array([len(np.unique(clustering)) for clustering in np.asarray(clusterings)], dtype=int)
+
+#############################################################################################
+
+def chain_diagnostics(log_likelihoods_by_chain, sampled_clusterings_by_chain):
+    '''
+    Summarize each chain and compute R-hat of the log posterior likelihood
+    and of the number of clusters across chains.
+
+    :param log_likelihoods_by_chain: per chain, list of log likelihoods of sampled clusterings
+    :type log_likelihoods_by_chain: list of lists
+    :param sampled_clusterings_by_chain: per chain, sampled clusterings
+    :type sampled_clusterings_by_chain: list of clustering_traces/numpy arrays
+
+    :returns: (summary, rhat):
+        summary: per chain, number of samples and mean log likelihood and number of clusters
+        :type summary: pandas dataframe
+        rhat: R-hat by quantity ("log_likelihood", "n_clusters")
+        :type rhat: dict
+    '''
+    n_clusters_by_chain = [number_of_clusters(clusterings) for clusterings in sampled_clusterings_by_chain]
+    summary = pd.DataFrame({'n_samples':[len(L) for L in log_likelihoods_by_chain],
+                            'mean_log_likelihood':[np.mean(L) if len(L) > 0 else np.nan for L in log_likelihoods_by_chain],
+                            'mean_n_clusters':[np.mean(K) if len(K) > 0 else np.nan for K in n_clusters_by_chain]},
+                           columns=['n_samples', 'mean_log_likelihood', 'mean_n_clusters'])
+    summary.index.name = 'chain'
+    rhat = {'log_likelihood':potential_scale_reduction(log_likelihoods_by_chain),
+            'n_clusters':potential_scale_reduction(n_clusters_by_chain)}
+    return summary, rhat
+
+#############################################################################################
+
+def save_chain_diagnostics(summary, rhat, output_path_prefix):
+    '''
+    Save per-chain summaries and R-hat values to output_path_prefix + "_chain_diagnostics.txt".
+
+    :param summary: per chain summary, see chain_diagnostics
+    :type summary: pandas dataframe
+    :param rhat: R-hat by quantity
+    :type rhat: dict
+    :param output_path_prefix: absolute path to output
+    :type output_path_prefix: str
+
+    :returns: NULL
+    '''
+    with open(output_path_prefix + "_chain_diagnostics.txt", 'w') as f:
+        summary.to_csv(f, sep='\t')
+        f.write('\n')
+        for quantity in sorted(rhat):
+            f.write('Rhat_%s\t%s\n'%(quantity, rhat[quantity]))
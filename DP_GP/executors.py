@@ -0,0 +1,82 @@
+'''
+Executors that map a function over independent tasks: serially, in a pool of threads
+or in a pool of processes.
+'''
+import multiprocessing
+import multiprocessing.pool
+
+EXECUTORS = ['serial', 'thread', 'process']
+
+#############################################################################################
+#
+#    Executors
+#
+#    All executors provide map(function, tasks), which returns the results in the order
+#    of tasks and dispatches tasks in that order, and close(). Executors that share
+#    memory with the caller (shares_memory = True) run the function on the tasks
+#    themselves, otherwise tasks and results are pickled.
+#
+#############################################################################################
+
+class serial_executor(object):
+    '''Run tasks one after another in the current thread.'''
+    shares_memory = True
+
+    def map(self, function, tasks):
+        return [function(task) for task in tasks]
+
+    def close(self):
+        pass
+
+class thread_executor(object):
+    '''
+    Run tasks in a pool of threads.
+
+    :param processes: number of threads [default=number of CPUs]
+    :type processes: int
+    '''
+    shares_memory = True
+
+    def __init__(self, processes=None):
+        self.pool = multiprocessing.pool.ThreadPool(processes)
+
+    def map(self, function, tasks):
+        # one task at a time, so that the tasks dispatched first (e.g. the largest) start first
+        return self.pool.map(function, tasks, chunksize=1)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+class process_executor(thread_executor):
+    '''
+    Run tasks in a pool of processes. The function must be defined at module level,
+    and tasks and results must be picklable.
+
+    :param processes: number of processes [default=number of CPUs]
+    :type processes: int
+    '''
+    shares_memory = False
+
+    def __init__(self, processes=None):
+        self.pool = multiprocessing.Pool(processes)
+
+def executor(kind='serial', processes=None):
+    '''
+    Create an executor.
+
+    :param kind: 'serial', 'thread' or 'process'
+    :type kind: str
+    :param processes: number of threads/processes [default=number of CPUs]
+    :type processes: int
+
+    :rtype: serial_executor, thread_executor or process_executor
+    '''
+    if kind == 'serial':
+        return serial_executor()
+    elif kind == 'thread':
+        return thread_executor(processes)
+    elif kind == 'process':
+        return process_executor(processes)
+    else:
+        raise ValueError("unknown executor: %s"%(kind))
@@ -0,0 +1,445 @@
+'''
+Gaussian process regression backends for fitting cluster hyperparameters.
+
+Three backends are available:
+    native:       exact GP regression with a radial basis function plus linear and bias
+                  kernel, implemented here in numpy/scipy with analytic gradients
+    native_stats: the native model fitted on per-time-point sufficient statistics of
+                  the members of a cluster, whose cost does not grow with cluster size
+    gpy:          the same model built from GPy objects (also provides sparse regression)
+
+All backends fit the maximum a posteriori hyperparameters under the same priors
+and parameterization (GPy's default "Logexp" transformation of positive parameters,
+including its log Jacobian for parameters with priors), so that they can be used
+interchangeably (see test/test_gp_backend.py).
+'''
+import numpy as np
+import scipy.linalg
+import scipy.optimize
+from scipy.special import gammaln
+import GPy
+
+GP_BACKENDS = ['native', 'native_stats', 'gpy']
+
+# as in GPy/paramz
+_lim_val = 36.0
+_log_lim_val = np.log(np.finfo(np.float64).max)
+_log_2_pi = np.log(2 * np.pi)
+
+#############################################################################################
+#
+#    Priors and transformation of positive parameters
+#
+#############################################################################################
+
+class inverse_gamma(object):
+    '''Inverse gamma prior with shape a and rate b.'''
+    def __init__(self, a, b):
+        self.a, self.b = float(a), float(b)
+        self.constant = -gammaln(self.a) + self.a * np.log(self.b)
+
+    def lnpdf(self, x):
+        return self.constant - (self.a + 1) * np.log(x) - self.b / x
+
+    def lnpdf_grad(self, x):
+        return -(self.a + 1.) / x + self.b / x ** 2
+
+class log_gaussian(object):
+    '''Log-normal prior, i.e. log(x) is normally distributed with mean mu and standard deviation sigma.'''
+    def __init__(self, mu, sigma):
+        self.mu, self.sigma2 = float(mu), float(sigma)**2
+        self.constant = -0.5 * np.log(2 * np.pi * self.sigma2)
+
+    def lnpdf(self, x):
+        return self.constant - 0.5 * np.square(np.log(x) - self.mu) / self.sigma2 - np.log(x)
+
+    def lnpdf_grad(self, x):
+        return -((np.log(x) - self.mu) / self.sigma2 + 1.) / x
+
+def logexp(theta):
+    '''Map unconstrained optimizer values to positive parameters, p = log(1 + exp(theta)).'''
+    return np.where(theta > _lim_val, theta, np.log1p(np.exp(np.clip(theta, -_log_lim_val, _lim_val))))
+
+def logexp_inverse(p):
+    '''Inverse of logexp.'''
+    return np.where(p > _lim_val, p, np.log(np.expm1(p)))
+
+def jitchol(A, max_tries=5):
+    '''
+    Lower Cholesky factor of A, adding increasing jitter to the diagonal if
+    A is numerically not positive definite (as GPy.util.linalg.jitchol).
+    '''
+    L, info = scipy.linalg.lapack.dpotrf(A, lower=1)
+    if info == 0:
+        return L
+    diagA = np.diag(A)
+    if np.any(diagA <= 0.):
+        raise np.linalg.LinAlgError("not pd: non-positive diagonal elements")
+    jitter = diagA.mean() * 1e-6
+    for i in range(max_tries):
+        L, info = scipy.linalg.lapack.dpotrf(A + np.eye(A.shape[0]) * jitter, lower=1)
+        if info == 0:
+            return L
+        jitter *= 10
+    raise np.linalg.LinAlgError("not positive definite, even with jitter.")
+
+#############################################################################################
+#
+#    Native backend
+#
+#############################################################################################
+
+class rbf_linear_bias(object):
+    '''
+    Covariance kernel k(x, x') = rbf_variance * exp(-(x - x')^2 / (2 lengthscale^2))
+                                 + linear_variance * x x' + bias_variance
+    for one-dimensional inputs. Parameters are kept in param_array, in the order
+    of GPy's RBF + Linear + Bias kernel.
+    '''
+    def __init__(self, variance=1., lengthscale=1., linear_variance=0.001, bias_variance=0.001):
+        self.param_array = np.array([variance, lengthscale, linear_variance, bias_variance], dtype=float)
+
+    def K(self, X, X2=None):
+        '''
+        :param X, X2: vertically stacked inputs
+        :type X, X2: numpy arrays of dimension N x 1 and M x 1
+
+        :returns: covariance matrix of dimension N x M (X2 = X if None)
+        '''
+        X2 = X if X2 is None else X2
+        variance, lengthscale, linear_variance, bias_variance = self.param_array
+        r2 = np.square(X - X2.T)
+        return variance * np.exp(-0.5 * r2 / lengthscale**2) + linear_variance * np.dot(X, X2.T) + bias_variance
+
+    def Kdiag(self, X):
+        '''Diagonal of K(X).'''
+        variance, lengthscale, linear_variance, bias_variance = self.param_array
+        return variance + linear_variance * np.square(X[:,0]) + bias_variance
+
+    def gradients(self, X, dL_dK):
+        '''
+        Gradient of an objective L with respect to param_array, given dL/dK(X).
+        '''
+        variance, lengthscale, linear_variance, bias_variance = self.param_array
+        r2 = np.square(X - X.T)
+        dL_dK_E = dL_dK * np.exp(-0.5 * r2 / lengthscale**2)
+        return np.array([np.sum(dL_dK_E),
+                         variance / lengthscale**3 * np.sum(dL_dK_E * r2),
+                         np.dot(X[:,0], np.dot(dL_dK, X[:,0])),
+                         np.sum(dL_dK)])
+
+class gp_regression(object):
+    '''
+    Exact Gaussian process regression with Gaussian noise, with the subset of the
+    interface of GPy.models.GPRegression used by DP_GP. Like GPy, the model shares
+    (and optimizes) the kernel object it is given.
+
+    :param X: vertically stacked inputs
+    :type X: numpy array of dimension N x 1
+    :param Y: outputs, one column per output sharing the kernel
+    :type Y: numpy array of dimension N x D
+    :param kernel: covariance kernel
+    :type kernel: rbf_linear_bias
+    :param noise_variance: Gaussian noise variance
+    :type noise_variance: float
+    '''
+    def __init__(self, X, Y, kernel, noise_variance=1.):
+        self.X = np.asarray(X, dtype=float)
+        self.Y = np.asarray(Y, dtype=float)
+        self.kern = kernel
+        self.noise_variance = float(noise_variance)
+        # priors by index into param_array
+        self.priors = {}
+        self.posterior = None
+
+    def set_XY(self, X, Y):
+        '''Replace the data of the model, keeping kernel, noise variance and priors.'''
+        self.X = np.asarray(X, dtype=float)
+        self.Y = np.asarray(Y, dtype=float)
+        self.posterior = None
+
+    def parameter_names(self):
+        return ['sum.rbf.variance', 'sum.rbf.lengthscale', 'sum.linear.variances', 'sum.bias.variance', 'Gaussian_noise.variance']
+
+    @property
+    def param_array(self):
+        return np.r_[self.kern.param_array, self.noise_variance]
+
+    def __setitem__(self, key, values):
+        param_array = self.param_array
+        param_array[key] = values
+        self.kern.param_array[:] = param_array[:-1]
+        self.noise_variance = param_array[-1]
+        self.posterior = None
+
+    def set_priors(self, sigma_n2_shape, sigma_n2_rate, length_scale_mu, length_scale_sigma, sigma_f_mu, sigma_f_sigma):
+        '''Set priors on noise variance, RBF lengthscale and RBF variance.'''
+        self.priors = {4:inverse_gamma(sigma_n2_shape, sigma_n2_rate),
+                       1:log_gaussian(length_scale_mu, length_scale_sigma),
+                       0:log_gaussian(sigma_f_mu, sigma_f_sigma)}
+
+    def inference(self):
+        '''
+        Compute the posterior, the log marginal likelihood and its gradient with
+        respect to param_array (as GPy's ExactGaussianInference).
+        '''
+        Ky = self.kern.K(self.X)
+        Ky[np.diag_indices_from(Ky)] += self.noise_variance + 1e-8
+        L = jitchol(Ky)
+        alpha = scipy.linalg.cho_solve((L, True), self.Y, check_finite=False)
+        Wi = scipy.linalg.cho_solve((L, True), np.eye(Ky.shape[0]), check_finite=False)
+        log_marginal = 0.5 * (-self.Y.size * _log_2_pi - self.Y.shape[1] * 2 * np.sum(np.log(np.diag(L))) - np.sum(alpha * self.Y))
+        dL_dK = 0.5 * (np.dot(alpha, alpha.T) - self.Y.shape[1] * Wi)
+        gradient = np.r_[self.kern.gradients(self.X, dL_dK), np.trace(dL_dK)]
+        self.posterior = (self.X, alpha, Wi, log_marginal)
+        return log_marginal, gradient
+
+    def log_likelihood(self):
+        '''Log marginal likelihood at the current parameters.'''
+        if self.posterior is None:
+            self.inference()
+        return self.posterior[3]
+
+    def log_prior(self):
+        '''Log prior density (including log Jacobian of the Logexp transformation) and its gradient.'''
+        param_array = self.param_array
+        log_p, gradient = 0., np.zeros(len(param_array))
+        for i, prior in self.priors.iteritems():
+            p = param_array[i]
+            log_p += prior.lnpdf(p) + (p if p > _lim_val else np.log(np.expm1(p))) - p
+            gradient[i] = prior.lnpdf_grad(p) + 1. / np.expm1(p)
+        return log_p, gradient
+
+    def objective(self, theta):
+        '''
+        Negative log posterior and its gradient at transformed parameters theta,
+        or (inf, 0) if the covariance matrix cannot be factorized.
+        '''
+        self[:] = logexp(theta)
+        try:
+            log_marginal, gradient = self.inference()
+        except np.linalg.LinAlgError:
+            return np.inf, np.zeros(len(theta))
+        log_p, prior_gradient = self.log_prior()
+        param_array = self.param_array
+        gradfactor = np.where(param_array > _lim_val, 1., -np.expm1(-param_array))
+        return -(log_marginal + log_p), -(gradient + prior_gradient) * gradfactor
+
+    def optimize(self, optimizer='lbfgsb', max_iters=1000):
+        '''
+        Fit the maximum a posteriori parameters, starting from the current parameters.
+
+        :param optimizer: 'lbfgsb' (L-BFGS-B), 'fmin_tnc' (truncated Newton) or 'simplex' (Nelder-Mead)
+        :type optimizer: str
+        :param max_iters: maximum number of optimizer iterations (function evaluations)
+        :type max_iters: int
+        '''
+        theta = logexp_inverse(self.param_array)
+        if optimizer == 'lbfgsb':
+            theta = scipy.optimize.fmin_l_bfgs_b(self.objective, theta, maxfun=max_iters, maxiter=max_iters)[0]
+        elif optimizer in ['fmin_tnc', 'tnc']:
+            theta = scipy.optimize.fmin_tnc(self.objective, theta, messages=0, maxfun=int(max_iters))[0]
+        elif optimizer == 'simplex':
+            theta = scipy.optimize.fmin(lambda theta: self.objective(theta)[0], theta, disp=False, maxfun=int(max_iters))
+        else:
+            raise ValueError("optimizer %s is not implemented by the native GP backend, use the gpy backend"%(optimizer))
+        self.objective(theta)
+
+    def _raw_predict(self, Xnew, full_cov=False, kern=None):
+        '''Posterior mean and (co)variance of the latent function at Xnew.'''
+        if self.posterior is None:
+            self.inference()
+        X, alpha, Wi, log_marginal = self.posterior
+        Kx = self.kern.K(X, Xnew)
+        mu = np.dot(Kx.T, alpha)
+        if full_cov:
+            var = self.kern.K(Xnew) - np.dot(Kx.T, np.dot(Wi, Kx))
+        else:
+            var = np.clip(self.kern.Kdiag(Xnew) - np.sum(np.dot(Wi.T, Kx) * Kx, 0), 1e-15, np.inf)[:,np.newaxis]
+        return mu, var
+
+    def predict(self, Xnew, full_cov=False, kern=None):
+        '''Posterior mean and (co)variance of outputs at Xnew, i.e. including noise.'''
+        mu, var = self._raw_predict(Xnew, full_cov=full_cov)
+        if full_cov:
+            var += np.eye(var.shape[0]) * self.noise_variance
+        else:
+            var += self.noise_variance
+        return mu, var
+
+class gp_regression_stats(gp_regression):
+    '''
+    Exact Gaussian process regression of replicate observations of one function on
+    a common grid of inputs, e.g. the expression of the members of a cluster, with the
+    interface of gp_regression.
+
+    The observations enter the marginal likelihood and the posterior only through
+    the number of observations c, their mean and the sum of squared deviations from
+    the mean at each input: the likelihood factorizes into a GP regression of the means
+    with noise variance noise_variance / c, and a term of the deviations from the means
+    that does not depend on the kernel. After the statistics are computed (in O(N T)
+    for N replicates on T inputs), inference costs O(T^3), independent of N.
+
+    :param X: inputs
+    :type X: numpy array of dimension T x 1
+    :param Y: observations, one column per replicate, NaN where missing
+    :type Y: numpy array of dimension T x N
+    :param kernel: covariance kernel
+    :type kernel: rbf_linear_bias
+    :param noise_variance: Gaussian noise variance
+    :type noise_variance: float
+    '''
+    def __init__(self, X, Y, kernel, noise_variance=1.):
+        gp_regression.__init__(self, X, Y, kernel, noise_variance)
+        self.set_XY(X, Y)
+
+    def set_XY(self, X, Y):
+        '''Replace the data of the model and their statistics, keeping kernel, noise variance and priors.'''
+        gp_regression.set_XY(self, X, Y)
+        observed = ~np.isnan(self.Y)
+        counts = observed.sum(axis=1)
+        mean = np.where(observed, self.Y, 0.).sum(axis=1) / np.maximum(counts, 1)
+        self.observed = counts > 0
+        self.counts = counts[self.observed].astype(float)
+        self.Y_mean = np.vstack(mean[self.observed])
+        self.n_observations = np.sum(counts)
+        self.residual = np.sum(np.where(observed, self.Y - mean[:,np.newaxis], 0.)**2)
+
+    def inference(self):
+        '''
+        Compute the posterior, the log marginal likelihood and its gradient with
+        respect to param_array from the statistics of the observations. Equal to
+        gp_regression.inference on all observations, including the jitter added 
+        to the noise variance.
+        '''
+        X = self.X[self.observed]
+        noise_variance = self.noise_variance + 1e-8
+        Ky = self.kern.K(X)
+        Ky[np.diag_indices_from(Ky)] += noise_variance / self.counts
+        L = jitchol(Ky)
+        alpha = scipy.linalg.cho_solve((L, True), self.Y_mean, check_finite=False)
+        Wi = scipy.linalg.cho_solve((L, True), np.eye(Ky.shape[0]), check_finite=False)
+        # deviations from the means at each input
+        n_deviations = self.n_observations - len(self.counts)
+        log_marginal = 0.5 * (-len(self.counts) * _log_2_pi - 2 * np.sum(np.log(np.diag(L))) - np.sum(alpha * self.Y_mean)) \
+                       - 0.5 * (n_deviations * (_log_2_pi + np.log(noise_variance)) + np.sum(np.log(self.counts)) + self.residual / noise_variance)
+        dL_dK = 0.5 * (np.dot(alpha, alpha.T) - Wi)
+        dL_dnoise = np.sum(np.diag(dL_dK) / self.counts) - 0.5 * n_deviations / noise_variance + 0.5 * self.residual / noise_variance**2
+        gradient = np.r_[self.kern.gradients(X, dL_dK), dL_dnoise]
+        self.posterior = (X, alpha, Wi, log_marginal)
+        return log_marginal, gradient
+
+def stats_log_likelihood(K, noise_variance, counts, sums, sum_squares):
+    '''
+    Log marginal likelihood of replicate observations of one function (see gp_regression_stats)
+    from the number, sum and sum of squares of the observations at each input, for one or 
+    several (stacked) sets of observations at once. Inputs without observations are 
+    marginalized out.
+
+    :param K: covariance matrix of the function at the inputs
+    :type K: numpy array of dimension T x T
+    :param noise_variance: Gaussian noise variance
+    :type noise_variance: float
+    :param counts, sums, sum_squares: statistics of the observations at each input
+    :type counts, sums, sum_squares: numpy arrays of length T, or of dimension S x T for S sets
+
+    :returns: log marginal likelihood of each set
+    :rtype: float, or numpy array of length S
+    '''
+    stacked = np.ndim(counts) == 2
+    counts, sums, sum_squares = np.atleast_2d(counts, sums, sum_squares)
+    observed = counts > 0
+    n_inputs = np.sum(observed, axis=1)
+    counts = np.where(observed, counts, 1.)
+    mean = sums / counts
+    residual = np.sum(sum_squares - sums * mean, axis=1)
+    noise_variance = noise_variance + 1e-8
+    # unobserved inputs get unit variance and no covariance, which leaves determinant and quadratic form unchanged
+    Ky = np.where(observed[:,:,np.newaxis] & observed[:,np.newaxis,:], K, 0.)
+    diagonal = np.arange(K.shape[0])
+    Ky[:,diagonal,diagonal] += np.where(observed, noise_variance / counts, 1.)
+    try:
+        L = np.linalg.cholesky(Ky)
+    except np.linalg.LinAlgError:
+        L = np.array([jitchol(A) for A in Ky])
+    z = np.linalg.solve(L, mean[:,:,np.newaxis])[:,:,0]
+    n_deviations = np.sum(np.where(observed, counts, 0.), axis=1) - n_inputs
+    LL = -0.5 * (n_inputs * _log_2_pi + 2 * np.sum(np.log(L[:,diagonal,diagonal]), axis=1) + np.sum(np.square(z), axis=1)) \
+         - 0.5 * (n_deviations * (_log_2_pi + np.log(noise_variance)) + np.sum(np.log(counts), axis=1) + residual / noise_variance)
+    return LL if stacked else LL[0]
+
+#############################################################################################
+#
+#    Backend-independent interface
+#
+#############################################################################################
+
+def default_kernel(backend='native'):
+    '''Radial basis function kernel plus linear and bias kernels, at initial hyperparameters.'''
+    if backend in ['native', 'native_stats']:
+        return rbf_linear_bias(variance=1., lengthscale=1., linear_variance=0.001, bias_variance=0.001)
+    elif backend == 'gpy':
+        return GPy.kern.RBF(input_dim=1, variance = 1., lengthscale = 1.) + \
+               GPy.kern.Linear(input_dim=1, variances=0.001) + \
+               GPy.kern.Bias(input_dim=1, variance=0.001)
+    else:
+        raise ValueError("unknown GP backend: %s"%(backend))
+
+def regression(X, Y, kernel, backend='native', sparse=False, Z=None):
+    '''
+    Build a GP regression model of Y on X with the given kernel (of the same backend).
+    Sparse regression, with inducing inputs Z, is only available from the gpy backend.
+    For the native_stats backend, X are the distinct inputs and the columns of Y are
+    replicate observations at these inputs (see gp_regression_stats).
+    '''
+    if backend in ['native', 'native_stats']:
+        if sparse:
+            raise ValueError("sparse regression is not implemented by the native GP backends, use the gpy backend")
+        if backend == 'native_stats':
+            return gp_regression_stats(X, Y, kernel)
+        return gp_regression(X, Y, kernel)
+    elif sparse:
+        return GPy.models.SparseGPRegression(X=X, Y=Y, kernel=kernel, Z=Z)
+    else:
+        return GPy.models.GPRegression(X=X, Y=Y, kernel=kernel)
+
+def set_priors(model, sigma_n2_shape, sigma_n2_rate, length_scale_mu, length_scale_sigma, sigma_f_mu, sigma_f_sigma):
+    '''
+    Set an inverse gamma prior on the noise variance and log-normal priors
+    on the RBF lengthscale and variance of a model of either backend.
+    '''
+    if isinstance(model, gp_regression):
+        model.set_priors(sigma_n2_shape, sigma_n2_rate, length_scale_mu, length_scale_sigma, sigma_f_mu, sigma_f_sigma)
+    else:
+        model.Gaussian_noise.set_prior(GPy.priors.InverseGamma(sigma_n2_shape, sigma_n2_rate), warning=False)
+        model.kern.rbf.lengthscale.set_prior(GPy.priors.LogGaussian(length_scale_mu, length_scale_sigma), warning=False)
+        model.kern.rbf.variance.set_prior(GPy.priors.LogGaussian(sigma_f_mu, sigma_f_sigma), warning=False)
+
+def is_sparse(model):
+    '''Whether the model is a (GPy) sparse regression model.'''
+    return isinstance(model, GPy.models.SparseGPRegression)
+
+def set_noise_variance(model, noise_variance):
+    '''Set the Gaussian noise variance of a model of either backend.'''
+    if isinstance(model, gp_regression):
+        model[-1] = noise_variance
+    else:
+        model.Gaussian_noise = noise_variance
+
+def hyperparameters(model):
+    '''
+    :returns: (RBF variance, RBF lengthscale, noise variance) of a model of either backend
+    :rtype: tuple of floats
+    '''
+    if isinstance(model, gp_regression):
+        return model.kern.param_array[0], model.kern.param_array[1], model.noise_variance
+    return float(model.kern.rbf.variance), float(model.kern.rbf.lengthscale), float(model.likelihood.variance)
+
+def kernel_parameters(model):
+    '''
+    :returns: (RBF variance, RBF lengthscale, linear variance, bias variance, noise variance)
+              of a (sparse or exact) model of either backend
+    :rtype: numpy array of floats
+    '''
+    # in GPy sparse models, the inducing inputs precede these parameters
+    return np.array(model.param_array)[-5:]
@@ -0,0 +1,174 @@
+'''
+Running several Gibbs sampling chains in parallel.
+'''
+import multiprocessing
+import os
+import signal
+from DP_GP import core
+from DP_GP.trace import clustering_trace
+
+#############################################################################################
+#
+#    Multiple chains
+#
+#############################################################################################
+
+# seconds to wait for the chains (about 30 years)
+_MAX_WAIT = 1E9
+
+# in pool workers, event set once SIGTERM was received, so that no further chains are started
+_termination = None
+
+def run_chain(chain):
+    '''
+    Run one independently seeded Gibbs sampling chain. The sampler draws from its own
+    random number generator only, so that chains in one process do not interfere.
+    Module-level so that it can be dispatched to a process pool.
+
+    :param chain: (seed, args, kwargs, resume) where args and kwargs are passed to
+                  core.gibbs_sampler, and if resume, the chain continues from
+                  kwargs['checkpoint_path'] if that checkpoint exists
+    :type chain: tuple
+
+    :returns: output of core.gibbs_sampler.sampler()
+    :rtype: tuple
+    '''
+    seed, args, kwargs, resume = chain
+    if _termination is not None and _termination.is_set():
+        raise core.SamplingTerminated('terminated on SIGTERM before the chain seeded %s started'%(seed))
+    GS = core.gibbs_sampler(*args, seed=seed, **kwargs)
+    checkpoint_path = kwargs.get('checkpoint_path')
+    if resume:
+        if checkpoint_path is not None and os.path.exists(checkpoint_path):
+            GS.load_checkpoint()
+        else:
+            print "WARNING: no checkpoint %s to resume from, starting a new chain"%(checkpoint_path)
+    return GS.sampler()
+
+#############################################################################################
+
+def sample_chains(n_chains, seed, args, kwargs={}, processes=None, resume=False):
+    '''
+    Run n_chains Gibbs sampling chains, seeded seed, seed + 1, ..., in a process pool.
+    A single chain is run in the current process. With several chains, each chain
+    is checkpointed to its own file, e.g. "prefix_checkpoint_chain0.pkl" for
+    kwargs['checkpoint_path'] = "prefix_checkpoint.pkl". With checkpoints, SIGTERM
+    received by this process or by any chain terminates all chains after their
+    current iteration, and chains not yet started are not started. Terminated chains
+    raise core.SamplingTerminated, which is re-raised here once the pool has shut down.
+
+    :param n_chains: number of chains
+    :type n_chains: int
+    :param seed: random seed of the first chain
+    :type seed: int
+    :param args: positional arguments to core.gibbs_sampler
+    :type args: tuple
+    :param kwargs: keyword arguments to core.gibbs_sampler
+    :type kwargs: dict
+    :param processes: number of worker processes [default=min(n_chains, number of CPUs)]
+    :type processes: int
+    :param resume: continue chains from their checkpoints
+    :type resume: bool
+
+    :returns: list of sampler() outputs, one per chain
+    :rtype: list
+    '''
+    chains = [(seed + k, args, chain_kwargs(kwargs, k, n_chains), resume) for k in range(n_chains)]
+    if n_chains == 1:
+        return [run_chain(chains[0])]
+
+    if processes is None:
+        processes = min(n_chains, multiprocessing.cpu_count())
+    if kwargs.get('checkpoint_path') is None:
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(run_chain, chains, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+        return results
+
+    termination = multiprocessing.Event()
+    pool = multiprocessing.Pool(processes, init_worker, (termination,))
+
+    def forward_termination(signum, frame):
+        '''Signal handler: stop the running chains after their current iteration and start no other.'''
+        termination.set()
+        for process in multiprocessing.active_children():
+            try:
+                os.kill(process.pid, signal.SIGTERM)
+            except OSError: # exited meanwhile
+                pass
+
+    previous_handler = signal.signal(signal.SIGTERM, forward_termination)
+    try:
+        # waiting with a timeout, unlike pool.map, lets the signal handler run
+        results = pool.map_async(run_chain, chains, chunksize=1).get(_MAX_WAIT)
+    except core.SamplingTerminated:
+        # a chain that received SIGTERM itself stops the others
+        forward_termination(signal.SIGTERM, None)
+        raise
+    finally:
+        pool.close()
+        pool.join()
+        signal.signal(signal.SIGTERM, previous_handler)
+    return results
+
+def init_worker(termination):
+    '''
+    Pool initializer: share the termination event, and set it on SIGTERM received
+    between chains (while a chain runs, the sampler handles SIGTERM itself).
+
+    :param termination: event set once the chains are to terminate
+    :type termination: multiprocessing.Event
+    '''
+    global _termination
+    _termination = termination
+    signal.signal(signal.SIGTERM, lambda signum, frame: termination.set())
+
+#############################################################################################
+
+def chain_kwargs(kwargs, k, n_chains):
+    '''Give chain k its own checkpoint and spill files if several chains are run.'''
+    kwargs = dict(kwargs)
+    if n_chains > 1 and kwargs.get('checkpoint_path') is not None:
+        root, ext = os.path.splitext(kwargs['checkpoint_path'])
+        kwargs['checkpoint_path'] = '%s_chain%s%s'%(root, k, ext)
+    if n_chains > 1 and kwargs.get('spill_path_prefix') is not None:
+        kwargs['spill_path_prefix'] = '%s_chain%s'%(kwargs['spill_path_prefix'], k)
+    return kwargs
+
+#############################################################################################
+
+def merge_chains(results, spill_path=None):
+    '''
+    Merge the posterior samples of several chains into one posterior. The sampled
+    clusterings of several chains are copied to a new trace, leaving those of the
+    chains, and their spill files, unchanged.
+
+    :param results: list of sampler() outputs, one per chain
+    :type results: list
+    :param spill_path: file to which the merged sampled clusterings of several chains are
+                       spilled, or None to keep them in memory (see trace.clustering_trace)
+    :type spill_path: str
+
+    :returns: (S, all_clusterings, sampled_clusterings, log_likelihoods, iter_num):
+        S: merged posterior similarity matrix
+        all_clusterings: clusterings of all iterations of the first chain
+        sampled_clusterings: sampled clusterings of all chains, chain by chain
+        log_likelihoods: log likelihoods of sampled clusterings of all chains, chain by chain
+        iter_num: maximum iteration number at termination over chains
+    '''
+    S, all_clusterings, sampled_clusterings, log_likelihoods, iter_num = results[0]
+    log_likelihoods = list(log_likelihoods)
+    if len(results) > 1:
+        sampled_clusterings_0 = sampled_clusterings
+        sampled_clusterings = clustering_trace(sampled_clusterings_0.n_genes, chunk=sampled_clusterings_0.chunk, spill_path=spill_path)
+        sampled_clusterings.extend(sampled_clusterings_0)
+    for S_k, _, sampled_clusterings_k, log_likelihoods_k, iter_num_k in results[1:]:
+        S.merge(S_k)
+        sampled_clusterings.extend(sampled_clusterings_k)
+        log_likelihoods.extend(log_likelihoods_k)
+        iter_num = max(iter_num, iter_num_k)
+
+    return S, all_clusterings, sampled_clusterings, log_likelihoods, iter_num
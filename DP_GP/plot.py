@@ -191,7 +191,7 @@ def plot_cluster_sizes_over_iterations(all_clusterings, burnIn_phaseI, burnIn_ph
     is indicated with a vertical line.
     
     :param all_clusterings: all_clusterings[i,j] is the cluster to which gene j belongs at iteration i
-    :type all_clusterings: numpy array of ints
+    :type all_clusterings: clustering_trace (read chunk by chunk) or numpy array of ints
     :param burnIn_phaseI: iteration at which first burn-in phase ends
     :type burnIn_phaseI: int
     :param burnIn_phaseII: iteration at which second burn-in phase ends
@@ -206,26 +206,21 @@ def plot_cluster_sizes_over_iterations(all_clusterings, burnIn_phaseI, burnIn_ph
     :rtype: None (output is saved to file(s))
     
     '''
-    # strip off "header" of array, which is a vector of gene names
-    gene_names = all_clusterings[0,:]
-    # now, array only contains the cluster number for each iteration (row) for each gene (col)
-    all_clusterings = all_clusterings[1:,:].astype('int')
+    chunks = all_clusterings.iter_chunks() if hasattr(all_clusterings, 'iter_chunks') else [np.asarray(all_clusterings)]
     
-    highest_cluster_number = np.max(all_clusterings) - m
-    all_clusterIDs = list(set(np.unique(all_clusterings)) - set(range(m)))
+    # find the size of each cluster over iterations, one chunk of iterations at a time
+    cluster_size_over_iterations = {}
+    for clusterings in chunks:
+        for labels in clusterings:
+            cluster_size_over_iterations[len(cluster_size_over_iterations)] = collections.Counter(labels.tolist())
     
     # for each cluster and across all iterations, find the maximum size that cluster attained
-    max_num_genes_per_cluster = {}
-    for clusterID in all_clusterIDs:
-        GSiters, genes = np.where(all_clusterings == clusterID)
-        counts = collections.Counter(GSiters)
-        [(GSiter, number)] = counts.most_common(1)
-        max_num_genes_per_cluster[clusterID] = number
-    
-    # find the size of each cluster over iterations
-    cluster_size_over_iterations = {}
-    for iter_num in range(len(all_clusterings)):
-        cluster_size_over_iterations[iter_num] = collections.Counter(all_clusterings[iter_num,:])
+    max_num_genes_per_cluster = collections.defaultdict(int)
+    for sizes in cluster_size_over_iterations.itervalues():
+        for clusterID, number in sizes.iteritems():
+            if clusterID >= m:
+                max_num_genes_per_cluster[clusterID] = max(max_num_genes_per_cluster[clusterID], number)
+    all_clusterIDs = sorted(max_num_genes_per_cluster)
     
     total_height = sum(max_num_genes_per_cluster.values())
     # height will decrement through the plotting of clusters
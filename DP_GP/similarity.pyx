@@ -0,0 +1,464 @@
+import cython
+import numpy as np
+cimport numpy as np
+np.import_array()
+import pandas as pd
+
+#############################################################################################
+#
+#    Routines for accumulating gene-by-gene co-clustering counts from cluster labels
+#
+#############################################################################################
+
+ctypedef fused count_t:
+    np.uint16_t
+    np.uint32_t
+
+ctypedef fused similarity_t:
+    np.uint16_t
+    np.uint32_t
+    double
+
+ctypedef fused partition_t:
+    np.uint8_t
+    np.uint16_t
+    np.uint32_t
+
+def label_runs(labels):
+    '''
+    Group genes by cluster label.
+
+    :param labels: cluster label of each gene
+    :type labels: numpy array of ints
+
+    :returns: (order, starts, ends):
+        order: gene indices sorted by label (ascending gene index within a label)
+        :type order: numpy array of ints
+        starts, ends: order[starts[k]:ends[k]] are the genes of the kth label
+        :type starts, ends: numpy arrays of ints
+    '''
+    order = np.argsort(labels, kind='mergesort').astype(np.intp)
+    sorted_labels = np.asarray(labels)[order]
+    starts = np.flatnonzero(np.r_[True, sorted_labels[1:] != sorted_labels[:-1]]).astype(np.intp)
+    ends = np.r_[starts[1:], len(order)].astype(np.intp)
+    return order, starts, ends
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def add_co_clustering_counts(count_t[:,:] counts, np.intp_t[:] order, np.intp_t[:] starts, np.intp_t[:] ends):
+    '''
+    Add one sample to a gene-by-gene co-clustering count matrix, visiting only the
+    within-cluster blocks given by label_runs (no N x N temporary is created).
+
+    :param counts: counts[i,j] = # samples gene i in cluster with gene j
+    :type counts: numpy array of uint16 or uint32 of dimension N by N
+    '''
+    cdef Py_ssize_t k, p, q
+    with nogil:
+        for k in range(starts.shape[0]):
+            for p in range(starts[k], ends[k]):
+                for q in range(starts[k], ends[k]):
+                    counts[order[p], order[q]] += 1
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def within_block_sum(similarity_t[:,:] S, np.intp_t[:] order, np.intp_t[:] starts, np.intp_t[:] ends):
+    '''
+    Sum a (count or similarity) matrix over the within-cluster blocks given by label_runs,
+    including the diagonal.
+
+    :param S: co-clustering counts or posterior similarities
+    :type S: numpy array of uint16, uint32 or floats of dimension N by N
+
+    :rtype: float
+    '''
+    cdef Py_ssize_t k, p, q, i
+    cdef double total = 0
+    with nogil:
+        for k in range(starts.shape[0]):
+            for p in range(starts[k], ends[k]):
+                i = order[p]
+                for q in range(starts[k], ends[k]):
+                    total += S[i, order[q]]
+    return total
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def partition_within_block_sum(partition_t[:,:] samples, np.intp_t[:] order, np.intp_t[:] starts, np.intp_t[:] ends):
+    '''
+    Sum the co-clustering counts of sampled partitions over the within-cluster blocks
+    given by label_runs (including the diagonal), without forming any counts: for each
+    sample and block, the number of pairs of block members that share a sampled label
+    is the sum of squared label frequencies within the block.
+
+    :param samples: compact labels (0 to N - 1) of each sample, one row per sample
+    :type samples: numpy array of uint8, uint16 or uint32 of dimension (# samples) by N
+
+    :rtype: float
+    '''
+    cdef Py_ssize_t s, k, p
+    cdef double total = 0
+    frequencies = np.zeros(samples.shape[1] + 1, dtype=np.intp)
+    cdef np.intp_t[::1] n = frequencies
+    with nogil:
+        for s in range(samples.shape[0]):
+            for k in range(starts.shape[0]):
+                # adding the mth member with a label adds m^2 - (m - 1)^2 = 2m - 1 pairs
+                for p in range(starts[k], ends[k]):
+                    n[samples[s, order[p]]] += 1
+                    total += 2 * n[samples[s, order[p]]] - 1
+                for p in range(starts[k], ends[k]):
+                    n[samples[s, order[p]]] = 0
+    return total
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def add_co_clustered_columns(double[:,:] S, np.intp_t[:] genes, np.intp_t[:] column_index, partition_t[:] labels, 
+                             partition_t[:] order, partition_t[:] ends):
+    '''
+    Add one sampled partition to rows of the co-clustering count matrix, S[r, column_index[j]] += 1 
+    for every gene j in the cluster of gene genes[r] (and column_index[j] >= 0), visiting only the 
+    clusters of the given genes.
+
+    :param labels: compact labels (0 to K - 1, all present) of the sample
+    :param order, ends: runs of labels (see partition_similarity.sample_runs), i.e. the genes of
+                        label k are order[ends[k - 1]:ends[k]], from order[0] for k = 0
+    '''
+    cdef Py_ssize_t r, p, k, column
+    with nogil:
+        for r in range(genes.shape[0]):
+            k = labels[genes[r]]
+            for p in range(ends[k - 1] if k > 0 else 0, ends[k]):
+                column = column_index[order[p]]
+                if column >= 0:
+                    S[r, column] += 1
+
+def co_clustered_before_and_after(order, starts, ends):
+    '''
+    For each gene i, count the genes in the same cluster with a lower (j < i)
+    and a higher (j > i) index, i.e. the row sums of the strict lower and upper
+    triangles of the co-clustering indicator matrix.
+
+    :returns: (before, after)
+    :rtype: tuple of numpy arrays of ints
+    '''
+    before = np.empty(len(order), dtype=np.intp)
+    after = np.empty(len(order), dtype=np.intp)
+    position = np.arange(len(order)) - np.repeat(starts, ends - starts)
+    before[order] = position
+    after[order] = np.repeat(ends - starts, ends - starts) - 1 - position
+    return before, after
+
+#############################################################################################
+#
+#    Posterior similarity matrix backends
+#
+#    All backends provide the same interface to the posterior similarity matrix
+#    S[i,j] = (# samples gene i in cluster with gene j)/(# total samples):
+#        n_genes, rows(genes), block(genes), block_sum(order, starts, ends), 
+#        to_dense(), dense_nbytes()
+#    and the sampling backends additionally record samples with add(labels)
+#    and combine the samples of several chains with merge(other).
+#    share_similarity and load_similarity pass a backend to other processes.
+#
+#############################################################################################
+
+class dense_similarity(object):
+    '''
+    Posterior similarity matrix kept as a dense N x N matrix of integer co-clustering
+    counts, in the smallest unsigned integer type that holds the maximum number of samples.
+
+    :param n_genes: number of genes
+    :type n_genes: int
+    :param max_samples: maximum number of samples that will be added
+    :type max_samples: int
+    '''
+    backend = 'dense'
+
+    def __init__(self, n_genes, max_samples):
+        self.n_genes = n_genes
+        self.num_samples = 0
+        self.counts = np.zeros((n_genes, n_genes), dtype=count_dtype(max_samples))
+
+    def add(self, labels, runs=None):
+        '''
+        Add the clustering of one sample.
+
+        :param labels: cluster label of each gene
+        :type labels: numpy array of ints
+        :param runs: output of label_runs(labels), if already available
+        :type runs: tuple
+        '''
+        order, starts, ends = label_runs(labels) if runs is None else runs
+        add_co_clustering_counts(self.counts, order, starts, ends)
+        self.num_samples += 1
+
+    def merge(self, other):
+        '''
+        Add the samples of another dense_similarity of the same genes, e.g. of another chain.
+
+        :type other: dense_similarity
+        '''
+        self.counts = self.counts.astype(count_dtype(self.num_samples + other.num_samples), copy=False)
+        self.counts += other.counts
+        self.num_samples += other.num_samples
+
+    def rows(self, genes):
+        '''Return S[genes,:] as floats.'''
+        return self.counts[genes,:] / float(max(self.num_samples, 1))
+
+    def block(self, genes):
+        '''Return S[genes,genes] as floats.'''
+        return self.counts[np.ix_(genes, genes)] / float(max(self.num_samples, 1))
+
+    def block_sum(self, order, starts, ends):
+        '''Return the sum of S over the within-cluster blocks of a clustering, given by label_runs.'''
+        if self.num_samples == 0:
+            return float(len(order))
+        return within_block_sum(self.counts, order, starts, ends) / float(self.num_samples)
+
+    def to_dense(self):
+        '''Return S as a dense float matrix.'''
+        if self.num_samples == 0:
+            return np.eye(self.n_genes)
+        return self.counts / float(self.num_samples)
+
+    def dense_nbytes(self):
+        '''Return the number of bytes needed by to_dense().'''
+        return 8 * self.n_genes**2
+
+class partition_similarity(object):
+    '''
+    Posterior similarity matrix kept implicitly as the list of sampled partitions.
+    Each sample is stored as compact, consecutive labels (in chunks of preallocated rows)
+    and rows of S are materialized on demand, so that memory grows as
+    (# samples) x N instead of N x N.
+
+    :param n_genes: number of genes
+    :type n_genes: int
+    :param chunk: number of samples by which storage grows
+    :type chunk: int
+    '''
+    backend = 'partition'
+    # runs of the labels of the samples, computed on demand (see sample_runs)
+    runs = None
+
+    def __init__(self, n_genes, chunk=64):
+        self.n_genes = n_genes
+        self.num_samples = 0
+        self.chunk = chunk
+        # labels, and positions in the runs of labels, range up to n_genes
+        self.labels = np.zeros((0, n_genes), dtype=np.min_scalar_type(n_genes))
+
+    def add(self, labels, runs=None):
+        '''
+        Add the clustering of one sample.
+
+        :param labels: cluster label of each gene
+        :type labels: numpy array of ints
+        '''
+        if self.num_samples == len(self.labels):
+            self.labels = np.vstack((self.labels, np.zeros((self.chunk, self.n_genes), dtype=self.labels.dtype)))
+        self.labels[self.num_samples] = np.unique(labels, return_inverse=True)[1]
+        self.num_samples += 1
+
+    def merge(self, other):
+        '''
+        Add the samples of another partition_similarity of the same genes, e.g. of another chain.
+
+        :type other: partition_similarity
+        '''
+        self.labels = np.vstack((self.samples(), other.samples()))
+        self.num_samples += other.num_samples
+
+    def samples(self):
+        '''Return the stored partitions, one row per sample.'''
+        return self.labels[:self.num_samples]
+
+    def sample_runs(self):
+        '''
+        Group the genes of each stored sample by label, sorting only the samples added since 
+        the last call.
+
+        :returns: (orders, ends): the genes of label k of sample s are 
+                  orders[s, ends[s, k - 1]:ends[s, k]], from orders[s, 0] for k = 0
+        :rtype: tuple of numpy arrays of dimension (# samples) by N, of the type of the labels
+        '''
+        if self.runs is None:
+            self.runs = (np.zeros((0, self.n_genes), dtype=self.labels.dtype), np.zeros((0, self.n_genes), dtype=self.labels.dtype))
+        orders, ends = self.runs
+        if len(orders) < self.num_samples:
+            added = self.samples()[len(orders):]
+            added_ends = np.cumsum([np.bincount(labels, minlength=self.n_genes) for labels in added], axis=1)
+            self.runs = (np.vstack((orders, np.argsort(added, axis=1, kind='mergesort').astype(orders.dtype))), 
+                         np.vstack((ends, added_ends.astype(ends.dtype))))
+        return self.runs
+
+    def rows(self, genes):
+        '''Return S[genes,:] as floats.'''
+        return self._co_clustering(genes, slice(None))
+
+    def block(self, genes):
+        '''Return S[genes,genes] as floats.'''
+        return self._co_clustering(genes, genes)
+
+    def block_sum(self, order, starts, ends):
+        '''Return the sum of S over the within-cluster blocks of a clustering, given by label_runs.'''
+        if self.num_samples == 0:
+            return float(len(order))
+        return partition_within_block_sum(self.samples(), order, starts, ends) / float(self.num_samples)
+
+    def _co_clustering(self, genes, columns):
+        genes = np.atleast_1d(genes).astype(np.intp)
+        columns = np.arange(self.n_genes)[columns]
+        if self.num_samples == 0:
+            return (genes[:,np.newaxis] == columns).astype(float)
+        # position of each gene among the columns, or -1
+        column_index = np.full(self.n_genes, -1, dtype=np.intp)
+        column_index[columns] = np.arange(len(columns))
+        S = np.zeros((len(genes), len(columns)))
+        orders, ends = self.sample_runs()
+        for s, labels in enumerate(self.samples()):
+            add_co_clustered_columns(S, genes, column_index, labels, orders[s], ends[s])
+        return S / float(self.num_samples)
+
+    def to_dense(self):
+        '''Return S as a dense float matrix.'''
+        return self.rows(np.arange(self.n_genes))
+
+    def dense_nbytes(self):
+        '''Return the number of bytes needed by to_dense().'''
+        return 8 * self.n_genes**2
+
+class matrix_similarity(object):
+    '''
+    Posterior similarity matrix that has already been computed, e.g. read from
+    a "_posterior_similarity_matrix.txt" file.
+
+    :param sim_mat: sim_mat[i,j] = (# samples gene i in cluster with gene j)/(# total samples)
+    :type sim_mat: numpy array of (0-1) floats
+    '''
+    backend = 'matrix'
+
+    def __init__(self, sim_mat):
+        self.sim_mat = np.asarray(sim_mat, dtype=float)
+        self.n_genes = self.sim_mat.shape[0]
+
+    def rows(self, genes):
+        '''Return S[genes,:] as floats.'''
+        return self.sim_mat[genes,:]
+
+    def block(self, genes):
+        '''Return S[genes,genes] as floats.'''
+        return self.sim_mat[np.ix_(genes, genes)]
+
+    def block_sum(self, order, starts, ends):
+        '''Return the sum of S over the within-cluster blocks of a clustering, given by label_runs.'''
+        return within_block_sum(self.sim_mat, order, starts, ends)
+
+    def to_dense(self):
+        '''Return S as a dense float matrix.'''
+        return self.sim_mat
+
+    def dense_nbytes(self):
+        '''Return the number of bytes needed by to_dense().'''
+        return 0
+
+def count_dtype(max_samples):
+    '''Smallest unsigned integer type for co-clustering counts of up to max_samples samples.'''
+    return np.uint16 if max_samples < np.iinfo(np.uint16).max else np.uint32
+
+def similarity_backend(n_genes, max_samples, backend='auto', memory_budget=4e9):
+    '''
+    Create an empty posterior similarity matrix backend for sampling. With backend='auto',
+    the dense count matrix is used if it fits into the memory budget, otherwise the
+    partition list is used.
+
+    :param n_genes: number of genes
+    :type n_genes: int
+    :param max_samples: maximum number of samples that will be added
+    :type max_samples: int
+    :param backend: 'auto', 'dense' or 'partition'
+    :type backend: str
+    :param memory_budget: memory (in bytes) available to the posterior similarity matrix
+    :type memory_budget: float
+
+    :rtype: dense_similarity or partition_similarity
+    '''
+    if backend == 'auto':
+        dense_nbytes = n_genes**2 * np.dtype(count_dtype(max_samples)).itemsize
+        backend = 'dense' if dense_nbytes <= memory_budget else 'partition'
+    if backend == 'dense':
+        return dense_similarity(n_genes, max_samples)
+    elif backend == 'partition':
+        return partition_similarity(n_genes)
+    else:
+        raise ValueError("unknown posterior similarity matrix backend: %s"%(backend))
+
+def as_similarity(sim_mat):
+    '''Wrap a precomputed posterior similarity matrix, leave backends as they are.'''
+    if hasattr(sim_mat, 'block'):
+        return sim_mat
+    return matrix_similarity(sim_mat)
+
+# attribute holding the data of each backend
+_BACKEND_DATA = {'dense':(dense_similarity, 'counts'), 'partition':(partition_similarity, 'labels'), 'matrix':(matrix_similarity, 'sim_mat')}
+
+def share_similarity(sim, path):
+    '''
+    Write the data of a posterior similarity matrix backend, in its own (e.g. integer count)
+    representation, to a .npy file, from which load_similarity memory-maps the backend in
+    another process.
+
+    :param sim: posterior similarity matrix
+    :type sim: numpy array or posterior similarity matrix backend
+    :param path: .npy file
+    :type path: str
+
+    :returns: picklable handle of the backend
+    :rtype: tuple
+    '''
+    sim = as_similarity(sim)
+    cls, data = _BACKEND_DATA[sim.backend]
+    attributes = dict(sim.__dict__)
+    del attributes[data]
+    # cached runs of partitions are recomputed where needed
+    attributes.pop('runs', None)
+    np.save(path, sim.samples() if sim.backend == 'partition' else getattr(sim, data))
+    return sim.backend, path, attributes
+
+def load_similarity(handle):
+    '''
+    Memory-map a posterior similarity matrix backend written by share_similarity.
+
+    :param handle: output of share_similarity
+    :type handle: tuple
+
+    :rtype: dense_similarity, partition_similarity or matrix_similarity
+    '''
+    backend, path, attributes = handle
+    cls, data = _BACKEND_DATA[backend]
+    sim = cls.__new__(cls)
+    sim.__dict__.update(attributes)
+    # copy-on-write, because typed memoryviews require a writable buffer
+    setattr(sim, data, np.load(path, mmap_mode='c'))
+    return sim
+
+def save_similarity_matrix(sim, gene_names, output, chunk=1000):
+    '''
+    Write a posterior similarity matrix as a tab-separated table, streaming
+    chunks of rows so that the full matrix is never materialized.
+
+    :param sim: posterior similarity matrix
+    :type sim: numpy array or posterior similarity matrix backend
+    :param gene_names: list of gene names
+    :type gene_names: list
+    :param output: absolute path to output
+    :type output: str
+    '''
+    sim = as_similarity(sim)
+    gene_names = list(gene_names)
+    with open(output, 'w') as handle:
+        for start in range(0, sim.n_genes, chunk):
+            genes = np.arange(start, min(start + chunk, sim.n_genes))
+            pd.DataFrame(sim.rows(genes), index=gene_names[start:start + chunk], columns=gene_names).to_csv(handle, sep='\t', header=(start == 0))
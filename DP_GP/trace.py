@@ -0,0 +1,123 @@
+'''
+Append-only storage of clusterings over Gibbs sampling iterations.
+'''
+import os
+import numpy as np
+
+#############################################################################################
+#
+#    Clustering trace
+#
+#############################################################################################
+
+class clustering_trace(object):
+    '''
+    Append-only trace of clusterings (one row of cluster labels per iteration or sample).
+    Rows are kept in preallocated chunks in the smallest unsigned integer type that holds
+    the labels (widened if a larger label is appended). Optionally, full chunks are
+    spilled to a file, so that memory use does not grow with the number of rows.
+
+    Like the pandas dataframe it replaces, the trace has "columns" (gene names, by default
+    gene indices) and converts to a numpy array of dimension rows by genes.
+
+    :param n_genes: number of genes
+    :type n_genes: int
+    :param max_label: largest cluster label expected
+    :type max_label: int
+    :param chunk: number of rows per chunk
+    :type chunk: int
+    :param spill_path: file to which full chunks are written, or None to keep them in memory
+    :type spill_path: str
+    '''
+    def __init__(self, n_genes, max_label=255, chunk=256, spill_path=None):
+        self.n_genes = n_genes
+        self.columns = np.arange(n_genes)
+        self.chunk = chunk
+        self.spill_path = spill_path
+        self.spill_size = 0
+        self.n_rows = 0
+        # chunks are (rows, None) if kept in memory, or (number of rows, (dtype, offset)) if spilled
+        self.chunks = []
+        self.current = np.empty((chunk, n_genes), dtype=np.min_scalar_type(max_label))
+        self.n_current = 0
+
+    def __len__(self):
+        return self.n_rows
+
+    def __array__(self, dtype=None):
+        clusterings = self.to_array()
+        return clusterings if dtype is None else clusterings.astype(dtype)
+
+    def append(self, labels):
+        '''
+        Append one clustering.
+
+        :param labels: cluster label of each gene
+        :type labels: numpy array of ints
+        '''
+        if labels.max() > np.iinfo(self.current.dtype).max:
+            self.current = self.current.astype(np.min_scalar_type(labels.max()))
+        self.current[self.n_current] = labels
+        self.n_current += 1
+        self.n_rows += 1
+        if self.n_current == self.chunk:
+            self.flush()
+
+    def extend(self, other):
+        '''Append all clusterings of another trace, e.g. of another chain.'''
+        for clusterings in other.iter_chunks():
+            for labels in clusterings:
+                self.append(labels)
+
+    def flush(self):
+        '''Close the current chunk, spilling it to file if a spill path is given.'''
+        if self.n_current == 0:
+            return
+        rows = self.current[:self.n_current]
+        if self.spill_path is None:
+            self.chunks.append((rows, None))
+        else:
+            # write at the recorded end of the trace, rather than at the end of the file,
+            # in case the file holds chunks of an interrupted run that resumed from a checkpoint
+            with open(self.spill_path, 'r+b' if os.path.exists(self.spill_path) else 'wb') as f:
+                f.seek(self.spill_size)
+                f.write(rows.tobytes())
+                f.truncate()
+            self.chunks.append((rows.shape[0], (rows.dtype.str, self.spill_size)))
+            self.spill_size += rows.nbytes
+        self.current = np.empty((self.chunk, self.n_genes), dtype=self.current.dtype)
+        self.n_current = 0
+
+    def iter_chunks(self):
+        '''
+        Iterate over the trace chunk by chunk.
+
+        :returns: generator of numpy arrays of ints of dimension rows by genes
+        '''
+        for rows, spilled in self.chunks:
+            if spilled is None:
+                yield rows
+            else:
+                dtype, offset = spilled
+                with open(self.spill_path, 'rb') as f:
+                    f.seek(offset)
+                    yield np.fromfile(f, dtype=dtype, count=rows * self.n_genes).reshape(rows, self.n_genes)
+        if self.n_current > 0:
+            yield self.current[:self.n_current]
+
+    def to_array(self):
+        '''Return all clusterings as one numpy array of dimension rows by genes.'''
+        chunks = [rows.astype(np.int64) for rows in self.iter_chunks()]
+        return np.vstack(chunks) if len(chunks) > 0 else np.zeros((0, self.n_genes), dtype=np.int64)
+
+    def save(self, output):
+        '''
+        Write the trace as a tab-separated table with "columns" as header, chunk by chunk.
+
+        :param output: absolute path to output
+        :type output: str
+        '''
+        with open(output, 'w') as f:
+            f.write('\t'.join([str(name) for name in self.columns]) + '\n')
+            for rows in self.iter_chunks():
+                np.savetxt(f, rows, fmt='%d', delimiter='\t')
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+'''
+Benchmark the factorization of cluster covariance matrices ("refresh") and the
+likelihoods of many genes under all clusters, eigendecomposition vs. Cholesky.
+
+Usage (from the repository root, after building the extensions in place):
+
+    python setup.py build_ext --inplace
+    python benchmarks/benchmark_factorization.py [--T 10 20 40] [--clusters 300] [--genes 5000] [--repeats 5]
+'''
+import argparse
+import time
+import numpy as np
+import GPy
+from DP_GP import core
+
+parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument("--T", type=int, nargs='+', default=[10, 20, 40], help="numbers of time points")
+parser.add_argument("--clusters", type=int, default=300, help="number of clusters scored per gene")
+parser.add_argument("--genes", type=int, default=5000, help="number of genes scored")
+parser.add_argument("--repeats", type=int, default=5, help="repeats, best time is reported")
+args = parser.parse_args()
+
+def best_time(f, repeats):
+    times = []
+    for r in range(repeats):
+        start = time.time()
+        f()
+        times.append(time.time() - start)
+    return min(times)
+
+np.random.seed(1234)
+print "%4s  %-28s  %12s  %12s  %8s"%("T", "operation", "eigh (s)", "cholesky (s)", "speed-up")
+for T in args.T:
+
+    # predictive covariance matrices of clusters with random hyperparameters
+    t = np.vstack(np.arange(T, dtype=float))
+    covs = []
+    for c in range(args.clusters):
+        kernel = GPy.kern.RBF(input_dim=1, variance=np.exp(np.random.randn()), lengthscale=np.exp(np.random.randn())) + \
+                 GPy.kern.Linear(input_dim=1, variances=0.001) + \
+                 GPy.kern.Bias(input_dim=1, variance=0.001)
+        covs.append(kernel.K(t) + 0.1 * np.eye(T))
+
+    clusters = {}
+    for factorization in ['eigh', 'cholesky']:
+        clusters[factorization] = [core.dp_cluster(members=[], X=t, factorization=factorization) for c in range(args.clusters)]
+        for cluster, cov in zip(clusters[factorization], covs):
+            cluster.covK = cov
+
+    # refresh: factorize all covariance matrices
+    refresh = {}
+    for factorization in ['eigh', 'cholesky']:
+        def f():
+            for cluster in clusters[factorization]:
+                cluster.update_rank_U_and_log_pdet()
+        refresh[factorization] = best_time(f, args.repeats)
+    print "%4s  %-28s  %12.4f  %12.4f  %7.1fx"%(T, "refresh %s factors"%(args.clusters), refresh['eigh'], refresh['cholesky'], refresh['eigh'] / refresh['cholesky'])
+
+    # likelihoods: score genes against all clusters, as in gibbs_sampler.cache_log_likelihoods, 
+    # by a stacked dense product with the eigh factors or by triangular solves with the Cholesky factors
+    genes = np.random.randn(args.genes, T)
+    means = np.random.randn(args.clusters, T)
+    factors = {}
+    for factorization in clusters:
+        factors[factorization] = [np.array(values) for values in zip(*[(cluster.factor, cluster.triangular, cluster.rank, cluster.log_pdet) 
+                                                                      for cluster in clusters[factorization]])]
+    LL = {}
+    def likelihoods(factorization):
+        def f():
+            LL[factorization] = core.log_likelihood_matrix(genes, means, *factors[factorization])
+        return f
+    quad = {factorization:best_time(likelihoods(factorization), args.repeats) for factorization in clusters}
+    print "%4s  %-28s  %12.4f  %12.4f  %7.1fx"%(T, "%s genes x %s clusters"%(args.genes, args.clusters), quad['eigh'], quad['cholesky'], quad['eigh'] / quad['cholesky'])
+
+    # both factorizations must give the same log-likelihoods
+    print "%4s  %-28s  %12.2e"%(T, "max |LL difference|", np.max(np.abs(LL['eigh'] - LL['cholesky'])))
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+'''
+Compare the native and GPy Gaussian process backends (see DP_GP.gp) on cluster
+hyperparameter fits: time per fit and agreement of the fitted hyperparameters,
+log marginal likelihoods and predictive means and covariances. The time per fit
+of the native_stats backend, and its largest difference from native in negative
+log-likelihood, are also reported.
+
+Usage (from the repository root, after building the extensions in place):
+
+    python setup.py build_ext --inplace
+    python benchmarks/benchmark_gp_backend.py [--T 10] [--sizes 1 5 20] [--clusters 20]
+'''
+import argparse
+import time
+import numpy as np
+from DP_GP import core
+from DP_GP import utils
+
+parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument("--T", type=int, default=10, help="number of time points")
+parser.add_argument("--sizes", type=int, nargs='+', default=[1, 5, 20], help="numbers of genes per cluster")
+parser.add_argument("--clusters", type=int, default=20, help="number of clusters fitted per size")
+parser.add_argument("--optimizer", type=str, default='lbfgsb', help="hyperparameter optimizer")
+parser.add_argument("--fast", action='store_true', help="fit genes as outputs sharing one kernel (--fast mode)")
+args = parser.parse_args()
+
+np.random.seed(1234)
+t = np.arange(args.T, dtype=float)
+X = np.vstack(t)
+
+print "%5s  %12s  %12s  %8s  %14s  %10s  %10s  %12s  %10s"%("size", "gpy (s/fit)", "native (s/fit)", "speed-up", "max rel. hyp.", "max |NLL|", "max |cov|", 
+                                                          "stats (s/fit)", "stats |NLL|")
+for size in args.sizes:
+    times = {'gpy':0., 'native':0., 'native_stats':0.}
+    max_hyperparameter_diff, max_NLL_diff, max_cov_diff, max_stats_NLL_diff = 0., 0., 0., 0.
+    for c in range(args.clusters):
+        # genes of a cluster: a smooth trajectory plus noise, mean-centered and scaled as by DP_GP_cluster.py
+        trajectory = np.sin(t / np.random.uniform(1, 4) + np.random.uniform(0, np.pi))
+        genes = trajectory + np.random.normal(0, np.random.uniform(0.1, 0.5), (size, args.T))
+        genes = (genes - genes.mean(axis=1)[:,np.newaxis]) / genes.std(axis=1)[:,np.newaxis]
+
+        clusters = {}
+        for backend in ['gpy', 'native', 'native_stats']:
+            with utils.suppress_stdout_stderr():
+                start = time.time()
+                cluster = core.dp_cluster(members=range(size), X=X, Y=genes.T, fast=args.fast, gp_backend=backend)
+                clusters[backend] = cluster.update_cluster_attributes(genes, optimizer=args.optimizer, fast=args.fast)
+                times[backend] += time.time() - start
+
+        hyperparameters = {backend:np.asarray(clusters[backend].model.param_array) for backend in clusters}
+        max_hyperparameter_diff = max(max_hyperparameter_diff, np.max(np.abs(hyperparameters['native'] - hyperparameters['gpy']) / hyperparameters['gpy']))
+        max_NLL_diff = max(max_NLL_diff, abs(clusters['native'].NLL_at_iters[-1] - clusters['gpy'].NLL_at_iters[-1]))
+        max_cov_diff = max(max_cov_diff, np.max(np.abs(clusters['native'].covK - clusters['gpy'].covK)))
+        max_stats_NLL_diff = max(max_stats_NLL_diff, abs(clusters['native_stats'].NLL_at_iters[-1] - clusters['native'].NLL_at_iters[-1]))
+
+    print "%5s  %12.4f  %12.4f  %7.1fx  %14.2e  %10.2e  %10.2e  %12.4f  %10.2e"%(size, times['gpy'] / args.clusters, times['native'] / args.clusters,
+                                                                                times['gpy'] / times['native'], max_hyperparameter_diff, max_NLL_diff, max_cov_diff, 
+                                                                                times['native_stats'] / args.clusters, max_stats_NLL_diff)
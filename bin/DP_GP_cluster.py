@@ -25,6 +25,11 @@ from DP_GP import plot
 from DP_GP import utils
 from DP_GP import core
 from DP_GP import cluster_tools
+from DP_GP import similarity
+from DP_GP import parallel
+from DP_GP import diagnostics
+from DP_GP import gp
+from DP_GP import executors
 
 import pandas as pd
 import numpy as np
@@ -38,6 +43,8 @@ import time
 import copy
 import argparse
 import os
+import signal
+import sys
 
 ##############################################################################
 #
@@ -105,9 +112,23 @@ Cluster assignment over Gibbs Sampling iterations (after burn-in and thinning):
 Log likelihoods of sampled clusterings (after burn-in and thinning):
 /path/to/my_gene_clustering_results_log_likelihoods.txt
 
+Posterior frequencies of the distinct partitions among the sampled clusterings, from most 
+to least frequent (cols: frequency, count, number of clusters, cluster of each gene):
+/path/to/my_gene_clustering_results_partition_frequencies.txt
+
 tab-delimited file listing (col 1) optimal cluster number (col 2) gene name
 /path/to/output_path_prefix_optimal_clustering.txt
 
+Output files optionally generated (if --checkpoint_every > 0 or --resume; note suffices added):
+
+Checkpoint of the Gibbs sampler state (per chain, _checkpoint_chain0.pkl etc., if --chains > 1):
+/path/to/my_gene_clustering_results_checkpoint.pkl
+
+Output files optionally generated (if --chains > 1; note suffices added):
+
+Per-chain summaries and cross-chain R-hat of log likelihood and number of clusters:
+/path/to/my_gene_clustering_results_chain_diagnostics.txt
+
 Output files optionally generated (if --plot; note suffices added):
 
 Heatmap of posterior similarity matrix, to which complete-linkage hierarchical clustering
@@ -187,6 +208,15 @@ parser.add_argument("--check_convergence", action='store_true', \
                   help="""optional, [default=do not check for convergence but run until max iterations]   
 If --check_convergence, then check for convergence, else run until max iterations.
 
+""")
+parser.add_argument("--target_ess", dest="target_ess", type=float, default=0, \
+                  help="""optional, [default=0, i.e. converge by plateaus of the log likelihood
+and of the distance to the posterior similarity matrix]
+With --check_convergence, stop sampling once the effective sample sizes of the
+log likelihood, the number of clusters and the co-clustering of 1000 random
+gene pairs all reach target_ess. Quantities that stay constant, e.g. a settled
+number of clusters, are not waited for.
+
 """)
 parser.add_argument("--check_burnin_convergence", action='store_true', \
                   help="""optional, [default=do not check for burn-in convergence but
@@ -197,6 +227,130 @@ parser.add_argument("--sparse_regression", action='store_true', \
                   help="""optional, may be useful to run sparse regression
 for large data sets.
 
+""")
+parser.add_argument("--factorization", dest="factorization", type=str, default='cholesky', \
+                  help="""optional, [default=cholesky]
+Factorization of cluster covariance matrices for likelihood calculations,
+among "cholesky" and "eigh" where:
+
+cholesky = (jittered) Cholesky decomposition, eigendecomposition only 
+           for rank-deficient covariance matrices
+eigh = eigendecomposition and pseudo-determinant for all covariance matrices
+
+""")
+parser.add_argument("--gp_backend", dest="gp_backend", type=str, default='native', \
+                  help="""optional, [default=native]
+Implementation of Gaussian process regression used to fit cluster 
+hyperparameters, among "native", "native_stats" and "gpy" where:
+
+native = exact regression implemented with numpy/scipy (lbfgsb, fmin_tnc 
+         and simplex optimizers)
+native_stats = native, fitted exactly from per-time-point counts, means and
+               sums of squares of the cluster members, so that the cost of
+               a fit does not grow with cluster size (same as native with --fast)
+gpy = GPy models (required for --sparse_regression and the scg optimizer)
+
+""")
+parser.add_argument("--refit_threshold", dest="refit_threshold", type=float, default=0., \
+                  help="""optional, [default=0]
+Re-optimize the hyperparameters of a cluster only if at least this fraction
+of its members changed since its hyperparameters were last optimized. 
+Otherwise, hyperparameters are kept and only the cluster's predictive mean
+and covariance are updated. Re-optimization starts from the last optimized
+hyperparameters. The number of skipped re-optimizations (and an estimate of
+the time saved) is reported at the end of sampling.
+
+""")
+parser.add_argument("--fit_executor", dest="fit_executor", type=str, default='serial', \
+                  help="""optional, [default=serial]
+Run the hyperparameter optimizations of clusters (during sampling and for the
+optimal clusters) in parallel, largest cluster first, among "serial", 
+"thread" and "process" where:
+
+serial = one cluster after another
+thread = in a pool of threads (--fit_processes threads)
+process = in a pool of processes (--fit_processes processes); with --chains > 1,
+          threads are used instead, since chains already run in processes
+
+""")
+parser.add_argument("--fit_processes", dest="fit_processes", type=int, default=None, \
+                  help="""optional, [default=number of CPUs]
+Number of threads or processes used by --fit_executor.
+
+""")
+parser.add_argument("--split_merge", dest="split_merge", type=int, default=0, \
+                  help="""optional, [default=0]
+Number of split-merge Metropolis-Hastings moves after each Gibbs sampling
+sweep over genes. Each move proposes to split a cluster in two or to merge
+two clusters, which one-gene-at-a-time Gibbs sampling does only slowly.
+The moves are a heuristic to escape local modes: they are evaluated at the
+hyperparameters of one cluster and by marginal rather than predictive
+likelihoods, so they are exact only at fixed, shared hyperparameters.
+Acceptance rates are reported at the end of sampling. Not available with
+--fast.
+
+""")
+parser.add_argument("--chains", dest="chains", type=int, default=1, \
+                  help="""optional, [default=1]
+Number of independently seeded Gibbs sampling chains, run in parallel
+processes. Sampled clusterings and posterior similarity matrices of all chains
+are merged into one posterior, and the potential scale reduction factor (R-hat)
+of the log likelihood and the number of clusters across chains is reported.
+
+""")
+parser.add_argument("--seed", dest="seed", type=int, default=1234, \
+                  help="""optional, [default=1234]
+Random seed. Each Gibbs sampling chain draws from its own random number
+generator, seeded seed, seed + 1, ... for chains 0, 1, ..., so that runs with
+the same seed and arguments are reproducible. The landmark genes of h_clust_avg
+and h_clust_comp on large data are chosen by a generator seeded seed.
+
+""")
+parser.add_argument("--checkpoint_every", dest="checkpoint_every", type=int, default=0, \
+                  help="""optional, [default=0, i.e. only on SIGTERM if --resume]
+Write the complete state of the Gibbs sampler to
+/path/to/my_gene_clustering_results_checkpoint.pkl (one file per chain
+if --chains > 1) every checkpoint_every iterations. If checkpointing is
+enabled, SIGTERM writes a final checkpoint after the current iteration
+and exits (all chains, if --chains > 1).
+
+""")
+parser.add_argument("--resume", action='store_true', \
+                  help="""optional, [default=False] if --resume indicated, continue the
+Gibbs sampling chain(s) from the checkpoint(s) of a previous run with the same
+output path prefix and arguments.
+
+""")
+parser.add_argument("--spill_clusterings", action='store_true', \
+                  help="""optional, [default=False] if --spill_clusterings indicated, then
+clusterings over Gibbs sampling iterations are written to
+/path/to/my_gene_clustering_results_all_clusterings.bin and
+/path/to/my_gene_clustering_results_sampled_clusterings.bin (binary, per chain
+if --chains > 1) as sampling proceeds, instead of being kept in memory. With
+several chains, the merged samples of all chains are written to the latter.
+
+""")
+parser.add_argument("--sim_mat_backend", dest="sim_mat_backend", type=str, default='auto', \
+                  help="""optional, [default=auto]
+Specify how the posterior similarity matrix is stored during sampling,
+among "auto", "dense", and "partition" where:
+
+dense = gene-by-gene matrix of co-clustering counts (memory grows as N^2)
+partition = list of sampled clusterings, from which rows of the posterior
+            similarity matrix are computed when needed (memory grows as
+            N x number of samples)
+auto = dense if it fits into --sim_mat_memory, partition otherwise
+
+""")
+parser.add_argument("--sim_mat_memory", dest="sim_mat_memory", type=float, default=4., \
+                  help="""optional, [default=4]
+Memory (in GB) available to the posterior similarity matrix. Determines
+the backend if --sim_mat_backend auto, and the posterior similarity matrix
+heatmap is only plotted if the full matrix fits into this memory. With
+--criterion h_clust_avg or h_clust_comp, hierarchical clustering is
+approximated from a subset of genes if their distance matrix (N^2 / 2
+floats) does not fit into this memory.
+
 """)
 parser.add_argument("-c", "--criterion", dest="criterion", type=str, default='MAP', \
                   help="""optional, [default=MAP]
@@ -207,12 +361,32 @@ MAP = maximum a posteriori
 MPEAR = Posterior expected adjusted Rand (see Fritsch and Ickstadt 2009, DOI:10.1214/09-BA414) 
 least_squares = minimize squared distance between clustering and posterior similarity matrix 
 (see Dahl 2006, "Model-Based Clustering...")
-h_clust_avg = hierarchical clustering by average linkage
-h_clust_comp = hierarchical clustering by complete linkage
+h_clust_avg = hierarchical clustering by average linkage of 1 - posterior similarity,
+              cut at 0.5
+h_clust_comp = hierarchical clustering by complete linkage of 1 - posterior similarity,
+               cut at 0.5
 
 Or, you may cluster genes post-hoc according to a criterion not implemented here 
 using the "_posterior_similarity_matrix.txt" or "_clusterings.txt" file.
 
+""")
+parser.add_argument("--scoring_executor", dest="scoring_executor", type=str, default='serial', \
+                  help="""optional, [default=serial]
+Score the sampled clusterings for --criterion MPEAR or least_squares in
+parallel, among "serial", "thread" and "process" where:
+
+serial = one clustering after another
+thread = in a pool of threads (--scoring_processes threads) sharing the
+         posterior similarity matrix
+process = in a pool of processes (--scoring_processes processes), which
+          memory-map one copy of the data of the posterior similarity 
+          matrix backend (e.g. its co-clustering counts)
+
+""")
+parser.add_argument("--scoring_processes", dest="scoring_processes", type=int, default=None, \
+                  help="""optional, [default=number of CPUs]
+Number of threads or processes used by --scoring_executor.
+
 """)
 
 ##############################################################################
@@ -424,6 +598,37 @@ if args.criterion not in ["MAP", "MPEAR", "least_squares", "h_clust_avg", "h_clu
     raise ValueError("""incorrect criterion. Please choose from among the following options:
     MPEAR, MAP, least_squares, h_clust_avg, h_clust_comp""")
 
+if args.fit_executor not in executors.EXECUTORS:
+    raise ValueError("""incorrect fit_executor. Please choose from among the following options:
+    serial, thread, process""")
+
+if args.scoring_executor not in executors.EXECUTORS:
+    raise ValueError("""incorrect scoring_executor. Please choose from among the following options:
+    serial, thread, process""")
+
+# daemonic chain processes cannot start process pools of their own
+sampling_fit_executor = args.fit_executor
+if args.fit_executor == 'process' and args.chains > 1:
+    print "WARNING: with --chains > 1, hyperparameters are fitted with --fit_executor thread during sampling"
+    sampling_fit_executor = 'thread'
+
+if args.split_merge > 0 and args.fast:
+    print "WARNING: --split_merge is not available with --fast, no split-merge moves are made"
+
+if args.target_ess > 0 and not args.check_convergence:
+    print "WARNING: --target_ess is only used with --check_convergence, running until max iterations"
+
+if args.gp_backend not in gp.GP_BACKENDS:
+    raise ValueError("""incorrect gp_backend. Please choose from among the following options:
+    native, native_stats, gpy""")
+
+if args.gp_backend != 'gpy' and args.sparse_regression:
+    print "WARNING: --sparse_regression requires --gp_backend gpy, using GPy"
+    args.gp_backend = 'gpy'
+elif args.gp_backend != 'gpy' and args.optimizer not in ['lbfgsb', 'fmin_tnc', 'simplex']:
+    print "WARNING: the %s optimizer requires --gp_backend gpy, using GPy"%(args.optimizer)
+    args.gp_backend = 'gpy'
+
 #############################################################################################
 #
 #    Parse args for script's usage for post-processing.
@@ -453,15 +658,12 @@ if args.clusterings:
 if args.sim_mat:
     sim_mat = pd.read_csv(args.sim_mat, delim_whitespace=True, index_col=0)
     gene_names = list(sim_mat.columns)
-    sim_mat = np.array(sim_mat)
+    sim_mat = similarity.as_similarity(np.array(sim_mat))
 
 if args.log_likelihoods:
     with open(args.log_likelihoods, 'r') as f:
         log_likelihoods = [float(line.strip()) for line in f]
 
-# set random seed to make random calls reproducible
-np.random.seed(1234)
-
 #############################################################################################
 #
 #    Import gene expression (and estimate noise variance from data if replicates available)
@@ -508,13 +710,39 @@ sq_dist_eps, post_eps  = 0.01, 1e-5
 
 if not args.post_process:
     print "Begin sampling"
-    GS = core.gibbs_sampler(gene_expression_matrix,t, args.max_num_iterations, args.max_iters, \
-                            args.optimizer, burnIn_phaseI, burnIn_phaseII, args.alpha, args.m, \
-                            args.s, args.check_convergence, args.check_burnin_convergence, args.sparse_regression, args.fast, \
-                            sigma_n, sigma_n2_shape, sigma_n2_rate, \
-                            args.length_scale_mu, args.length_scale_sigma, args.sigma_f_mu, \
-                            args.sigma_f_sigma, sq_dist_eps, post_eps)
-    sim_mat, all_clusterings, sampled_clusterings, log_likelihoods, iter_num = GS.sampler()
+    # the memory budget of the posterior similarity matrix is shared by the chains
+    GS_args = (gene_expression_matrix,t, args.max_num_iterations, args.max_iters, \
+               args.optimizer, burnIn_phaseI, burnIn_phaseII, args.alpha, args.m, \
+               args.s, args.check_convergence, args.check_burnin_convergence, args.sparse_regression, args.fast, \
+               sigma_n, sigma_n2_shape, sigma_n2_rate, \
+               args.length_scale_mu, args.length_scale_sigma, args.sigma_f_mu, \
+               args.sigma_f_sigma, sq_dist_eps, post_eps, \
+               args.sim_mat_backend, args.sim_mat_memory * 1e9 / args.chains)
+    GS_kwargs = {'factorization':args.factorization, 'gp_backend':args.gp_backend, 
+                 'refit_threshold':args.refit_threshold, 
+                 'fit_executor':sampling_fit_executor, 'fit_processes':args.fit_processes, 
+                 'split_merge':args.split_merge, 'target_ess':args.target_ess}
+    if args.checkpoint_every > 0 or args.resume:
+        GS_kwargs.update({'checkpoint_path':args.output_path_prefix + "_checkpoint.pkl", 
+                          'checkpoint_every':args.checkpoint_every})
+    if args.spill_clusterings:
+        GS_kwargs['spill_path_prefix'] = args.output_path_prefix
+    try:
+        chains = parallel.sample_chains(args.chains, args.seed, GS_args, GS_kwargs, resume=args.resume)
+    except core.SamplingTerminated as terminated:
+        print "Gibbs sampling %s; continue with --resume."%(terminated)
+        sys.exit(128 + signal.SIGTERM)
+    
+    if args.chains > 1:
+        chain_summary, rhat = diagnostics.chain_diagnostics([chain[3] for chain in chains], [chain[2] for chain in chains])
+        print "Cross-chain diagnostics:"
+        print chain_summary
+        print "R-hat of log likelihood: %s, R-hat of number of clusters: %s"%(rhat['log_likelihood'], rhat['n_clusters'])
+        diagnostics.save_chain_diagnostics(chain_summary, rhat, args.output_path_prefix)
+    
+    merged_spill_path = args.output_path_prefix + "_sampled_clusterings.bin" if args.spill_clusterings else None
+    sim_mat, all_clusterings, sampled_clusterings, log_likelihoods, iter_num = parallel.merge_chains(chains, merged_spill_path)
+    del chains
     
     sampled_clusterings.columns = gene_names
     all_clusterings.columns = gene_names
@@ -528,16 +756,24 @@ else:
 ############################################################################################## 
 # Find an optimal "clusters" list, sorted by gene in order of "gene_names" object
 
-if args.criterion == 'MPEAR':
-    optimal_clusters = cluster_tools.best_clustering_by_mpear(np.array(sampled_clusterings), sim_mat)
+# distinct partitions among the sampled clusterings, which are scored once each
+if not args.post_process or args.clusterings:
+    partitions = cluster_tools.unique_clusterings(sampled_clusterings)
+    print "%s distinct partitions among %s sampled clusterings."%(len(partitions[1]), partitions[1].sum())
+
+if args.criterion == 'MPEAR' or args.criterion == 'least_squares':
+    scoring_executor = executors.executor(args.scoring_executor, args.scoring_processes)
+    if args.criterion == 'MPEAR':
+        optimal_clusters = cluster_tools.best_clustering_by_mpear(sampled_clusterings, sim_mat, scoring_executor, partitions)
+    else:
+        optimal_clusters = cluster_tools.best_clustering_by_sq_dist(sampled_clusterings, sim_mat, scoring_executor, partitions)
+    scoring_executor.close()
 elif args.criterion == 'MAP':
     optimal_clusters = cluster_tools.best_clustering_by_log_likelihood(np.array(sampled_clusterings), log_likelihoods)
-elif args.criterion == 'least_squares':
-    optimal_clusters = cluster_tools.best_clustering_by_sq_dist(np.array(sampled_clusterings), sim_mat)
 elif args.criterion == 'h_clust_avg':
-    optimal_clusters = cluster_tools.best_clustering_by_h_clust(sim_mat, 'average')
+    optimal_clusters = cluster_tools.best_clustering_by_h_clust(sim_mat, 'average', memory_budget=args.sim_mat_memory * 1e9, random_state=np.random.RandomState(args.seed))
 elif args.criterion == 'h_clust_comp':
-    optimal_clusters = cluster_tools.best_clustering_by_h_clust(sim_mat, 'complete')
+    optimal_clusters = cluster_tools.best_clustering_by_h_clust(sim_mat, 'complete', memory_budget=args.sim_mat_memory * 1e9, random_state=np.random.RandomState(args.seed))
 
 # Given an optimal clustering, optimize the hyperparameters once again
 # because (1) hyperparameters are re-written at every iteration and (2) the particular clustering
@@ -550,12 +786,18 @@ for gene, (gene_name, cluster) in enumerate(zip(gene_names, optimal_clusters)):
     optimal_cluster_labels_original_gene_names[cluster].append(gene_name)
 
 if args.cluster_uncertainty_estimate:
+    # only the within-cluster blocks of the posterior similarity matrix are needed,
+    # cluster_sim_mat[cluster][gene_i_k][gene_j_k] = sim_mat[gene_i_k,gene_j_k]
+    cluster_sim_mat = {}
+    for cluster, genes in optimal_cluster_labels.iteritems():
+        cluster_sim_mat[cluster] = {gene_i_k:dict(zip(genes, row)) for gene_i_k, row in zip(genes, sim_mat.block(genes))}
+    
     gene_to_prob = {}
     for gene_i_k, (gene_name, cluster) in enumerate(zip(gene_names, optimal_clusters)):
         genes_in_cluster = set(optimal_cluster_labels[cluster])
         genes_j_k = genes_in_cluster - set([gene_i_k])
         if len(genes_j_k) > 0:
-            gene_to_prob[gene_name] = sum([sim_mat[gene_i_k,gene_j_k] for gene_j_k in genes_j_k])/len(genes_j_k)
+            gene_to_prob[gene_name] = sum([cluster_sim_mat[cluster][gene_i_k][gene_j_k] for gene_j_k in genes_j_k])/len(genes_j_k)
         else:
             gene_to_prob[gene_name] = 1.
             
@@ -576,7 +818,7 @@ if args.cluster_uncertainty_estimate:
                     # the mean proportion of times gene co-clusters
                     # with every other gene in cluster
                     denominator = len(genes_j_k)
-                    gene_to_prob[gene_i_k] = sum([sim_mat[gene_i_k,gene_j_k] for gene_j_k in genes_j_k])/denominator
+                    gene_to_prob[gene_i_k] = sum([cluster_sim_mat[cluster][gene_i_k][gene_j_k] for gene_j_k in genes_j_k])/denominator
                 else:
                     # in subsequent loops, genes are weighted by how
                     # likely they are to belong to a cluster. In this way,
@@ -584,7 +826,7 @@ if args.cluster_uncertainty_estimate:
                     # depends less on a gene j that is unlikely to belong to cluster k
                     # and depends more on gene l that is likely to belong to cluster k
                     denominator = sum([last_gene_to_prob[gene_j_k] for gene_j_k in genes_j_k])
-                    gene_to_prob[gene_i_k] = sum([sim_mat[gene_i_k,gene_j_k] * last_gene_to_prob[gene_j_k] for gene_j_k in genes_j_k])/denominator
+                    gene_to_prob[gene_i_k] = sum([cluster_sim_mat[cluster][gene_i_k][gene_j_k] * last_gene_to_prob[gene_j_k] for gene_j_k in genes_j_k])/denominator
             else:
                 gene_to_prob[gene_i_k] = 1.
                 
@@ -620,17 +862,17 @@ for cluster, genes in optimal_cluster_labels.iteritems():
                                                    sigma_n=sigma_n, 
                                                    X=np.vstack(t), 
                                                    Y=np.array(np.mat(gene_expression_matrix[genes,:])).T, 
-                                                   iter_num_at_birth=iter_num)
-    optimal_clusters_GP[cluster] = optimal_clusters_GP[cluster].update_cluster_attributes(gene_expression_matrix, 
-                                                                                          sigma_n2_shape, 
-                                                                                          sigma_n2_rate, 
-                                                                                          args.length_scale_mu, 
-                                                                                          args.length_scale_sigma, 
-                                                                                          args.sigma_f_mu, 
-                                                                                          args.sigma_f_sigma, 
-                                                                                          iter_num, 
-                                                                                          args.max_iters, 
-                                                                                          args.optimizer)
+                                                   iter_num_at_birth=iter_num,
+                                                   factorization=args.factorization,
+                                                   gp_backend=args.gp_backend)
+
+executor = executors.executor(args.fit_executor, args.fit_processes)
+core.update_clusters(optimal_clusters_GP.values(), gene_expression_matrix, 
+                     (sigma_n2_shape, sigma_n2_rate, args.length_scale_mu, args.length_scale_sigma, 
+                      args.sigma_f_mu, args.sigma_f_sigma, args.max_iters, args.optimizer), iter_num, executor)
+executor.close()
+
+for cluster, genes in optimal_cluster_labels.iteritems():
     if args.save_residuals:
         for gene in genes:
             resids = ( gene_expression_matrix[gene,:] - optimal_clusters_GP[cluster].mean )**2
@@ -655,6 +897,10 @@ if not args.post_process:
     core.save_clusterings(sampled_clusterings, args.output_path_prefix)
     core.save_log_likelihoods(log_likelihoods, args.output_path_prefix)
 
+if not args.post_process or args.clusterings:
+    cluster_tools.save_partition_frequencies(partitions, gene_names, 
+                                             args.output_path_prefix + "_partition_frequencies.txt")
+
 if not args.cluster_uncertainty_estimate:
     cluster_tools.save_cluster_membership_information(optimal_cluster_labels_original_gene_names, 
                                                       args.output_path_prefix + "_optimal_clustering.txt")
@@ -673,15 +919,20 @@ else:
 if args.plot:
     print "Plotting expression and sampling results."    
     plot_types = args.plot_types
+    sim_mat_key = None
     if not args.post_process or args.sim_mat and not args.do_not_plot_sim_mat:
-        try:
-            sim_mat_key = plot.plot_similarity_matrix(sim_mat, args.output_path_prefix, plot_types)
-        except RuntimeError:
-            print "WARNING: skipping heatmap plot generation, too many dendrogram recursions for scipy to handle"
+        if sim_mat.dense_nbytes() > args.sim_mat_memory * 1e9:
+            print "WARNING: skipping heatmap plot generation, posterior similarity matrix does not fit into --sim_mat_memory"
+        else:
+            try:
+                sim_mat_key = plot.plot_similarity_matrix(sim_mat.to_dense(), args.output_path_prefix, plot_types)
+            except RuntimeError:
+                print "WARNING: skipping heatmap plot generation, too many dendrogram recursions for scipy to handle"
         
     if not args.post_process:    
-        core.save_posterior_similarity_matrix_key([gene_names[idx] for idx in sim_mat_key], args.output_path_prefix)
-        plot.plot_cluster_sizes_over_iterations(np.array(all_clusterings), burnIn_phaseI, burnIn_phaseII, args.m, args.output_path_prefix, plot_types)
+        if sim_mat_key is not None:
+            core.save_posterior_similarity_matrix_key([gene_names[idx] for idx in sim_mat_key], args.output_path_prefix)
+        plot.plot_cluster_sizes_over_iterations(all_clusterings, burnIn_phaseI, burnIn_phaseII, args.m, args.output_path_prefix, plot_types)
     
     plot.plot_cluster_gene_expression(optimal_clusters_GP, 
                                       pd.DataFrame(gene_expression_matrix, index=gene_names, columns=t),
@@ -701,5 +952,5 @@ if args.plot:
 
 if args.save_cluster_GPs:    
     param_df = pd.DataFrame({name:dp_cluster.model.param_array for name, dp_cluster in optimal_clusters_GP.iteritems()}) 
-    param_df.index = dp_cluster.model.parameter_names()
+    param_df.index = optimal_clusters_GP.values()[0].model.parameter_names()
     param_df.to_csv(args.output_path_prefix + "_cluster_model_params.txt", sep='\t', index=True, header=True)
\ No newline at end of file
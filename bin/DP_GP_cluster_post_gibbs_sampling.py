@@ -24,6 +24,8 @@ import matplotlib.pyplot as plt
 from DP_GP import utils
 from DP_GP import cluster_tools
 from DP_GP import core
+from DP_GP import gp
+from DP_GP import executors
 import pandas as pd
 import numpy as np
 import scipy
@@ -153,12 +155,31 @@ among "MPEAR", "MAP", "least_squares", "h_clust_avg", and "h_clust_comp" where:
 
 MPEAR = Posterior expected adjusted Rand (see Fritsch and Ickstadt 2009, DOI:10.1214/09-BA414) 
 MAP = maximum a posteriori
-h_clust_avg = hierarchical clustering by average linkage
-h_clust_comp = hierarchical clustering by complete linkage
+h_clust_avg = hierarchical clustering by average linkage of 1 - posterior similarity,
+              cut at 0.5
+h_clust_comp = hierarchical clustering by complete linkage of 1 - posterior similarity,
+               cut at 0.5
 least_squares = minimize squared distance between clustering and posterior similarity matrix 
 (see Dahl 2006, "Model-Based Clustering...")
 
 """))
+parser.add_argument("--scoring_executor", dest="scoring_executor", type=str, default='serial', \
+                  help="""optional, [default=serial]
+Score the sampled clusterings for --criterion MPEAR or least_squares in
+parallel, among "serial", "thread" and "process" where:
+
+serial = one clustering after another
+thread = in a pool of threads (--scoring_processes threads) sharing the
+         posterior similarity matrix
+process = in a pool of processes (--scoring_processes processes), which
+          memory-map one copy of the posterior similarity matrix
+
+""")
+parser.add_argument("--scoring_processes", dest="scoring_processes", type=int, default=None, \
+                  help="""optional, [default=number of CPUs]
+Number of threads or processes used by --scoring_executor.
+
+""")
 parser.add_argument("--plot", action='store_true', \
                   help="""optional, [default=do not plot anything, if indicated, then plot
 
@@ -192,6 +213,11 @@ Cluster sizes over course of Gibbs Sampling (including burn-in phase I):
 tab-delimited file listing (col 1) optimal cluster number (col 2) gene name
 /path/to/output_path_prefix_optimal_clustering.txt
 
+Posterior frequencies of the distinct partitions among the sampled clusterings, from most 
+to least frequent (cols: frequency, count, number of clusters, cluster of each gene), 
+if --clusterings is given:
+/path/to/output_path_prefix_partition_frequencies.txt
+
 Plot of gene expression over the time-course, for all optimal clusters
 with six panels/clusters per figure:
 /path/to/output_path_prefix_gene_expression_fig_1.pdf
@@ -211,6 +237,19 @@ fmin_tnc = truncated Newton algorithm
 simplex = Nelder-Mead simplex 
 scg = stochastic conjugate gradient 
 
+""")
+parser.add_argument("--gp_backend", dest="gp_backend", type=str, default='native', \
+                  help="""optional, [default=native]
+Implementation of Gaussian process regression used to fit cluster 
+hyperparameters, among "native", "native_stats" and "gpy" where:
+
+native = exact regression implemented with numpy/scipy (lbfgsb, fmin_tnc 
+         and simplex optimizers)
+native_stats = native, fitted exactly from per-time-point counts, means and
+               sums of squares of the cluster members, so that the cost of
+               a fit does not grow with cluster size (same as native with --fast)
+gpy = GPy models (required for the scg optimizer)
+
 """)
 parser.add_argument("-t", "--time_unit", dest="time_unit", type=str, default='', \
                   help="""optional, [default=None] time unit, used for plotting purposes.
@@ -268,6 +307,13 @@ plot_types = args.plot_types.split(',')
 length_scale_mu, length_scale_sigma, sigma_f_mu, sigma_f_sigma = \
 args.length_scale_mu, args.length_scale_sigma, args.sigma_f_mu, args.sigma_f_sigma
 
+if args.gp_backend not in gp.GP_BACKENDS:
+    print "ERROR: gp_backend must be one of native, native_stats, gpy"
+    exit()
+elif args.gp_backend != 'gpy' and args.optimizer not in ['lbfgsb', 'fmin_tnc', 'simplex']:
+    print "WARNING: the %s optimizer requires --gp_backend gpy, using GPy"%(args.optimizer)
+    args.gp_backend = 'gpy'
+
 if criterion == 'MPEAR':
     if not clusterings or not sim_mat:
         print "ERROR: if criterion = MPEAR, must provide both clusterings and similarity_matrix"
@@ -293,6 +339,10 @@ else:
 MPEAR, MAP, least_squares, h_clust_avg, h_clust_comp"""
     exit()
 
+if args.scoring_executor not in executors.EXECUTORS:
+    print "ERROR: scoring_executor must be one of serial, thread, process"
+    exit()
+
 if clusterings:
     clusterings = pd.read_csv(clusterings, delim_whitespace=True)
     gene_names = list(clusterings.columns)
@@ -312,12 +362,21 @@ if log_likelihoods:
 ####
 # Find an optimal "clusters" list, sorted by gene in order of "gene_names" object
 
-if criterion == 'MPEAR':
-    optimal_clusters = cluster_tools.best_clustering_by_mpear(np.array(clusterings), np.array(sim_mat))
+# distinct partitions among the sampled clusterings, which are scored once each
+if clusterings is not None:
+    partitions = cluster_tools.unique_clusterings(np.array(clusterings))
+    print "%s distinct partitions among %s sampled clusterings."%(len(partitions[1]), partitions[1].sum())
+    cluster_tools.save_partition_frequencies(partitions, gene_names, output_path_prefix + "_partition_frequencies.txt")
+
+if criterion == 'MPEAR' or criterion == 'least_squares':
+    scoring_executor = executors.executor(args.scoring_executor, args.scoring_processes)
+    if criterion == 'MPEAR':
+        optimal_clusters = cluster_tools.best_clustering_by_mpear(np.array(clusterings), np.array(sim_mat), scoring_executor, partitions)
+    else:
+        optimal_clusters = cluster_tools.best_clustering_by_sq_dist(np.array(clusterings), np.array(sim_mat), scoring_executor, partitions)
+    scoring_executor.close()
 elif criterion == 'MAP':
     optimal_clusters = cluster_tools.best_clustering_by_log_likelihood(np.array(clusterings), log_likelihoods)
-elif criterion == 'least_squares':
-    optimal_clusters = cluster_tools.best_clustering_by_sq_dist(np.array(clusterings), np.array(sim_mat))
 elif criterion == 'h_clust_avg':
     optimal_clusters = cluster_tools.best_clustering_by_h_clust(np.array(sim_mat), 'average')
 elif criterion == 'h_clust_comp':
@@ -410,7 +469,7 @@ if args.gene_expression_matrix:
 
 optimal_clusters_GP = {}
 for cluster, genes in optimal_cluster_labels.iteritems():
-    optimal_clusters_GP[cluster] = core.dp_cluster(members=genes, sigma_n=sigma_n, X=X, Y=np.array(np.mat(gene_expression_matrix[genes,:])).T, iter_num_at_birth=0)
+    optimal_clusters_GP[cluster] = core.dp_cluster(members=genes, sigma_n=sigma_n, X=X, Y=np.array(np.mat(gene_expression_matrix[genes,:])).T, iter_num_at_birth=0, gp_backend=args.gp_backend)
     optimal_clusters_GP[cluster] = optimal_clusters_GP[cluster].update_cluster_attributes(gene_expression_matrix, sigma_n2_shape, sigma_n2_rate, length_scale_mu, length_scale_sigma, sigma_f_mu, sigma_f_sigma, 0, 10000, args.optimizer)
 
 ####
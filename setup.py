@@ -6,6 +6,8 @@ import numpy
 ext_modules = [Extension("DP_GP.core", ["DP_GP/core.pyx"], 
                          include_dirs=[numpy.get_include()]),
                Extension("DP_GP.cluster_tools", ["DP_GP/cluster_tools.pyx"], 
+                         include_dirs=[numpy.get_include()]),
+               Extension("DP_GP.similarity", ["DP_GP/similarity.pyx"], 
                          include_dirs=[numpy.get_include()])]
                          
 setup(
@@ -0,0 +1,135 @@
+'''
+Tests of the selection of an optimal clustering (DP_GP.cluster_tools).
+'''
+import numpy as np
+from DP_GP import cluster_tools
+from DP_GP import executors
+from DP_GP import similarity
+from DP_GP.trace import clustering_trace
+from test_similarity import sampled_clusterings, brute_force_similarity, backends
+
+def reference_mpear(labels, S):
+    '''MPEAR as computed pair by pair before it was taken cluster by cluster.'''
+    N = S.shape[0]
+    c = np.exp(cluster_tools.log_binomial_coefficient(N, 2))
+    num_term_1, num_term_2, den_term_1 = 0., 0., 0.
+    for j in range(N):
+        for i in range(j):
+            den_term_1 += S[i, j]
+            if labels[i] == labels[j]:
+                num_term_1 += S[i, j]
+                num_term_2 += np.sum(S[:j - 1, j])
+                den_term_1 += 1
+    num_term_2 /= c
+    den_term_1 /= 2
+    return (num_term_1 - num_term_2) / (den_term_1 - num_term_2)
+
+def test_mpear_matches_pairwise_reference():
+    clusterings = sampled_clusterings()
+    S = brute_force_similarity(clusterings)
+    for labels in clusterings[:10]:
+        expected = reference_mpear(labels, S)
+        for sim in backends(clusterings):
+            assert np.isclose(cluster_tools.compute_mpear(labels, sim), expected, rtol=1e-12)
+
+def test_best_clustering_by_mpear_is_backend_and_executor_independent():
+    clusterings = sampled_clusterings()
+    S = brute_force_similarity(clusterings)
+    expected = cluster_tools.relabel_clustering(clusterings[np.argmax([reference_mpear(labels, S) for labels in clusterings])])
+    for sim in backends(clusterings):
+        for kind in executors.EXECUTORS:
+            executor = executors.executor(kind, 2)
+            assert cluster_tools.best_clustering_by_mpear(clusterings, sim, executor) == expected
+            executor.close()
+
+def test_scores_are_executor_independent():
+    # more clusterings than one chunk of scoring tasks
+    clusterings = sampled_clusterings(n_samples=2 * cluster_tools._SCORING_CHUNK + 5, n_genes=30)
+    for sim in backends(clusterings):
+        for criterion, terms in [('MPEAR', cluster_tools.mpear_terms(sim)), ('least_squares', cluster_tools.sum_of_squares(sim))]:
+            expected = cluster_tools.score_clusterings(clusterings, sim, criterion, terms)
+            assert len(expected) == len(clusterings)
+            for kind in executors.EXECUTORS:
+                executor = executors.executor(kind, 2)
+                assert np.array_equal(cluster_tools.score_clusterings(clusterings, sim, criterion, terms, executor), expected)
+                executor.close()
+
+def co_clustering_matrix(labels):
+    return (labels[:,np.newaxis] == labels[np.newaxis,:]).astype(float)
+
+def test_least_squares_distance_matches_dense_distance():
+    clusterings = sampled_clusterings()
+    S = brute_force_similarity(clusterings)
+    for labels in clusterings[:10]:
+        expected = cluster_tools.compute_sq_dist(S, co_clustering_matrix(labels))
+        for sim in backends(clusterings):
+            assert np.isclose(cluster_tools.compute_least_squares_distance(labels, sim), expected, rtol=1e-12)
+
+def test_best_clustering_by_sq_dist_never_materializes_the_similarity_matrix(monkeypatch):
+    clusterings = sampled_clusterings()
+    S = brute_force_similarity(clusterings)
+    expected = cluster_tools.relabel_clustering(clusterings[np.argmin([cluster_tools.compute_sq_dist(S, co_clustering_matrix(labels)) 
+                                                                       for labels in clusterings])])
+    for sim in backends(clusterings)[:2]:
+        monkeypatch.setattr(sim, 'to_dense', None)
+        for kind in executors.EXECUTORS:
+            executor = executors.executor(kind, 2)
+            assert cluster_tools.best_clustering_by_sq_dist(clusterings, sim, executor) == expected
+            executor.close()
+
+def relabelled(clusterings, seed=0):
+    '''The same partitions under random permutations of their cluster labels.'''
+    random_state = np.random.RandomState(seed)
+    return np.array([random_state.permutation(labels.max() + 1)[labels] + 10 for labels in clusterings])
+
+def test_unique_clusterings_counts_relabelled_duplicates():
+    partitions = sampled_clusterings(n_samples=3, n_genes=20)
+    # partition 1 sampled 4 times, partition 0 twice and partition 2 once
+    clusterings = relabelled(partitions[[1, 0, 1, 2, 1, 0, 1]])
+    unique, counts = cluster_tools.unique_clusterings(clusterings)
+    assert np.array_equal(counts, [4, 2, 1])
+    for partition, labels in zip(unique, partitions[[1, 0, 2]]):
+        assert np.array_equal(partition, cluster_tools.relabel_clustering(labels))
+        assert np.array_equal(co_clustering_matrix(partition), co_clustering_matrix(labels))
+    trace = clustering_trace(clusterings.shape[1], chunk=3)
+    for labels in clusterings:
+        trace.append(labels)
+    unique_trace, counts_trace = cluster_tools.unique_clusterings(trace)
+    assert np.array_equal(unique_trace, unique) and np.array_equal(counts_trace, counts)
+
+def test_best_clustering_from_partitions_matches_all_samples():
+    clusterings = relabelled(sampled_clusterings()[np.random.RandomState(3).randint(0, 40, 100)])
+    S = brute_force_similarity(clusterings)
+    partitions = cluster_tools.unique_clusterings(clusterings)
+    for sim in backends(clusterings)[:2]:
+        assert cluster_tools.best_clustering_by_mpear(clusterings, sim, partitions=partitions) == \
+               cluster_tools.best_clustering_by_mpear(clusterings, sim)
+        assert cluster_tools.best_clustering_by_sq_dist(clusterings, sim, partitions=partitions) == \
+               cluster_tools.best_clustering_by_sq_dist(clusterings, sim)
+
+def test_landmark_h_clust_matches_exact_h_clust():
+    # samples of four groups of 15 genes, in each of which a few genes stray
+    random_state = np.random.RandomState(0)
+    groups = np.repeat(np.arange(4), 15)
+    clusterings = np.array([np.where(random_state.uniform(size=60) < 0.1, random_state.randint(0, 4, 60), groups) for s in range(50)])
+    for sim in backends(clusterings):
+        for method in ['average', 'complete']:
+            exact = cluster_tools.best_clustering_by_h_clust(sim, method)
+            assert len(set(exact)) == 4
+            # the condensed distances among 20 landmarks take 1520 bytes
+            approximate = cluster_tools.best_clustering_by_h_clust(sim, method, memory_budget=1600, random_state=np.random.RandomState(1))
+            assert approximate == exact
+
+def test_save_partition_frequencies(tmpdir):
+    partitions = sampled_clusterings(n_samples=3, n_genes=20)
+    unique, counts = cluster_tools.unique_clusterings(relabelled(partitions[[1, 0, 1, 2, 1, 0, 1]]))
+    output = str(tmpdir.join('partition_frequencies.txt'))
+    gene_names = ['gene%s'%(i) for i in range(20)]
+    cluster_tools.save_partition_frequencies((unique[::-1], counts[::-1]), gene_names, output)
+    with open(output) as f:
+        assert f.readline().strip().split('\t') == ['frequency', 'count', 'n_clusters'] + gene_names
+    table = np.loadtxt(output, skiprows=1)
+    assert np.allclose(table[:,0], [4 / 7., 2 / 7., 1 / 7.], atol=1e-4)
+    assert np.array_equal(table[:,1], counts)
+    assert np.array_equal(table[:,2], unique.max(axis=1))
+    assert np.array_equal(table[:,3:], unique)
@@ -0,0 +1,230 @@
+'''
+Tests of the Gibbs sampler (DP_GP.core.gibbs_sampler), on short chains over genes of test/test.txt.
+'''
+import os
+import numpy as np
+import pandas as pd
+import scipy.stats
+import scipy.special
+from DP_GP import core
+from DP_GP import gp
+from DP_GP import parallel
+from test_similarity import pairwise_updates
+
+def gene_expression(n_genes=40, missing_fraction=0., seed=0):
+    '''Mean-centered and scaled expression of the first genes, with values set missing at random.'''
+    expression = pd.read_csv(os.path.join(os.path.dirname(__file__), 'test.txt'), delim_whitespace=True, index_col=0)
+    expression = np.array(expression)[:n_genes]
+    expression = (expression - expression.mean(axis=1)[:,np.newaxis]) / expression.std(axis=1)[:,np.newaxis]
+    missing = np.random.RandomState(seed).uniform(size=expression.shape) < missing_fraction
+    # keep at least one observed time point per gene
+    missing[:,0] = False
+    return np.where(missing, np.nan, expression)
+
+def short_chain(expression, seed=3, **kwargs):
+    '''Gibbs sampler taking a sample at every iteration after a short burn-in.'''
+    settings = {'max_num_iterations':12, 'burnIn_phaseI':3, 'burnIn_phaseII':6, 's':1, 'seed':seed}
+    settings.update(kwargs)
+    return core.gibbs_sampler(expression, np.arange(expression.shape[1], dtype=float), **settings)
+
+def test_cached_log_likelihoods_match_multivariate_normal():
+    expression = gene_expression(missing_fraction=0.15)
+    GS = short_chain(expression)
+    GS.sampler()
+    clusters = GS.get_state()['clusters']
+    clusterIDs = GS.active_clusters()
+    GS.cache_log_likelihoods(clusterIDs)
+    for clusterID in clusterIDs:
+        cluster = clusters[clusterID]
+        for gene, x in enumerate(expression):
+            observed = ~np.isnan(x)
+            # marginal distribution of the observed time points
+            expected = scipy.stats.multivariate_normal.logpdf(x[observed], cluster.mean[observed], cluster.covK[np.ix_(observed, observed)])
+            assert np.isclose(GS.LL_cache[gene, clusterID], expected, rtol=1e-8)
+
+def test_genes_sharing_missing_patterns_are_scored_together():
+    # most genes miss time points in one of three patterns
+    patterns = np.ones((4, 8), dtype=bool)
+    patterns[1,[2,5]] = False
+    patterns[2,3:6] = False
+    patterns[3,0] = False
+    observed = patterns[np.random.RandomState(0).randint(0, 4, 120)]
+    expression = np.where(observed, gene_expression(n_genes=120), np.nan)
+    GS = short_chain(expression)
+    GS.sampler()
+    clusters = GS.get_state()['clusters']
+    clusterIDs = GS.active_clusters()
+    GS.cache_log_likelihoods(clusterIDs)
+    for clusterID in clusterIDs:
+        cluster = clusters[clusterID]
+        for pattern in patterns:
+            genes = np.flatnonzero((observed == pattern).all(axis=1))
+            expected = scipy.stats.multivariate_normal.logpdf(expression[np.ix_(genes, pattern)], cluster.mean[pattern], cluster.covK[np.ix_(pattern, pattern)])
+            assert np.allclose(GS.LL_cache[genes, clusterID], expected, rtol=1e-8)
+        # sub-matrices are factorized once per pattern (by the shared prior for auxiliary clusters)
+        assert len(getattr(cluster, 'prior', cluster).pattern_factors) <= 3
+
+def test_sq_dist_matches_pairwise_update():
+    expression = gene_expression()
+    # sample from the second iteration on, while genes still switch clusters
+    for max_num_iterations in (2, 3, 5, 8):
+        GS = short_chain(expression, max_num_iterations=max_num_iterations, burnIn_phaseI=1, burnIn_phaseII=2, alpha=20.)
+        GS.sampler()
+        state = GS.get_state()
+        clusterings = state['sampled_clusterings'].to_array()
+        assert len(clusterings) == max_num_iterations - 1
+        S, sq_dists = pairwise_updates(clusterings)
+        assert np.isclose(state['current_sq_dist'], sq_dists[-1], rtol=1e-10)
+        assert np.allclose(state['S'].to_dense(), S + S.T + np.eye(len(S)))
+
+def test_resumed_chain_reproduces_uninterrupted_chain(tmpdir):
+    expression = gene_expression()
+    args = (expression, np.arange(expression.shape[1], dtype=float))
+    kwargs = {'max_num_iterations':8, 'burnIn_phaseI':1, 'burnIn_phaseII':2, 's':1, 'alpha':20.}
+    uninterrupted = parallel.run_chain((3, args, kwargs, False))
+    # the last checkpoint of the first run is written at iteration 4, halfway through
+    kwargs.update({'checkpoint_path':str(tmpdir.join('checkpoint.pkl')), 'checkpoint_every':4})
+    parallel.run_chain((3, args, kwargs, False))
+    # the random state is restored from the checkpoint, not seeded anew
+    resumed = parallel.run_chain((4, args, kwargs, True))
+    S, all_clusterings, sampled_clusterings, log_likelihoods, iter_num = resumed
+    assert iter_num == uninterrupted[4] == 8
+    assert np.array_equal(sampled_clusterings.to_array(), uninterrupted[2].to_array())
+    assert np.array_equal(all_clusterings.to_array(), uninterrupted[1].to_array())
+    assert np.allclose(log_likelihoods, uninterrupted[3])
+    assert np.allclose(S.to_dense(), uninterrupted[0].to_dense())
+
+def test_settled_chain_does_not_converge_by_ess():
+    # with these settings, the chain keeps the same two clusters and hyperparameters from the 
+    # first sample on, so that no monitored quantity varies (see also test_diagnostics.py)
+    GS = short_chain(gene_expression(), check_convergence=True, target_ess=1.)
+    iter_num = GS.sampler()[4]
+    ess = GS.get_state()['streaming_diagnostics'].effective_sample_sizes(current=True)
+    assert all(np.isnan(value) for value in ess.values())
+    assert iter_num == 12
+
+def test_cluster_table_shrinks_after_first_sweep():
+    # noisy copies of the genes, more than two chunks of one-gene clusters in the first sweep
+    expression = np.tile(gene_expression(n_genes=120), (5, 1))
+    expression += np.random.RandomState(1).normal(0, 0.05, expression.shape)
+    GS = short_chain(expression, max_num_iterations=3, burnIn_phaseI=2, burnIn_phaseII=3)
+    GS.sampler()
+    clusterIDs = GS.active_clusters()
+    # clusters are moved to the lowest slots and one chunk of free slots is kept
+    assert GS.LL_cache.shape[1] == len(GS.get_state()['clusters']) < expression.shape[0]
+    assert clusterIDs.max() == len(clusterIDs) - 1
+    assert np.in1d(GS.get_state()['sampled_clusterings'].to_array()[-1], clusterIDs).all()
+    # moved columns of the cache are still valid
+    GS.cache_stale_log_likelihoods()
+    cached = GS.LL_cache[:,clusterIDs].copy()
+    GS.cache_log_likelihoods(clusterIDs)
+    assert np.allclose(GS.LL_cache[:,clusterIDs], cached, rtol=1e-10)
+
+def set_partitions(items):
+    '''All partitions of a list of items into non-empty blocks.'''
+    if len(items) == 0:
+        yield []
+        return
+    for partition in set_partitions(items[1:]):
+        yield [[items[0]]] + partition
+        for k in range(len(partition)):
+            yield partition[:k] + [[items[0]] + partition[k]] + partition[k+1:]
+
+def canonical_labels(labels):
+    '''Relabel clusters in order of their first gene.'''
+    return tuple(np.unique(labels, return_index=True)[1].argsort().argsort()[np.unique(labels, return_inverse=True)[1]])
+
+def test_split_merge_moves_sample_posterior_at_fixed_hyperparameters():
+    # genes and hyperparameters for which the posterior is spread over all partitions
+    expression = gene_expression()[[3, 9, 20, 33]]
+    alpha = 1.
+    GS = short_chain(expression, alpha=alpha)
+    GS.sampler()
+    # RBF variance and lengthscale, linear and bias variance, noise variance
+    parameters = np.array([1., 2., 0.01, 0.1, 1.])
+    for clusterID in np.unique(GS.get_state()['last_cluster']):
+        GS.condition_cluster(clusterID, parameters)
+    K = gp.rbf_linear_bias(*parameters[:4]).K(np.vstack(np.arange(expression.shape[1], dtype=float)))
+    
+    # posterior of each partition: Chinese Restaurant Process prior times GP marginal likelihoods
+    posterior = {}
+    for partition in set_partitions(range(4)):
+        labels = np.zeros(4, dtype=int)
+        log_p = 0.
+        for k, genes in enumerate(partition):
+            labels[genes] = k
+            observed = ~np.isnan(expression[genes])
+            log_p += np.log(alpha) + scipy.special.gammaln(len(genes)) + gp.stats_log_likelihood(
+                K, parameters[4], observed.sum(axis=0), expression[genes].sum(axis=0), np.square(expression[genes]).sum(axis=0))
+        posterior[canonical_labels(labels)] = log_p
+    assert len(posterior) == 15
+    log_norm = np.logaddexp.reduce(posterior.values())
+    
+    n_moves = 8000
+    counts = dict.fromkeys(posterior, 0)
+    for move in range(n_moves):
+        GS.split_merge_move()
+        counts[canonical_labels(GS.get_state()['last_cluster'])] += 1
+    for labels, log_p in posterior.items():
+        assert abs(counts[labels] / float(n_moves) - np.exp(log_p - log_norm)) < 0.015
+
+def test_chain_leaves_global_random_state_alone():
+    expression = gene_expression()
+    np.random.seed(0)
+    global_state = np.random.get_state()
+    GS = short_chain(expression, burnIn_phaseI=1, burnIn_phaseII=2, alpha=20.)
+    S, all_clusterings, sampled_clusterings, log_likelihoods, iter_num = GS.sampler()
+    assert all(np.array_equal(value, expected) for value, expected in zip(np.random.get_state(), global_state))
+    # the chain is reproduced from its seed whatever the global state
+    np.random.seed(1)
+    rerun = short_chain(expression, burnIn_phaseI=1, burnIn_phaseII=2, alpha=20.).sampler()
+    assert np.array_equal(rerun[1].to_array(), all_clusterings.to_array())
+    assert np.allclose(rerun[3], log_likelihoods)
+
+def test_cluster_table_matches_assignments():
+    GS = short_chain(gene_expression(), burnIn_phaseI=1, burnIn_phaseII=2, alpha=20.)
+    GS.sampler()
+    state = GS.get_state()
+    n_slots = len(state['clusters'])
+    sizes = np.bincount(state['last_cluster'], minlength=n_slots)
+    assert np.array_equal(state['cluster_sizes'][sizes > 0], sizes[sizes > 0])
+    for slot, cluster in enumerate(state['clusters']):
+        # free slots hold no cluster and are on the free-slot heap
+        assert (cluster is None) == (not state['occupied'][slot]) == (slot in state['free_slots'])
+        if sizes[slot] > 0:
+            assert sorted(cluster.members) == list(np.flatnonzero(state['last_cluster'] == slot))
+    # the lowest free slot is re-used first
+    assert state['free_slots'][0] == min(state['free_slots'])
+
+def test_auxiliary_means_follow_gp_prior():
+    X = np.vstack(np.arange(8, dtype=float))
+    sigma_n = 0.3
+    prior = core.cluster_prior(X, sigma_n=sigma_n)
+    # the posterior mean K (K + sigma_n^2 I)^-1 y of a draw y ~ N(0, K)
+    K = gp.default_kernel('native').K(X)
+    smoother = np.dot(K, np.linalg.inv(K + sigma_n**2 * np.eye(8)))
+    covariance = np.dot(np.dot(smoother, K), smoother.T)
+    assert np.allclose(np.dot(prior.L, prior.L.T), covariance, atol=1e-8)
+    means = prior.draw_means(20000, np.random.RandomState(0))
+    assert means.shape == (20000, 8)
+    scale = np.sqrt(np.diag(covariance))
+    assert np.all(np.abs(means.mean(axis=0)) < 0.05 * scale)
+    assert np.allclose(np.cov(means.T), covariance, atol=0.05 * scale.max()**2)
+    # draws are reproducible from the random state
+    assert np.array_equal(prior.draw_means(3, np.random.RandomState(1)), prior.draw_means(3, np.random.RandomState(1)))
+
+def recomputed_log_posterior(state):
+    '''Log posterior of the current clustering, evaluating the GP model of every cluster.'''
+    sizes = np.bincount(state['last_cluster'])
+    clusterIDs = np.flatnonzero(sizes)
+    return sum(np.log(sizes[clusterID] / float(sizes.sum())) + state['clusters'][clusterID].model.log_likelihood() for clusterID in clusterIDs)
+
+def test_cached_log_posterior_matches_recomputed():
+    GS = short_chain(gene_expression(), burnIn_phaseI=1, burnIn_phaseII=2, alpha=20.)
+    GS.sampler()
+    log_posterior = GS.get_log_posterior()
+    assert np.isclose(log_posterior, recomputed_log_posterior(GS.get_state()), rtol=1e-10)
+    # a cluster updated since is re-evaluated
+    GS.condition_cluster(GS.get_state()['last_cluster'][0], np.array([1., 2., 0.01, 0.1, 1.]))
+    assert not np.isclose(GS.get_log_posterior(), log_posterior)
+    assert np.isclose(GS.get_log_posterior(), recomputed_log_posterior(GS.get_state()), rtol=1e-10)
@@ -0,0 +1,58 @@
+'''
+Tests of the convergence diagnostics (DP_GP.diagnostics).
+'''
+import numpy as np
+from DP_GP import diagnostics
+
+def test_potential_scale_reduction_of_mixed_chains_is_near_one():
+    random_state = np.random.RandomState(0)
+    assert abs(diagnostics.potential_scale_reduction(random_state.normal(size=(4, 1000))) - 1) < 0.01
+    assert diagnostics.potential_scale_reduction(random_state.normal(size=(4, 1000)) + 3 * np.vstack(np.arange(4))) > 2
+
+def test_potential_scale_reduction_of_constant_chains():
+    assert diagnostics.potential_scale_reduction([[3., 3., 3.], [3., 3.]]) == 1
+    # chains stuck at different values have not converged
+    assert diagnostics.potential_scale_reduction([[3., 3., 3.], [4., 4.]]) == np.inf
+    assert np.isnan(diagnostics.potential_scale_reduction([[3., 3., 3.]]))
+
+def test_effective_sample_size_of_independent_and_correlated_samples():
+    random_state = np.random.RandomState(0)
+    assert 800 < diagnostics.effective_sample_size(random_state.normal(size=1000)) < 1200
+    # AR(1) with coefficient 0.9: about n (1 - 0.9) / (1 + 0.9)
+    x = np.zeros(10000)
+    for i in range(1, len(x)):
+        x[i] = 0.9 * x[i - 1] + random_state.normal()
+    assert 350 < diagnostics.effective_sample_size(x) < 700
+
+def test_effective_sample_size_of_constant_trace_is_undefined():
+    assert np.isnan(diagnostics.effective_sample_size([2] * 100))
+    assert np.isnan(diagnostics.effective_sample_size([0.1] * 50))
+    assert np.isnan(diagnostics.effective_sample_size([1., 2., 3.]))
+
+def test_min_effective_sample_size_leaves_out_constant_quantities():
+    random_state = np.random.RandomState(0)
+    streaming = diagnostics.streaming_diagnostics(10, random_state=random_state)
+    log_posteriors = random_state.normal(size=50)
+    # the number of clusters and the co-clustering of pairs are constant
+    for log_posterior in log_posteriors:
+        streaming.add(log_posterior, np.arange(10) % 2)
+    ess = streaming.effective_sample_sizes(current=True)
+    assert np.isnan(ess['n_clusters']) and np.isnan(ess['co_clustering'])
+    assert streaming.min_effective_sample_size() == diagnostics.effective_sample_size(log_posteriors)
+    constant = diagnostics.streaming_diagnostics(10, random_state=random_state)
+    for i in range(50):
+        constant.add(-1., np.arange(10) % 2)
+    assert np.isnan(constant.min_effective_sample_size())
+
+def test_effective_sample_sizes_are_recomputed_as_samples_grow_by_check_growth():
+    random_state = np.random.RandomState(0)
+    streaming = diagnostics.streaming_diagnostics(10, random_state=random_state, check_growth=0.5)
+    computed_at = []
+    for i in range(100):
+        streaming.add(random_state.normal(), random_state.randint(0, 3, 10))
+        streaming.effective_sample_sizes()
+        if streaming.ess_samples == i + 1:
+            computed_at.append(i + 1)
+    assert computed_at == [1, 2, 3, 5, 8, 12, 18, 27, 41, 62, 93]
+    assert streaming.effective_sample_sizes() == streaming.ess
+    assert streaming.effective_sample_sizes(current=True)['log_likelihood'] == diagnostics.effective_sample_size(streaming.log_posteriors)
@@ -0,0 +1,72 @@
+'''
+Tests of the factorization of cluster covariance matrices (DP_GP.core.factorize_covariance).
+'''
+import numpy as np
+import scipy.stats
+from DP_GP import core
+
+def random_covariance(T, rank, seed=0):
+    x = np.random.RandomState(seed).randn(T, rank)
+    return np.dot(x, x.T)
+
+def mvn_log_likelihood(x, rank, factor, log_pdet, triangular):
+    return -0.5 * (rank * np.log(2 * np.pi) + log_pdet + core.factor_sq_norms(x[np.newaxis], factor, triangular)[0])
+
+def test_full_rank_cholesky_matches_eigh():
+    covK = random_covariance(10, 10) + 0.1 * np.eye(10)
+    x = np.random.RandomState(1).randn(10)
+    rank, L, log_pdet, triangular = core.factorize_covariance(covK, 'cholesky')
+    rank_e, U_e, log_pdet_e, triangular_e = core.factorize_covariance(covK, 'eigh')
+    assert triangular and not triangular_e
+    assert rank == rank_e == 10
+    assert np.isclose(log_pdet, np.linalg.slogdet(covK)[1])
+    assert np.isclose(log_pdet, log_pdet_e)
+    assert np.allclose(L, np.linalg.cholesky(covK))
+    assert np.isclose(mvn_log_likelihood(x, rank, L, log_pdet, triangular), mvn_log_likelihood(x, rank_e, U_e, log_pdet_e, triangular_e))
+    assert np.isclose(mvn_log_likelihood(x, rank, L, log_pdet, triangular), scipy.stats.multivariate_normal.logpdf(x, cov=covK))
+
+def test_log_likelihood_matrix_mixes_cholesky_and_eigh_factors():
+    random_state = np.random.RandomState(2)
+    covs = [random_covariance(10, 10, seed) + 0.1 * np.eye(10) for seed in range(4)] + [random_covariance(10, 3, 4)]
+    means = random_state.randn(5, 10)
+    expression = random_state.randn(30, 10)
+    rank, factors, log_pdet, triangular = [np.array(values) for values in zip(*[core.factorize_covariance(cov, factorization) 
+                                                                                for cov, factorization in zip(covs, ['cholesky', 'eigh'] * 2 + ['cholesky'])])]
+    assert list(triangular) == [True, False, True, False, False]
+    LL = core.log_likelihood_matrix(expression, means, factors, triangular, rank, log_pdet)
+    for k in range(4):
+        assert np.allclose(LL[:,k], scipy.stats.multivariate_normal.logpdf(expression, means[k], covs[k]))
+    # rank-deficient: the density on the support, whose pseudo-determinant is the product of the non-zero eigenvalues
+    assert np.allclose(LL[:,4], scipy.stats.multivariate_normal.logpdf(expression, means[4], covs[4], allow_singular=True))
+
+def test_rank_deficient_falls_back_to_eigh():
+    covK = random_covariance(10, 3)
+    rank, L, log_pdet, triangular = core.factorize_covariance(covK, 'cholesky')
+    rank_e, U_e, log_pdet_e, triangular_e = core.factorize_covariance(covK, 'eigh')
+    assert not triangular
+    assert rank == rank_e == 3
+    assert np.isclose(log_pdet, log_pdet_e)
+    # pseudo-determinant: product of the non-zero eigenvalues
+    assert np.isclose(log_pdet, np.sum(np.log(np.linalg.eigvalsh(covK)[-3:])))
+
+def test_jittered_cholesky_without_rtol_factors_singular_matrix():
+    # drawing cluster means from the prior accepts jittered factors of singular matrices
+    L = core.jittered_cholesky(random_covariance(10, 3))
+    assert L is not None
+    assert core.jittered_cholesky(random_covariance(10, 3), rtol=core._RANK_RTOL) is None
+
+def test_log_likelihood_matrix_is_independent_of_chunking(monkeypatch):
+    random_state = np.random.RandomState(3)
+    covs = [random_covariance(8, 8, seed) + 0.1 * np.eye(8) for seed in range(6)]
+    means = random_state.randn(6, 8)
+    expression = random_state.randn(25, 8)
+    rank, factors, log_pdet, triangular = [np.array(values) for values in zip(*[core.factorize_covariance(cov, factorization) 
+                                                                                for cov, factorization in zip(covs, ['cholesky', 'eigh'] * 3)])]
+    LL = core.log_likelihood_matrix(expression, means, factors, triangular, rank, log_pdet)
+    # each gene scored on its own, as by one gene of a Gibbs sweep
+    for gene, x in enumerate(expression):
+        assert np.allclose(core.log_likelihood_matrix(x[np.newaxis], means, factors, triangular, rank, log_pdet)[0], LL[gene], rtol=1e-12)
+    # chunks of one and of seven genes
+    for chunk in [1, 7]:
+        monkeypatch.setattr(core, '_LL_CHUNK', chunk * 6 * 8)
+        assert np.allclose(core.log_likelihood_matrix(expression, means, factors, triangular, rank, log_pdet), LL, rtol=1e-12)
@@ -0,0 +1,85 @@
+'''
+Parity of the native GP regression backends (DP_GP.gp) with GPy, on clusters of test/test.txt.
+'''
+import os
+import numpy as np
+import pandas as pd
+import GPy
+from DP_GP import gp
+
+# default priors of bin/DP_GP_cluster.py
+PRIORS = (12., 2., 0., 1., 0., 1.)
+
+def cluster_expression(cluster, missing_fraction=0., seed=0):
+    '''Mean-centered and scaled expression of the 20 genes of a cluster, with values set missing at random.'''
+    expression = pd.read_csv(os.path.join(os.path.dirname(__file__), 'test.txt'), delim_whitespace=True, index_col=0)
+    expression = np.array(expression)[20 * cluster:20 * (cluster + 1)]
+    expression = (expression - expression.mean(axis=1)[:,np.newaxis]) / expression.std(axis=1)[:,np.newaxis]
+    missing = np.random.RandomState(seed).uniform(size=expression.shape) < missing_fraction
+    return np.where(missing, np.nan, expression)
+
+def stacked(expression):
+    '''Inputs and outputs of all observed (time point, expression) pairs, as fitted without --fast.'''
+    t = np.arange(expression.shape[1], dtype=float)
+    observed = ~np.isnan(expression)
+    X = np.vstack(np.tile(t, (expression.shape[0], 1))[observed])
+    return X, np.vstack(expression[observed])
+
+def gpy_model(X, Y):
+    model = GPy.models.GPRegression(X=X, Y=Y, kernel=gp.default_kernel('gpy'))
+    gp.set_priors(model, *PRIORS)
+    return model
+
+def native_model(X, Y, backend='native'):
+    model = gp.regression(X, Y, gp.default_kernel(backend), backend)
+    gp.set_priors(model, *PRIORS)
+    return model
+
+def gpy_objective(model, theta):
+    '''Objective and gradient in the transformed parameters, as seen by GPy's optimizers.'''
+    return model._objective_grads(theta)
+
+def test_objective_matches_gpy():
+    random_state = np.random.RandomState(1)
+    for cluster in range(6):
+        X, Y = stacked(cluster_expression(cluster))
+        native, reference = native_model(X, Y), gpy_model(X, Y)
+        for i in range(3):
+            theta = random_state.normal(0, 1, 5)
+            objective, gradient = native.objective(theta)
+            gpy_value, gpy_gradient = gpy_objective(reference, theta)
+            assert np.isclose(objective, gpy_value, rtol=1e-8)
+            assert np.allclose(gradient, gpy_gradient, rtol=1e-6, atol=1e-8)
+
+def test_fitted_hyperparameters_match_gpy():
+    for cluster in range(6):
+        X, Y = stacked(cluster_expression(cluster))
+        native, reference = native_model(X, Y), gpy_model(X, Y)
+        native.optimize('lbfgsb')
+        reference.optimize('lbfgsb')
+        assert np.allclose(native.param_array, reference.param_array, rtol=1e-3, atol=1e-5)
+        assert np.isclose(native.objective(gp.logexp_inverse(native.param_array))[0], reference.objective_function(), atol=1e-4)
+
+def test_fitted_hyperparameters_match_gpy_with_missing_values():
+    for cluster in range(6):
+        expression = cluster_expression(cluster, missing_fraction=0.2, seed=cluster)
+        X, Y = stacked(expression)
+        t = np.vstack(np.arange(expression.shape[1], dtype=float))
+        stats, reference = native_model(t, expression.T, 'native_stats'), gpy_model(X, Y)
+        theta = gp.logexp_inverse(reference.param_array)
+        assert np.isclose(stats.objective(theta)[0], gpy_objective(reference, theta)[0], rtol=1e-8)
+        stats.optimize('lbfgsb')
+        reference.optimize('lbfgsb')
+        assert np.allclose(stats.param_array, reference.param_array, rtol=1e-3, atol=1e-5)
+        assert np.isclose(stats.objective(gp.logexp_inverse(stats.param_array))[0], reference.objective_function(), atol=1e-4)
+
+def test_fitted_hyperparameters_match_gpy_fast():
+    # --fast: genes are outputs sharing one kernel
+    for cluster in range(6):
+        expression = cluster_expression(cluster)
+        t = np.vstack(np.arange(expression.shape[1], dtype=float))
+        native, reference = native_model(t, expression.T), gpy_model(t, expression.T)
+        native.optimize('lbfgsb')
+        reference.optimize('lbfgsb')
+        assert np.allclose(native.param_array, reference.param_array, rtol=1e-3, atol=1e-5)
+        assert np.isclose(native.objective(gp.logexp_inverse(native.param_array))[0], reference.objective_function(), atol=1e-4)
@@ -0,0 +1,54 @@
+'''
+Tests of running and merging several Gibbs sampling chains (DP_GP.parallel).
+'''
+import os
+import signal
+import threading
+import numpy as np
+import pytest
+from DP_GP import core
+from DP_GP import parallel
+from DP_GP import similarity
+from test_similarity import sampled_clusterings
+from test_trace import filled_trace
+from test_core import gene_expression
+
+def chain_result(clusterings, spill_path):
+    '''sampler() output of a chain that sampled the given clusterings.'''
+    S = similarity.dense_similarity(clusterings.shape[1], len(clusterings))
+    for labels in clusterings:
+        S.add(labels)
+    return S, None, filled_trace(clusterings, spill_path=spill_path), list(np.arange(len(clusterings), dtype=float)), len(clusterings)
+
+def test_merged_trace_is_spilled_to_its_own_file(tmpdir):
+    clusterings = sampled_clusterings(n_samples=20, n_genes=12)
+    results = [chain_result(clusterings[:10], str(tmpdir.join('chain0.bin'))), chain_result(clusterings[10:], str(tmpdir.join('chain1.bin')))]
+    chain0_size = tmpdir.join('chain0.bin').size()
+    S, _, merged, log_likelihoods, iter_num = parallel.merge_chains(results, str(tmpdir.join('merged.bin')))
+    assert np.array_equal(merged.to_array(), clusterings)
+    assert merged.spill_path == str(tmpdir.join('merged.bin'))
+    assert tmpdir.join('merged.bin').size() == merged.spill_size > 0
+    # the trace of the first chain is left as it was
+    assert tmpdir.join('chain0.bin').size() == chain0_size
+    assert np.array_equal(results[0][2].to_array(), clusterings[:10])
+    assert log_likelihoods == range(10) + range(10)
+
+@pytest.mark.parametrize('processes', [1, 2])
+def test_sigterm_terminates_all_chains(tmpdir, processes):
+    expression = gene_expression()
+    args = (expression, np.arange(expression.shape[1], dtype=float))
+    # chains that would run for minutes
+    kwargs = {'max_num_iterations':10000, 'burnIn_phaseI':1, 'burnIn_phaseII':2, 's':1, 'alpha':20.,
+              'checkpoint_path':str(tmpdir.join('checkpoint.pkl'))}
+    timer = threading.Timer(3., os.kill, (os.getpid(), signal.SIGTERM))
+    timer.start()
+    try:
+        with pytest.raises(core.SamplingTerminated):
+            parallel.sample_chains(2, 3, args, kwargs, processes=processes)
+    finally:
+        timer.cancel()
+    # running chains wrote a final checkpoint, from which they can resume, and 
+    # with one process, the second chain was not started
+    for k in range(2):
+        assert tmpdir.join('checkpoint_chain%s.pkl'%(k)).check() == (k < processes)
+    assert signal.getsignal(signal.SIGTERM) == signal.SIG_DFL
@@ -0,0 +1,101 @@
+'''
+Tests of the posterior similarity matrix backends (DP_GP.similarity).
+'''
+import numpy as np
+from DP_GP import similarity
+
+def sampled_clusterings(n_samples=40, n_genes=60, seed=0):
+    random_state = np.random.RandomState(seed)
+    return np.array([random_state.randint(0, random_state.randint(1, 8), n_genes) for s in range(n_samples)])
+
+def brute_force_similarity(clusterings):
+    return np.mean([labels[:,np.newaxis] == labels[np.newaxis,:] for labels in clusterings], axis=0)
+
+def backends(clusterings):
+    dense = similarity.dense_similarity(clusterings.shape[1], len(clusterings))
+    partition = similarity.partition_similarity(clusterings.shape[1], chunk=16)
+    for labels in clusterings:
+        dense.add(labels)
+        partition.add(labels)
+    return [dense, partition, similarity.matrix_similarity(brute_force_similarity(clusterings))]
+
+def test_rows_and_blocks_match_brute_force():
+    clusterings = sampled_clusterings()
+    S = brute_force_similarity(clusterings)
+    genes = np.random.RandomState(1).choice(S.shape[0], 15, replace=False)
+    for sim in backends(clusterings):
+        assert np.allclose(sim.rows(genes), S[genes])
+        assert np.allclose(sim.block(genes), S[np.ix_(genes, genes)])
+        assert np.allclose(sim.to_dense(), S)
+
+def test_block_sum_matches_brute_force():
+    clusterings = sampled_clusterings()
+    S = brute_force_similarity(clusterings)
+    for labels in sampled_clusterings(n_samples=10, seed=2):
+        order, starts, ends = similarity.label_runs(labels)
+        expected = np.sum(S[labels[:,np.newaxis] == labels[np.newaxis,:]])
+        for sim in backends(clusterings):
+            assert np.isclose(sim.block_sum(order, starts, ends), expected)
+
+def test_empty_backends_are_identity():
+    labels = np.array([0, 1, 0, 2])
+    order, starts, ends = similarity.label_runs(labels)
+    for sim in [similarity.dense_similarity(4, 10), similarity.partition_similarity(4)]:
+        assert np.array_equal(sim.to_dense(), np.eye(4))
+        assert sim.block_sum(order, starts, ends) == 4
+
+def test_shared_backends_round_trip(tmpdir):
+    clusterings = sampled_clusterings()
+    S = brute_force_similarity(clusterings)
+    for sim in backends(clusterings):
+        shared = similarity.load_similarity(similarity.share_similarity(sim, str(tmpdir.join(sim.backend + '.npy'))))
+        assert shared.backend == sim.backend
+        assert np.allclose(shared.to_dense(), S)
+
+def test_partition_runs_are_sorted_once_per_sample(tmpdir):
+    clusterings = sampled_clusterings()
+    partition = backends(clusterings[:30])[1]
+    assert partition.runs is None
+    runs = partition.sample_runs()
+    # reused until samples are added, then extended by the added samples only
+    partition.rows(np.arange(5))
+    assert partition.sample_runs() is runs
+    for labels in clusterings[30:]:
+        partition.add(labels)
+    orders, ends = partition.sample_runs()
+    assert np.array_equal(orders[:30], runs[0]) and np.array_equal(ends[:30], runs[1])
+    for s, labels in enumerate(partition.samples()):
+        order, starts, run_ends = similarity.label_runs(labels)
+        assert np.array_equal(orders[s], order)
+        assert np.array_equal(ends[s,:len(run_ends)], run_ends)
+    assert np.allclose(partition.to_dense(), brute_force_similarity(clusterings))
+    # runs are not shared with other processes
+    shared = similarity.load_similarity(similarity.share_similarity(partition, str(tmpdir.join('partition.npy'))))
+    assert shared.runs is None
+
+def pairwise_updates(clusterings):
+    '''
+    Running averages of the lower triangle of co-clustering, and squared distances of each
+    clustering to the previous average, as updated gene pair by gene pair before S was
+    kept as counts by label runs.
+    '''
+    N = clusterings.shape[1]
+    genes1, genes2 = np.tril_indices(N, k=-1)
+    S, sq_dists = np.zeros((N, N)), []
+    for n, labels in enumerate(clusterings, 1):
+        S_new = np.zeros((N, N))
+        for gene1, gene2 in zip(genes1, genes2):
+            if labels[gene1] == labels[gene2]:
+                S_new[gene1, gene2] += 1.0
+        diff = S - S_new
+        sq_dists.append(np.sum(np.dot(diff, diff)))
+        S = (S * (n - 1.0) + S_new) / float(n)
+    return S, sq_dists
+
+def test_label_run_counts_match_pairwise_update():
+    clusterings = sampled_clusterings(n_samples=15, n_genes=30)
+    S, sq_dists = pairwise_updates(clusterings)
+    S = S + S.T + np.eye(len(S))
+    dense, partition = backends(clusterings)[:2]
+    assert np.array_equal(dense.counts, np.rint(S * len(clusterings)))
+    assert np.allclose(partition.to_dense(), S)
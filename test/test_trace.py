@@ -0,0 +1,58 @@
+'''
+Tests of the append-only storage of clusterings (DP_GP.trace.clustering_trace).
+'''
+import copy
+import numpy as np
+from DP_GP.trace import clustering_trace
+from test_similarity import sampled_clusterings
+
+def filled_trace(clusterings, **kwargs):
+    trace = clustering_trace(clusterings.shape[1], chunk=4, **kwargs)
+    for labels in clusterings:
+        trace.append(labels)
+    return trace
+
+def test_spilled_trace_round_trips(tmpdir):
+    clusterings = sampled_clusterings(n_samples=10, n_genes=12)
+    # a label beyond uint8 from the seventh row on
+    clusterings[6:,0] = 300
+    spill_path = str(tmpdir.join('trace.bin'))
+    trace = filled_trace(clusterings, spill_path=spill_path)
+    assert len(trace) == 10
+    # two full chunks spilled, of uint8 and uint16 labels, and two rows in memory
+    assert [spilled[0] for rows, spilled in trace.chunks] == ['|u1', '<u2']
+    assert tmpdir.join('trace.bin').size() == 4 * 12 * (1 + 2)
+    assert trace.n_current == 2
+    assert np.array_equal(trace.to_array(), clusterings)
+    assert np.array_equal(np.vstack(list(trace.iter_chunks())), clusterings)
+    assert np.array_equal(np.array(trace), clusterings)
+    assert np.array_equal(filled_trace(clusterings).to_array(), clusterings)
+
+def test_saved_trace_has_gene_header(tmpdir):
+    clusterings = sampled_clusterings(n_samples=10, n_genes=12)
+    trace = filled_trace(clusterings, spill_path=str(tmpdir.join('trace.bin')))
+    trace.columns = np.array(['gene%s'%(i) for i in range(12)])
+    output = str(tmpdir.join('clusterings.txt'))
+    trace.save(output)
+    with open(output) as f:
+        assert f.readline().strip().split('\t') == list(trace.columns)
+    assert np.array_equal(np.loadtxt(output, skiprows=1, dtype=int), clusterings)
+
+def test_extend_appends_all_rows(tmpdir):
+    clusterings = sampled_clusterings(n_samples=10, n_genes=12)
+    trace = filled_trace(clusterings[:3], spill_path=str(tmpdir.join('trace.bin')))
+    trace.extend(filled_trace(clusterings[3:], spill_path=str(tmpdir.join('other.bin'))))
+    assert len(trace) == 10
+    assert np.array_equal(trace.to_array(), clusterings)
+
+def test_resumed_trace_overwrites_chunks_of_interrupted_run(tmpdir):
+    clusterings = sampled_clusterings(n_samples=20, n_genes=12)
+    trace = filled_trace(clusterings[:6], spill_path=str(tmpdir.join('trace.bin')))
+    checkpoint = copy.deepcopy(trace)
+    # the interrupted run spills chunks after its checkpoint
+    for labels in clusterings[6:14]:
+        trace.append(labels)
+    for labels in clusterings[14:]:
+        checkpoint.append(labels)
+    assert np.array_equal(checkpoint.to_array(), np.vstack((clusterings[:6], clusterings[14:])))
+    assert tmpdir.join('trace.bin').size() == checkpoint.spill_size